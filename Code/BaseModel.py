@@ -1,5 +1,5 @@
 # import requirements.
-from OpenGL.GL import *
+from glbackend import gl
 
 from matutils import *
 
@@ -10,6 +10,15 @@ from mesh import Mesh
 from shaders import *
 from texture import Texture
 
+# CPU profiler of the frame stages.
+from profiler import profiler
+from gpuprofiler import gpu_profiler
+
+# leveled logging of the runtime profile.
+from runtime import get_logger
+
+log = get_logger(__name__)
+
 
 class BaseModel:
     '''
@@ -17,12 +26,13 @@ class BaseModel:
     Can inherit from this to create new models.
     '''
 
-    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=GL_TRIANGLES, visible=True):
+    def __init__(self, scene, M=poseMatrix(), mesh=Mesh(), color=[1., 1., 1.], primitive=gl.GL_TRIANGLES, visible=True, arena=None):
         '''
         Initialise the model data
+        :param arena: [optional] a BufferArena in which to store the mesh data, instead of the model's own buffers
         '''
 
-        print('+ Initializing {}'.format(self.__class__.__name__))
+        log.debug('+ Initializing %s', self.__class__.__name__)
 
         # if this flag is set to False, the model is not rendered.
         self.visible = visible
@@ -53,18 +63,24 @@ class BaseModel:
         # store the position of the model in the scene.
         self.M = M
 
-        # use a Vertex Array Object to pack all buffers for rendering in the GPU.
-        self.vao = glGenVertexArrays(1)
+        # buffer arena shared with other models, and the ranges allocated to this model in it.
+        self.arena = arena
+        self.allocation = None
+
+        # use a Vertex Array Object to pack all buffers for rendering in the GPU, models in an arena share its VAO.
+        if self.arena is None:
+            self.vao = gl.glGenVertexArrays(1)
+        else:
+            self.vao = self.arena.vao
 
         # buffer will be used to store indices if using shared vertex representation.
         self.index_buffer = None
 
     def initialise_vbo(self, name, data):
-        print('Initialising VBO for attribute {}'.format(name))
+        log.debug('Initialising VBO for attribute %s', name)
 
         if data is None:
-            print('(W) Warning in {}.bind_attribute(): Data array for attribute {} is None!'.format(
-                self.__class__.__name__, name))
+            log.warning('%s.bind_attribute(): Data array for attribute %s is None!', self.__class__.__name__, name)
             return
 
         # bind the location of the attribute in the GLSL program to the next index.
@@ -72,21 +88,21 @@ class BaseModel:
         self.attributes[name] = len(self.vbos)
 
         # create a buffer object.
-        self.vbos[name] = glGenBuffers(1)
+        self.vbos[name] = gl.glGenBuffers(1)
         # and bind it.
-        glBindBuffer(GL_ARRAY_BUFFER, self.vbos[name])
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbos[name])
 
         # enable the attribute.
-        glEnableVertexAttribArray(self.attributes[name])
+        gl.glEnableVertexAttribArray(self.attributes[name])
 
         # associate the bound buffer to the corresponding input location in the shader.
         # each instance of the vertex shader will get one row of the array.
         # so this can be processed in parallel.
-        glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=GL_FLOAT, normalized=False,
+        gl.glVertexAttribPointer(index=self.attributes[name], size=data.shape[1], type=gl.GL_FLOAT, normalized=False,
                               stride=0, pointer=None)
 
         # set the data in the buffer as the vertex array.
-        glBufferData(GL_ARRAY_BUFFER, data, GL_STATIC_DRAW)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, data, gl.GL_STATIC_DRAW)
 
     def bind_shader(self, shader):
         '''
@@ -106,11 +122,17 @@ class BaseModel:
         Stores the vertex data in a Vertex Buffer Object (VBO) that can be uploaded to the GPU at render time.
         '''
 
+        # models in an arena only need a range of its buffers, with attribute locations fixed by the arena.
+        if self.arena is not None:
+            self.attributes = self.arena.attributes
+            self.allocation = self.arena.allocate(self.mesh)
+            return
+
         # bind the VAO to retrieve all buffers and rendering context.
-        glBindVertexArray(self.vao)
+        gl.glBindVertexArray(self.vao)
 
         if self.mesh.vertices is None:
-            print('(W) Warning in {}.bind(): No vertex array!'.format(self.__class__.__name__))
+            log.warning('%s.bind(): No vertex array!', self.__class__.__name__)
 
         # initialise vertex position VBO and link to shader program attribute.
         self.initialise_vbo('position', self.mesh.vertices)
@@ -122,13 +144,13 @@ class BaseModel:
 
         # if indices are provided, put them in a buffer too.
         if self.mesh.faces is not None:
-            self.index_buffer = glGenBuffers(1)
-            glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
-            glBufferData(GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, GL_STATIC_DRAW)
+            self.index_buffer = gl.glGenBuffers(1)
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+            gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, self.mesh.faces, gl.GL_STATIC_DRAW)
 
         # unbind the VAO and VBO.
-        glBindVertexArray(0)
-        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
 
     def draw(self, Mp=poseMatrix()):
         '''
@@ -140,41 +162,59 @@ class BaseModel:
         if self.visible:
 
             if self.mesh.vertices is None:
-                print('(W) Warning in {}.draw(): No vertex array!'.format(self.__class__.__name__))
+                log.warning('%s.draw(): No vertex array!', self.__class__.__name__)
 
             # bind the Vertex Array Object.
-            glBindVertexArray(self.vao)
+            gl.glBindVertexArray(self.vao)
 
             # setup the shader program and provide it the Model, View and Projection matrices to use for rendering.
-            self.shader.bind(
-                model=self,
-                M=np.matmul(Mp, self.M)
-            )
+            with profiler.scope('shader.bind'):
+                self.shader.bind(
+                    model=self,
+                    M=np.matmul(Mp, self.M)
+                )
 
             # bind all textures.
             for unit, tex in enumerate(self.mesh.textures):
-                glActiveTexture(GL_TEXTURE0 + unit)
+                gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
                 tex.bind()
 
             # check whether the data is stored as vertex array or index array.
-            if self.mesh.faces is not None:
-                # draw the data in the buffer using the index array.
-                glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], GL_UNSIGNED_INT, None )
-            else:
-                # draw the data in the buffer using the vertex array ordering only.
-                glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
+            with profiler.scope('draw call'), gpu_profiler.scope(self.mesh.material.name):
+                self.draw_call()
 
             # unbind the shader to avoid side effects.
-            glBindVertexArray(0)
+            gl.glBindVertexArray(0)
+
+    def draw_call(self):
+        '''
+        Draws the geometry of the model with the program in use, e.g. for a depth only pass. The Vertex Array Object
+        must be bound.
+        '''
+        if self.allocation is not None:
+            # draw our range of the arena buffers.
+            self.arena.draw(self.allocation, self.primitive)
+        elif self.mesh.faces is not None:
+            # draw the data in the buffer using the index array.
+            gl.glDrawElements(self.primitive, self.mesh.faces.flatten().shape[0], gl.GL_UNSIGNED_INT, None )
+        else:
+            # draw the data in the buffer using the vertex array ordering only.
+            gl.glDrawArrays(self.primitive, 0, self.mesh.vertices.shape[0])
 
     def __del__(self):
         '''
         Release all VBO objects when finished.
         '''
-        for vbo in self.vbos.items():
-            glDeleteBuffers(1, vbo)
+        if self.arena is not None:
+            # return our ranges to the arena, the buffers themselves belong to it.
+            if self.allocation is not None:
+                self.arena.free(self.allocation)
+            return
+
+        for vbo in self.vbos.values():
+            gl.glDeleteBuffers(1, [vbo])
 
-        glDeleteVertexArrays(self.vao)
+        gl.glDeleteVertexArrays(1, [self.vao])
 
 
 class DrawModelFromMesh(BaseModel):
@@ -182,22 +222,22 @@ class DrawModelFromMesh(BaseModel):
     Base class for all models, inherit from this to create new models
     '''
 
-    def __init__(self, scene, M, mesh, shader=None):
+    def __init__(self, scene, M, mesh, shader=None, arena=None):
         '''
         Initialise the model data
         '''
 
-        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh)
+        BaseModel.__init__(self, scene=scene, M=M, mesh=mesh, arena=arena)
 
         # and we check which primitives we need to use for drawing.
         if self.mesh.faces.shape[1] == 3:
-            self.primitive = GL_TRIANGLES
+            self.primitive = gl.GL_TRIANGLES
 
         elif self.mesh.faces.shape[1] == 4:
-            self.primitive = GL_QUADS
+            self.primitive = gl.GL_QUADS
 
         else:
-            print('(E) Error in DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found {}!'.format(self.indices.shape[1]))
+            log.error('DrawModelFromObjFile.__init__(): index array must have 3 (triangles) or 4 (quads) columns, found %d!', self.indices.shape[1])
 
         self.bind()
 
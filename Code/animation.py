@@ -0,0 +1,310 @@
+# import requirements
+import numpy as np
+
+from matutils import *
+
+from runtime import get_logger
+
+'''
+Keyframe animation of model transforms. Tracks of position, rotation (as unit quaternions [x,y,z,w]) and scale keys
+are stored in flat arrays, and all active tracks are evaluated each frame in a single vectorised pass: the key pairs
+are found with one binary search over all tracks, the values are blended with a batched lerp or slerp, and the
+resulting matrices are written directly into the storage that the animated models use as their model matrix.
+'''
+
+log = get_logger(__name__)
+
+POSITION = 0
+ROTATION = 1
+SCALE = 2
+
+# number of components and rest value of each kind of track.
+TRACK_WIDTHS = {POSITION: 3, ROTATION: 4, SCALE: 3}
+TRACK_DEFAULTS = {POSITION: [0., 0., 0.], ROTATION: [0., 0., 0., 1.], SCALE: [1., 1., 1.]}
+
+
+def quaternionFromAxisAngle(axis, angle):
+    '''
+    Returns the unit quaternion [x,y,z,w] of a rotation of angle radians around axis.
+    '''
+    axis = np.asarray(axis, dtype='f')
+    axis = axis / np.linalg.norm(axis)
+    return np.append(axis * np.sin(angle / 2.), np.cos(angle / 2.)).astype('f')
+
+
+def lerp(a, b, alpha):
+    '''
+    Batched linear interpolation between the rows of a and b.
+    '''
+    return a + (b - a) * alpha[:, np.newaxis]
+
+
+def slerp(q0, q1, alpha):
+    '''
+    Batched spherical linear interpolation between the unit quaternions in the rows of q0 and q1.
+    '''
+    dot = np.sum(q0 * q1, axis=1)
+
+    # take the shortest path around the sphere.
+    q1 = np.where(dot[:, np.newaxis] < 0., -q1, q1)
+    dot = np.abs(dot)
+
+    # close quaternions are blended linearly to avoid dividing by a vanishing sine.
+    theta = np.arccos(np.clip(dot, -1., 1.))
+    sin_theta = np.sin(theta)
+    close = sin_theta < 1e-4
+    safe = np.where(close, 1., sin_theta)
+    w0 = np.where(close, 1. - alpha, np.sin((1. - alpha) * theta) / safe)
+    w1 = np.where(close, alpha, np.sin(alpha * theta) / safe)
+
+    q = q0 * w0[:, np.newaxis] + q1 * w1[:, np.newaxis]
+    return q / np.linalg.norm(q, axis=1, keepdims=True)
+
+
+def composeMatrices(positions, rotations, scales, out=None):
+    '''
+    Batched TRS matrices from (N,3) positions, (N,4) unit quaternions and (N,3) scale factors.
+    :param out: [optional] (N,4,4) float32 array to write the result into
+    '''
+    n = positions.shape[0]
+    if out is None:
+        out = np.empty((n, 4, 4), dtype='f')
+
+    x, y, z, w = rotations.T
+    R = out[:, :3, :3]
+    R[:, 0, 0] = 1. - 2. * (y * y + z * z)
+    R[:, 0, 1] = 2. * (x * y - z * w)
+    R[:, 0, 2] = 2. * (x * z + y * w)
+    R[:, 1, 0] = 2. * (x * y + z * w)
+    R[:, 1, 1] = 1. - 2. * (x * x + z * z)
+    R[:, 1, 2] = 2. * (y * z - x * w)
+    R[:, 2, 0] = 2. * (x * z - y * w)
+    R[:, 2, 1] = 2. * (y * z + x * w)
+    R[:, 2, 2] = 1. - 2. * (x * x + y * y)
+
+    # R*S scales the columns of the rotation.
+    R *= scales[:, np.newaxis, :]
+    out[:, :3, 3] = positions
+    out[:, 3, :3] = 0.
+    out[:, 3, 3] = 1.
+    return out
+
+
+class Animator:
+    '''
+    Class to hold and evaluate the keyframe tracks of a set of targets. A target is any object with a model matrix
+    attribute M, such as a BaseModel or a glTF Node. Once bound, the target's M is a view into the animator's
+    matrix storage, so evaluating the tracks updates the target without any per-target Python code.
+    '''
+    def __init__(self, capacity=64):
+        '''
+        :param capacity: initial number of targets, the storage grows as needed
+        '''
+        self.matrices = np.tile(np.identity(4, dtype='f'), (capacity, 1, 1))
+        self.targets = []
+        self.active = np.zeros(capacity, dtype=bool)
+
+        # tracks as added, before packing.
+        self.tracks = {kind: [] for kind in TRACK_WIDTHS}
+        self.packed = None
+
+    def bind(self, target):
+        '''
+        Bind a target to the animator storage, the current model matrix of the target is kept until it is animated.
+        :return: the index of the target in the storage
+        '''
+        for index, bound in enumerate(self.targets):
+            if bound is target:
+                # re-bind in case the model matrix was replaced since.
+                self.matrices[index] = target.M
+                target.M = self.matrices[index]
+                return index
+
+        index = len(self.targets)
+        if index == self.matrices.shape[0]:
+            self._grow(2 * index)
+
+        self.matrices[index] = target.M
+        self.targets.append(target)
+        target.M = self.matrices[index]
+        return index
+
+    def _grow(self, capacity):
+        matrices = np.tile(np.identity(4, dtype='f'), (capacity, 1, 1))
+        matrices[:len(self.targets)] = self.matrices[:len(self.targets)]
+        self.matrices = matrices
+        self.active = np.append(self.active, np.zeros(capacity - self.active.shape[0], dtype=bool))
+
+        # the storage moved, so all targets need to view the new array.
+        for index, target in enumerate(self.targets):
+            target.M = self.matrices[index]
+
+    def add_track(self, target, kind, times, values, loop=True, start=0., speed=1.):
+        '''
+        Add a keyframe track to a target, and start playing it.
+        :param target: the object to animate
+        :param kind: POSITION, ROTATION or SCALE
+        :param times: (K,) increasing key times in seconds
+        :param values: (K,3) positions or scales, or (K,4) quaternions
+        :param loop: whether the track loops, otherwise it holds its last value
+        :param start: the time at which the track starts
+        :param speed: playback speed factor
+        '''
+        index = self.bind(target)
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+        values = np.asarray(values, dtype='f').reshape(times.shape[0], TRACK_WIDTHS[kind])
+        self.tracks[kind].append((index, times, values, loop, start, speed))
+        self.active[index] = True
+        self.packed = None
+
+    def add_clip(self, target, times, positions=None, rotations=None, scales=None, **kwargs):
+        '''
+        Add position, rotation and scale tracks sharing the same key times to a target.
+        '''
+        for kind, values in ((POSITION, positions), (ROTATION, rotations), (SCALE, scales)):
+            if values is not None:
+                self.add_track(target, kind, times, values, **kwargs)
+
+    def play(self, target):
+        '''
+        Resume animating a target, re-binding its model matrix to the storage.
+        '''
+        self.active[self.bind(target)] = True
+
+    def stop(self, target):
+        '''
+        Stop animating a target, it keeps its last evaluated matrix.
+        '''
+        for index, bound in enumerate(self.targets):
+            if bound is target:
+                self.active[index] = False
+
+    @property
+    def track_count(self):
+        return sum(len(tracks) for tracks in self.tracks.values())
+
+    def _pack(self):
+        '''
+        Concatenate the keys of all tracks of each kind, with a key time offset per track so that a single sorted
+        array can be searched for all tracks at once.
+        '''
+        self.packed = {}
+        for kind, tracks in self.tracks.items():
+            if not tracks:
+                continue
+
+            first = np.array([times[0] for _, times, _, _, _, _ in tracks])
+            duration = np.array([times[-1] - times[0] for _, times, _, _, _, _ in tracks])
+            counts = np.array([times.shape[0] for _, times, _, _, _, _ in tracks])
+            offsets = np.concatenate([[0], np.cumsum(counts)])
+            track_ids = np.repeat(np.arange(len(tracks)), counts)
+
+            # each track gets its own window of the global time axis.
+            stride = duration.max() + 1.
+            keys = np.concatenate([times - times[0] for _, times, _, _, _, _ in tracks]) + track_ids * stride
+
+            self.packed[kind] = {
+                'target': np.array([track[0] for track in tracks]),
+                'loop': np.array([track[3] for track in tracks]),
+                'start': np.array([track[4] for track in tracks]),
+                'speed': np.array([track[5] for track in tracks]),
+                'first': first,
+                'duration': duration,
+                'offsets': offsets,
+                'stride': stride,
+                'keys': keys,
+                'values': np.concatenate([values for _, _, values, _, _, _ in tracks]),
+            }
+
+    def _evaluate(self, packed, time, width):
+        '''
+        Evaluate all active tracks of a kind at the given time.
+        :return: the target indices and the (T,width) interpolated values
+        '''
+        active = self.active[packed['target']]
+        tracks = np.flatnonzero(active)
+
+        # local time of each track, wrapped or clamped to its key range.
+        local = (time - packed['start'][tracks]) * packed['speed'][tracks]
+        duration = packed['duration'][tracks]
+        wrapped = np.mod(local, np.where(duration > 0., duration, 1.))
+        local = np.where(packed['loop'][tracks], wrapped, np.clip(local, 0., duration))
+
+        # batched binary search for the key pair around the local time of each track.
+        start = packed['offsets'][tracks]
+        end = packed['offsets'][tracks + 1]
+        query = local + tracks * packed['stride']
+        i0 = np.searchsorted(packed['keys'], query, side='right') - 1
+        i0 = np.clip(i0, start, np.maximum(end - 2, start))
+        i1 = np.minimum(i0 + 1, end - 1)
+
+        keys = packed['keys']
+        span = keys[i1] - keys[i0]
+        alpha = np.where(span > 0., (query - keys[i0]) / np.where(span > 0., span, 1.), 0.)
+        alpha = np.clip(alpha, 0., 1.).astype('f')
+
+        values = packed['values']
+        if width == 4:
+            result = slerp(values[i0], values[i1], alpha)
+        else:
+            result = lerp(values[i0], values[i1], alpha)
+        return packed['target'][tracks], result
+
+    def update(self, time):
+        '''
+        Evaluate all active tracks at the given time and write the matrices of the animated targets.
+        :param time: the animation time in seconds
+        '''
+        if self.packed is None:
+            self._pack()
+
+        n = len(self.targets)
+        animated = np.zeros(n, dtype=bool)
+        channels = {}
+        for kind, width in TRACK_WIDTHS.items():
+            channels[kind] = np.tile(np.array(TRACK_DEFAULTS[kind], dtype='f'), (n, 1))
+            if kind in self.packed:
+                targets, values = self._evaluate(self.packed[kind], time, width)
+                channels[kind][targets] = values
+                animated[targets] = True
+
+        # targets without active tracks keep their matrix.
+        if animated.all():
+            composeMatrices(channels[POSITION], channels[ROTATION], channels[SCALE], out=self.matrices[:n])
+        elif animated.any():
+            self.matrices[:n][animated] = composeMatrices(
+                channels[POSITION][animated], channels[ROTATION][animated], channels[SCALE][animated])
+
+
+def benchmark(tracks=10000, keys=16, frames=200):
+    '''
+    Time the evaluation of a number of position, rotation and scale tracks per frame.
+    '''
+    import time
+
+    class Target:
+        def __init__(self):
+            self.M = np.identity(4, dtype='f')
+
+    rng = np.random.default_rng(0)
+    animator = Animator()
+    targets = [Target() for _ in range(tracks // 3)]
+    for target in targets:
+        times = np.sort(rng.uniform(0., 10., keys))
+        axes = rng.standard_normal((keys, 3))
+        rotations = np.array([quaternionFromAxisAngle(a, t) for a, t in zip(axes, rng.uniform(0., 6.28, keys))])
+        animator.add_clip(target, times, positions=rng.standard_normal((keys, 3)), rotations=rotations,
+                          scales=rng.uniform(0.5, 2., (keys, 3)), loop=True)
+
+    animator.update(0.)
+    start = time.perf_counter()
+    for frame in range(frames):
+        animator.update(frame / 60.)
+    elapsed = (time.perf_counter() - start) / frames
+
+    log.info('%d tracks on %d targets, %d keys each: %.3f ms per frame',
+             animator.track_count, len(targets), keys, 1000 * elapsed)
+
+
+if __name__ == '__main__':
+    benchmark()
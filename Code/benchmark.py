@@ -0,0 +1,237 @@
+# import requirements
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import tempfile
+import time
+import timeit
+from types import SimpleNamespace
+
+import numpy as np
+
+import glbackend
+from glbackend import RecordingBackend
+from runtime import get_logger, quiet
+
+'''
+Benchmark suite of the CPU hot paths: loading Blender files and material libraries, fixing the texture indexing,
+calculating the normals, building the matrices, updating the camera and binding the Phong shader for a model. The
+loaders run on the bundled models and on synthetic meshes of increasing size, and GL is switched to the no-op
+recording backend so that no window or GPU is needed. Results are saved to JSON with the machine they were measured
+on, and compare() flags the cases which got slower than a baseline by more than a threshold.
+'''
+
+log = get_logger(__name__)
+
+# bundled models, relative to the Code directory.
+MODELS = ('models/car2.obj', 'models/test.obj')
+
+# number of groups of the synthetic meshes, each group is a 40x40 vertices grid patch.
+SCALES = (5, 20)
+
+
+def machine():
+    '''
+    Returns a description of the machine and versions the benchmark ran on.
+    '''
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpu_count': multiprocessing.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def time_case(function, repeats, number=1):
+    '''
+    Time a function, quietly, over several repeats of number calls.
+    :return: the best and mean time of one call in milliseconds
+    '''
+    with quiet(), np.errstate(all='ignore'):
+        times = np.array(timeit.repeat(function, number=number, repeat=repeats)) / number
+    return {'best': 1000. * float(times.min()), 'mean': 1000. * float(times.mean()), 'repeats': repeats}
+
+
+def grid_mesh(size):
+    '''
+    A size x size vertices grid with texture coordinates, and its faces in the Blender (F,3,2) 1-based format.
+    '''
+    u, v = np.meshgrid(np.linspace(0., 1., size), np.linspace(0., 1., size))
+    vertices = np.column_stack([u.ravel(), np.sin(3. * u.ravel()) * np.cos(2. * v.ravel()), v.ravel()]).astype('f')
+    textures = np.column_stack([u.ravel(), v.ravel()]).astype('f')
+    cells = (np.arange(size - 1)[:, None] * size + np.arange(size - 1)[None, :]).ravel()
+    triangles = np.concatenate([np.stack([cells, cells + 1, cells + size + 1], axis=1),
+                                np.stack([cells, cells + size + 1, cells + size], axis=1)])
+    faces = np.repeat(triangles[:, :, None] + 1, 2, axis=2)
+    return vertices, textures, faces
+
+
+def loader_cases(file_name, label, repeats):
+    '''
+    Cases of the Blender file loaders on one file.
+    '''
+    from blender import load_obj_file, load_material_library
+
+    mtl_name = os.path.splitext(file_name)[0] + '.mtl'
+    cases = {'load_obj_file[{}]'.format(label): time_case(lambda: load_obj_file(file_name), repeats)}
+    if os.path.exists(mtl_name):
+        cases['load_material_library[{}]'.format(label)] = time_case(lambda: load_material_library(mtl_name), repeats)
+    return cases
+
+
+def mesh_cases(sizes, repeats):
+    '''
+    Cases of the per-mesh preprocessing on grids of increasing size.
+    '''
+    from blender import fix_blender_textures
+    from mesh import calculate_normals
+
+    cases = {}
+    for size in sizes:
+        vertices, textures, faces = grid_mesh(size)
+        label = '{}v'.format(vertices.shape[0])
+        cases['fix_blender_textures[{}]'.format(label)] = time_case(
+            lambda: fix_blender_textures(textures, faces, vertices), repeats)
+        cases['calculate_normals[{}]'.format(label)] = time_case(
+            lambda: calculate_normals(vertices, faces[:, :, 0] - 1, textures), repeats)
+    return cases
+
+
+def matrix_cases(repeats, n=1000):
+    '''
+    Cases of the matrix constructors, timed per call, and of the camera update.
+    '''
+    from matutils import translationMatrix, rotationMatrixX, rotationMatrixY, rotationMatrixZ, scaleMatrix, \
+        poseMatrix, frustumMatrix, lookAtMatrix, poseMatrices
+    from camera import Camera
+
+    rng = np.random.default_rng(0)
+    positions = rng.standard_normal((n, 3)).astype('f')
+    angles = rng.uniform(0., 2. * np.pi, n).astype('f')
+
+    cases = {
+        'translationMatrix': lambda: translationMatrix([1., 2., 3.]),
+        'rotationMatrixX': lambda: rotationMatrixX(0.5),
+        'rotationMatrixY': lambda: rotationMatrixY(0.5),
+        'rotationMatrixZ': lambda: rotationMatrixZ(0.5),
+        'scaleMatrix': lambda: scaleMatrix([1., 2., 3.]),
+        'poseMatrix': lambda: poseMatrix([1., 2., 3.], 0.5, 2.),
+        'frustumMatrix': lambda: frustumMatrix(-1., 1., -1., 1., 1., 100.),
+        'lookAtMatrix': lambda: lookAtMatrix([10., 10., 10.], [0., 0., 0.]),
+    }
+    results = {name: time_case(function, repeats, number=n) for name, function in cases.items()}
+    results['poseMatrices[{}]'.format(n)] = time_case(lambda: poseMatrices(positions, angles), repeats)
+
+    camera = Camera()
+    results['Camera.update'] = time_case(camera.update, repeats, number=n)
+    return results
+
+
+def bind_cases(repeats, n=1000):
+    '''
+    Case of the per-model bind of the Phong shader, with the flat GLSL and GL calls going to the no-op backend.
+    '''
+    from material import Material
+    from shaders import FlatShader
+    from uniformblocks import MaterialTable
+
+    with quiet():
+        shader = FlatShader()
+        shader.compile({'position': 0, 'normal': 1, 'color': 2, 'texCoord': 3})
+        scene = SimpleNamespace(materials=MaterialTable())
+
+    model = SimpleNamespace(scene=scene, mesh=SimpleNamespace(material=Material(), textures=[]))
+    M = np.identity(4, dtype='f')
+    return {'PhongShader.bind': time_case(lambda: shader.bind(model, M), repeats, number=n)}
+
+
+def run(output='benchmark.json', repeats=5, scales=SCALES):
+    '''
+    Run all the cases and save the results with the machine description.
+    :param output: the JSON file to save the results to, not saved if None
+    :param repeats: the number of times each case is timed
+    :param scales: the numbers of groups of the synthetic Blender files
+    :return: the results
+    '''
+    from objstream import write_synthetic_obj
+
+    previous = glbackend.use(RecordingBackend())
+    cases = {}
+    try:
+        for file_name in MODELS:
+            log.info('--> Timing %s', file_name)
+            cases.update(loader_cases(file_name, os.path.basename(file_name), repeats))
+
+        with tempfile.TemporaryDirectory() as directory:
+            for groups in scales:
+                file_name = write_synthetic_obj(directory, groups=groups)
+                log.info('--> Timing synthetic file of %d groups', groups)
+                cases.update(loader_cases(file_name, 'synthetic{}'.format(groups), repeats))
+
+        log.info('--> Timing meshes, matrices and shader binding')
+        cases.update(mesh_cases((40, 100), repeats))
+        cases.update(matrix_cases(repeats))
+        cases.update(bind_cases(repeats))
+    finally:
+        glbackend.use(previous)
+
+    results = {'machine': machine(), 'cases': cases}
+    for name, case in cases.items():
+        log.info('- %-40s %10.4f ms', name, case['best'])
+
+    if output is not None:
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=1)
+        log.info('--> Saved results to %s', output)
+    return results
+
+
+def compare(baseline, current, threshold=0.1):
+    '''
+    Compare the best times of two results files, and flag the cases slower than the baseline by more than threshold.
+    :return: the names of the regressed cases
+    '''
+    runs = []
+    for file_name in (baseline, current):
+        with open(file_name, 'r') as file:
+            runs.append(json.load(file))
+
+    if runs[0]['machine']['platform'] != runs[1]['machine']['platform'] or \
+            runs[0]['machine']['processor'] != runs[1]['machine']['processor']:
+        log.warning('the results were measured on different machines')
+
+    regressions = []
+    log.info('%-40s %10s %10s %8s', '(ms)', 'baseline', 'current', 'change')
+    for name, case in runs[1]['cases'].items():
+        reference = runs[0]['cases'].get(name)
+        if reference is None:
+            log.info('%-40s %10s %10.4f      new', name, '-', case['best'])
+            continue
+
+        change = (case['best'] - reference['best']) / reference['best'] if reference['best'] > 0. else 0.
+        if change > threshold:
+            regressions.append(name)
+            log.warning('%-40s %10.4f %10.4f %+7.1f%%  <-- regression', name, reference['best'], case['best'], 100. * change)
+        else:
+            log.info('%-40s %10.4f %10.4f %+7.1f%%', name, reference['best'], case['best'], 100. * change)
+
+    if regressions:
+        log.warning('%d case(s) slower than the baseline by more than %.0f%%', len(regressions), 100. * threshold)
+    else:
+        log.info('--> No regression beyond %.0f%%', 100. * threshold)
+    return regressions
+
+
+if __name__ == '__main__':
+    # usage: python benchmark.py run [results.json] [repeats]
+    #        python benchmark.py compare baseline.json results.json [threshold]
+    arguments = sys.argv[1:] or ['run']
+    if arguments[0] == 'compare':
+        regressions = compare(arguments[1], arguments[2], float(arguments[3]) if len(arguments) > 3 else 0.1)
+        sys.exit(1 if regressions else 0)
+    else:
+        run(arguments[1] if len(arguments) > 1 else 'benchmark.json', int(arguments[2]) if len(arguments) > 2 else 5)
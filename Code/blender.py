@@ -1,15 +1,21 @@
 # import requirements
+import os
+
 import numpy as np
 
 from material import Material,MaterialLibrary
 from mesh import Mesh
 
+from runtime import get_logger
+
 '''
 Functions for reading models from blender. 
 Source: 
 https://en.wikipedia.org/wiki/Wavefront_.obj_file
 '''
 
+log = get_logger(__name__)
+
 def process_line(line):
 	'''
 	Read the Blender3D object file, line by line.
@@ -27,25 +33,25 @@ def process_line(line):
 	elif fields[0] == 'v':
 		label = 'vertex'
 		if len(fields) != 4:
-			print('(E) Error, 3 entries expected for vertex')
+			log.error('3 entries expected for vertex')
 			return None
 	
 	elif fields[0] == 'vn':
 		label = 'vertex normal'
 		if len(fields) != 4:
-			print('(E) Error, 3 entries expected for vertex normal')
+			log.error('3 entries expected for vertex normal')
 			return None
 
 	elif fields[0] == 'vt':
 		label = 'vertex texture'
 		if len(fields) != 3:
-			print('(E) Error, 2 entries expected for vertex texture')
+			log.error('2 entries expected for vertex texture')
 			return None
 
 	elif fields[0] == 'mtllib':
 		label = 'material library'
 		if len(fields) != 2:
-			print('(E) Error, material library file name missing')
+			log.error('material library file name missing')
 			return None
 		else:
 			return (label, fields[1])
@@ -53,7 +59,7 @@ def process_line(line):
 	elif fields[0] == 'usemtl':
 		label = 'material'
 		if len(fields) != 2:
-			print('(E) Error, material file name missing')
+			log.error('material file name missing')
 			return None
 		else:
 			return (label, fields[1])
@@ -61,7 +67,7 @@ def process_line(line):
 	elif fields[0] == 'f':
 		label = 'face'
 		if len(fields) != 4 and len(fields) != 5:
-			print('(E) Error, 3 or 4 entries expected for faces\n{}'.format(line))
+			log.error('3 or 4 entries expected for faces\n%s', line)
 			return None
 		'''
 		face lines can have multiple formats, e.g. f 586/1 1860/2 1781/3 or f vi/ti/ni, where where vi is the vertex
@@ -70,7 +76,7 @@ def process_line(line):
 		return ( label, [ [np.uint32(i) for i in v.split('/')] for v in fields[1:] ] )
 
 	else:
-		print('(E) Unknown line: {}'.format(fields))
+		log.error('Unknown line: %s', fields)
 		return None
 
 	return (label, [float(token) for token in fields[1:]])
@@ -83,7 +89,7 @@ def load_material_library(file_name):
 	library = MaterialLibrary()
 	material = None
 
-	print('-- Loading material library {}'.format(file_name))
+	log.debug('-- Loading material library %s', file_name)
 
 	mtlfile = open(file_name)
 	for line in mtlfile:
@@ -94,7 +100,7 @@ def load_material_library(file_name):
 					library.add_material(material)
 
 				material = Material(fields[1])
-				print('Found material definition: {}'.format(material.name))
+				log.debug('Found material definition: %s', material.name)
 			elif fields[0] == 'Ka':
 				material.Ka = np.array(fields[1:], 'f')
 			elif fields[0] == 'Kd':
@@ -114,16 +120,18 @@ def load_material_library(file_name):
 
 	library.add_material(material)
 
-	print('- Done, loaded {} materials'.format(len(library.materials)))
+	log.debug('- Done, loaded %d materials', len(library.materials))
 
 	return library
 
 
-def load_obj_file(file_name):
+def load_obj_file(file_name, workers=None):
 	'''
 	Load a Blender3D object file.
+	:param file_name: the path to the .obj file
+	:param workers: [optional] number of worker processes used to preprocess the meshes, serial if None or 1
 	'''
-	print('Loading mesh(es) from Blender file: {}'.format(file_name))
+	log.info('Loading mesh(es) from Blender file: %s', file_name)
 
 	vlist = []	# list of vertices.
 	tlist = []	# list of texture vectors.
@@ -184,24 +192,32 @@ def load_obj_file(file_name):
 					lnlist.append(line_nb)
 
 			elif data[0] == 'material library':
-				library = load_material_library('models/{}'.format(data[1]))
+				# the material library is stored next to the object file.
+				library = load_material_library(os.path.join(os.path.dirname(file_name), data[1]))
 
 			# material indicate a new mesh in the file, so we store the previous one if not empty and start
 			# a new one.
 			elif data[0] == 'material':
 				material = library.names[data[1]]
 				mesh_id += 1
-				print('[l.{}] Loading mesh with material: {}'.format(line_nb, data[1]))
+				log.debug('[l.%d] Loading mesh with material: %s', line_nb, data[1])
 
-	print('File read. Found {} vertices and {} faces.'.format(len(vlist), len(flist)))
+	log.debug('File read. Found %d vertices and %d faces.', len(vlist), len(flist))
 
-	return create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist)
+	return create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist, workers=workers)
 
 
-def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist):
+def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist, workers=None):
 	'''
 	Create the meshes.
+	:param workers: [optional] number of worker processes, if more than one the per-mesh preprocessing (texture
+	welding and normals) is fanned out to a process pool, see preprocess.py.
 	'''
+	if workers is not None and workers > 1:
+		# imported here as the preprocess module depends on this one.
+		from preprocess import create_meshes_parallel
+		return create_meshes_parallel(vlist, flist, mlist, tlist, library, mesh_list, workers)
+
 	fstart = 0
 	mesh_id = 1
 	meshes = []
@@ -216,13 +232,12 @@ def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, l
 
 	for f in range(len(flist)):
 		if mesh_id != mesh_list[f]:  # new mesh is denoted by change in material.
-			print('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s' % (mesh_id, fstart, f, lnlist[fstart], mlist[fstart], library.materials[mlist[fstart]].name))
+			log.debug('Creating new mesh %i, faces %i-%i, line %i, with material %i: %s', mesh_id, fstart, f, lnlist[fstart], mlist[fstart], library.materials[mlist[fstart]].name)
 			try:
 				mesh = create_mesh(varray, tarray, flist, fstart, f, library, material)
 				meshes.append(mesh)
-			except Exception as e:
-				print('(W) could not load mesh!')
-				print(e)
+			except Exception:
+				log.exception('could not load mesh!')
 				raise
 
 			mesh_id = mesh_list[f]
@@ -235,10 +250,10 @@ def create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, l
 	try:
 		meshes.append(create_mesh(varray, tarray, flist, fstart, len(flist), library, material))
 	except:
-		print('(W) could not load mesh!')
+		log.exception('could not load mesh!')
 		raise
 
-	print('--- Created {} mesh(es) from Blender file.'.format(len(meshes)))
+	log.debug('--- Created %d mesh(es) from Blender file.', len(meshes))
 	return meshes
 
 
@@ -250,10 +265,8 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
 	vmax = np.max(farray[:, :, 0].flatten())
 	vmin = np.min(farray[:, :, 0].flatten()) - 1
 
-	# fix blender texture indexing.
-	textures = fix_blender_textures(tarray, farray, varray)
-	if textures is not None:
-		textures = textures[vmin:vmax, :]
+	# fix blender texture indexing, only over the range of vertices used by this mesh.
+	textures = fix_blender_textures(tarray, farray, varray, vmin, vmax)
 
 	return Mesh(
 			vertices=varray[vmin:vmax, :],
@@ -263,24 +276,29 @@ def create_mesh(varray, tarray, flist, fstart, f, library, material):
 		)
 
 
-def fix_blender_textures(textures, faces, vertices):
+def fix_blender_textures(textures, faces, vertices, vmin=0, vmax=None):
 	'''
 	Corrects the indexing of textures in Blender file for OpenGL.
 	Blender allows for multiple indexing of vertices and textures, which is not supported by OpenGL.
 	This function ensures that indexing is consistent.
 	:param textures: Original Blender texture UV values
 	:param faces: Blender faces multiple-index
-	:return: a new texture array indexed according to vertices.
+	:param vmin: [optional] first vertex (0-based) of the range covered by the faces
+	:param vmax: [optional] end of the vertex range covered by the faces, all vertices if None
+	:return: a new texture array indexed according to vertices[vmin:vmax].
 	'''
 
 	if faces.shape[2] == 1:
-		print('(W) No texture indices provided, setting texture coordinate array as None!')
+		log.warning('No texture indices provided, setting texture coordinate array as None!')
 		return None
 
-	new_textures = np.zeros((vertices.shape[0], 2), dtype='f')
+	if vmax is None:
+		vmax = vertices.shape[0]
+
+	new_textures = np.zeros((vmax - vmin, 2), dtype='f')
 
 	for f in range(faces.shape[0]):
 		for j in range(faces.shape[1]):
-			new_textures[faces[f, j, 0] - 1, :] = textures[faces[f, j, 1] - 1, :]
+			new_textures[faces[f, j, 0] - 1 - vmin, :] = textures[faces[f, j, 1] - 1, :]
 
 	return new_textures
@@ -0,0 +1,357 @@
+# imports all openGL functions
+from glbackend import gl
+
+import bisect
+import ctypes
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+Sub-allocation of vertex and index data in a few large OpenGL buffers. Instead of each model creating a Vertex
+Array Object and one buffer per attribute, models get a range of vertices and a range of indices in the arena, and
+are drawn with a base vertex offset. This avoids creating and deleting thousands of small GL objects when loading
+and unloading content at runtime.
+'''
+
+log = get_logger(__name__)
+
+
+class FreeListAllocator:
+    '''
+    Class to sub-allocate ranges in a linear space of a given capacity. Free blocks are kept sorted by offset so that
+    neighbouring free blocks can be merged when a range is released.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.free_blocks = [[0, capacity]] if capacity > 0 else []
+
+    def allocate(self, size):
+        '''
+        Allocate a range using the smallest free block large enough.
+        :param size: the size of the range
+        :return: the offset of the range, or None if no free block is large enough
+        '''
+        best = None
+        for i, (offset, length) in enumerate(self.free_blocks):
+            if length >= size and (best is None or length < self.free_blocks[best][1]):
+                best = i
+                if length == size:
+                    break
+
+        if best is None:
+            return None
+
+        offset, length = self.free_blocks[best]
+        if length == size:
+            del self.free_blocks[best]
+        else:
+            self.free_blocks[best] = [offset + size, length - size]
+        return offset
+
+    def free(self, offset, size):
+        '''
+        Release a range, merging it with the neighbouring free blocks.
+        '''
+        if size == 0:
+            return
+
+        i = bisect.bisect_left(self.free_blocks, [offset, size])
+        self.free_blocks.insert(i, [offset, size])
+
+        # merge with the next block.
+        if i + 1 < len(self.free_blocks) and offset + size == self.free_blocks[i + 1][0]:
+            self.free_blocks[i][1] += self.free_blocks[i + 1][1]
+            del self.free_blocks[i + 1]
+
+        # merge with the previous block.
+        if i > 0 and self.free_blocks[i - 1][0] + self.free_blocks[i - 1][1] == offset:
+            self.free_blocks[i - 1][1] += self.free_blocks[i][1]
+            del self.free_blocks[i]
+
+    def grow(self, capacity):
+        '''
+        Extend the space to a larger capacity, the new space is added as a free block.
+        '''
+        self.free(self.capacity, capacity - self.capacity)
+        self.capacity = capacity
+
+    def reset(self, used):
+        '''
+        Mark the first used elements as allocated and the rest as free, after compaction.
+        '''
+        self.free_blocks = [[used, self.capacity - used]] if used < self.capacity else []
+
+    @property
+    def free_size(self):
+        return sum(length for _, length in self.free_blocks)
+
+    @property
+    def largest_free_block(self):
+        return max((length for _, length in self.free_blocks), default=0)
+
+    @property
+    def fragmentation(self):
+        '''
+        Fraction of the free space which is not in the largest free block, 0 when all free space is contiguous.
+        '''
+        free = self.free_size
+        if free == 0:
+            return 0.
+        return 1. - self.largest_free_block / free
+
+
+class ArenaAllocation:
+    '''
+    Class to hold the ranges allocated to a mesh in the arena. Offsets are updated in place when the arena is
+    defragmented, so models should keep a reference to this object rather than copying the offsets.
+    '''
+    def __init__(self, vertex_offset, vertex_count, index_offset, index_count):
+        self.vertex_offset = vertex_offset
+        self.vertex_count = vertex_count
+        self.index_offset = index_offset
+        self.index_count = index_count
+
+
+class BufferArena:
+    '''
+    Class to hold large vertex and index buffers shared by many models.
+    '''
+
+    # attributes stored in the arena, with their number of components. The location of each attribute is fixed by
+    # its position in this list, so that all models share the same Vertex Array Object.
+    attribute_sizes = [('position', 3), ('normal', 3), ('color', 3), ('texCoord', 2), ('tangent', 3), ('binormal', 3)]
+
+    def __init__(self, vertex_capacity=1 << 16, index_capacity=1 << 18, defragment_threshold=0.5):
+        '''
+        :param vertex_capacity: the initial number of vertices in the arena
+        :param index_capacity: the initial number of indices in the arena
+        :param defragment_threshold: fragmentation above which the arena is compacted when a range is freed
+        '''
+        self.defragment_threshold = defragment_threshold
+        self.attributes = {name: location for location, (name, _) in enumerate(self.attribute_sizes)}
+
+        self.vertices = FreeListAllocator(vertex_capacity)
+        self.indices = FreeListAllocator(index_capacity)
+        self.allocations = []
+
+        # counters for the statistics.
+        self.defragment_count = 0
+        self.grow_count = 0
+
+        self.vao = gl.glGenVertexArrays(1)
+        self.vbos = {name: self._create_buffer(gl.GL_ARRAY_BUFFER, vertex_capacity * size * 4)
+                     for name, size in self.attribute_sizes}
+        self.index_buffer = self._create_buffer(gl.GL_ELEMENT_ARRAY_BUFFER, index_capacity * 4)
+        self._setup_vao()
+
+    def _create_buffer(self, target, size):
+        buffer = gl.glGenBuffers(1)
+        gl.glBindBuffer(target, buffer)
+        gl.glBufferData(target, size, None, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBuffer(target, 0)
+        return buffer
+
+    def _setup_vao(self):
+        '''
+        Link the arena buffers to the attribute locations, needs to be redone when buffers are re-created.
+        '''
+        gl.glBindVertexArray(self.vao)
+        for name, size in self.attribute_sizes:
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbos[name])
+            gl.glEnableVertexAttribArray(self.attributes[name])
+            gl.glVertexAttribPointer(index=self.attributes[name], size=size, type=gl.GL_FLOAT, normalized=False,
+                                  stride=0, pointer=None)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+        gl.glBindVertexArray(0)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+    def allocate(self, mesh):
+        '''
+        Allocate space for a mesh and upload its data.
+        :param mesh: the Mesh object
+        :return: an ArenaAllocation object
+        '''
+        vertex_count = mesh.vertices.shape[0]
+        index_count = 0 if mesh.faces is None else mesh.faces.size
+
+        vertex_offset = self._allocate(self.vertices, vertex_count)
+        index_offset = self._allocate(self.indices, index_count)
+
+        allocation = ArenaAllocation(vertex_offset, vertex_count, index_offset, index_count)
+        self.allocations.append(allocation)
+
+        data = {
+            'position': mesh.vertices,
+            'normal': mesh.normals,
+            'color': mesh.colors,
+            'texCoord': mesh.textureCoords,
+            'tangent': mesh.tangents,
+            'binormal': mesh.binormals,
+        }
+        for name, size in self.attribute_sizes:
+            # attributes missing from the mesh are cleared so that the range does not show stale data.
+            if data[name] is None:
+                values = np.zeros((vertex_count, size), dtype=np.float32)
+            else:
+                values = np.ascontiguousarray(data[name], dtype=np.float32)
+            gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbos[name])
+            gl.glBufferSubData(gl.GL_ARRAY_BUFFER, vertex_offset * size * 4, values.nbytes, values)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, 0)
+
+        if index_count > 0:
+            faces = np.ascontiguousarray(mesh.faces, dtype=np.uint32)
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.index_buffer)
+            gl.glBufferSubData(gl.GL_ELEMENT_ARRAY_BUFFER, index_offset * 4, faces.nbytes, faces)
+            gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, 0)
+
+        return allocation
+
+    def _allocate(self, allocator, size):
+        '''
+        Allocate a range, compacting or growing the arena if no free block is large enough.
+        '''
+        if size == 0:
+            return 0
+
+        offset = allocator.allocate(size)
+        if offset is None and allocator.free_size >= size:
+            self.defragment()
+            offset = allocator.allocate(size)
+
+        if offset is None:
+            capacity = allocator.capacity
+            while capacity - allocator.capacity < size:
+                capacity *= 2
+            self._grow(allocator, capacity)
+            offset = allocator.allocate(size)
+
+        return offset
+
+    def free(self, allocation):
+        '''
+        Release the ranges of an allocation, and compact the arena if it becomes too fragmented.
+        '''
+        self.allocations.remove(allocation)
+        self.vertices.free(allocation.vertex_offset, allocation.vertex_count)
+        self.indices.free(allocation.index_offset, allocation.index_count)
+        allocation.vertex_count = 0
+        allocation.index_count = 0
+
+        if max(self.vertices.fragmentation, self.indices.fragmentation) > self.defragment_threshold:
+            self.defragment()
+
+    def draw(self, allocation, primitive=gl.GL_TRIANGLES):
+        '''
+        Draw an allocation, the arena VAO must be bound.
+        '''
+        if allocation.index_count > 0:
+            gl.glDrawElementsBaseVertex(primitive, allocation.index_count, gl.GL_UNSIGNED_INT,
+                                     ctypes.c_void_p(allocation.index_offset * 4), allocation.vertex_offset)
+        else:
+            gl.glDrawArrays(primitive, allocation.vertex_offset, allocation.vertex_count)
+
+    def _copy_buffer(self, source, capacity, moves):
+        '''
+        Create a new buffer and copy ranges of the source buffer in it.
+        :param moves: list of (source offset, destination offset, size) in bytes
+        :return: the new buffer
+        '''
+        buffer = self._create_buffer(gl.GL_COPY_WRITE_BUFFER, capacity)
+        gl.glBindBuffer(gl.GL_COPY_READ_BUFFER, source)
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, buffer)
+        for read_offset, write_offset, size in moves:
+            if size > 0:
+                gl.glCopyBufferSubData(gl.GL_COPY_READ_BUFFER, gl.GL_COPY_WRITE_BUFFER, read_offset, write_offset, size)
+        gl.glBindBuffer(gl.GL_COPY_READ_BUFFER, 0)
+        gl.glBindBuffer(gl.GL_COPY_WRITE_BUFFER, 0)
+        gl.glDeleteBuffers(1, [source])
+        return buffer
+
+    def _grow(self, allocator, capacity):
+        '''
+        Grow the vertex or index buffers to a new capacity, keeping their content.
+        '''
+        used = allocator.capacity
+        allocator.grow(capacity)
+        self.grow_count += 1
+
+        if allocator is self.vertices:
+            for name, size in self.attribute_sizes:
+                self.vbos[name] = self._copy_buffer(self.vbos[name], capacity * size * 4,
+                                                    [(0, 0, used * size * 4)])
+        else:
+            self.index_buffer = self._copy_buffer(self.index_buffer, capacity * 4, [(0, 0, used * 4)])
+
+        self._setup_vao()
+
+    def defragment(self):
+        '''
+        Compact all allocations at the start of the buffers, leaving a single free block at the end.
+        '''
+        allocations = sorted(self.allocations, key=lambda a: a.vertex_offset)
+        vertex_moves = []
+        offset = 0
+        for allocation in allocations:
+            vertex_moves.append((allocation.vertex_offset, offset, allocation.vertex_count))
+            allocation.vertex_offset = offset
+            offset += allocation.vertex_count
+        self.vertices.reset(offset)
+
+        allocations = sorted(self.allocations, key=lambda a: a.index_offset)
+        index_moves = []
+        offset = 0
+        for allocation in allocations:
+            index_moves.append((allocation.index_offset, offset, allocation.index_count))
+            allocation.index_offset = offset
+            offset += allocation.index_count
+        self.indices.reset(offset)
+
+        for name, size in self.attribute_sizes:
+            self.vbos[name] = self._copy_buffer(
+                self.vbos[name], self.vertices.capacity * size * 4,
+                [(src * size * 4, dst * size * 4, count * size * 4) for src, dst, count in vertex_moves])
+        self.index_buffer = self._copy_buffer(
+            self.index_buffer, self.indices.capacity * 4,
+            [(src * 4, dst * 4, count * 4) for src, dst, count in index_moves])
+
+        self._setup_vao()
+        self.defragment_count += 1
+
+    def stats(self):
+        '''
+        Return the usage statistics of the arena.
+        '''
+        return {
+            'allocations': len(self.allocations),
+            'vertex_capacity': self.vertices.capacity,
+            'vertex_used': self.vertices.capacity - self.vertices.free_size,
+            'vertex_fragmentation': self.vertices.fragmentation,
+            'index_capacity': self.indices.capacity,
+            'index_used': self.indices.capacity - self.indices.free_size,
+            'index_fragmentation': self.indices.fragmentation,
+            'gl_buffers': len(self.vbos) + 1,
+            'defragmentations': self.defragment_count,
+            'grows': self.grow_count,
+        }
+
+    def report(self):
+        '''
+        Print the usage statistics of the arena.
+        '''
+        stats = self.stats()
+        log.info('Buffer arena: %d allocations in %d GL buffers', stats['allocations'], stats['gl_buffers'])
+        log.info('- vertices: %d/%d used, fragmentation %.0f%%',
+                 stats['vertex_used'], stats['vertex_capacity'], 100. * stats['vertex_fragmentation'])
+        log.info('- indices: %d/%d used, fragmentation %.0f%%',
+                 stats['index_used'], stats['index_capacity'], 100. * stats['index_fragmentation'])
+        log.info('- %d defragmentation(s), %d grow(s)', stats['defragmentations'], stats['grows'])
+
+    def __del__(self):
+        '''
+        Release the arena buffers.
+        '''
+        gl.glDeleteBuffers(len(self.vbos), list(self.vbos.values()))
+        gl.glDeleteBuffers(1, [self.index_buffer])
+        gl.glDeleteVertexArrays(1, [self.vao])
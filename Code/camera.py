@@ -17,9 +17,15 @@ class Camera:
 
     def update(self):
         '''
-        Update the camera view matrix from parameters. Set the point to look at as centre of the coordinate system,
-        then rotate the coordinate system according to phi and psi angles and move the camera to the set distance from
-        the point.
+        Update the camera view matrix from parameters.
+        '''
+        self.V = self.view()
+
+    def view(self):
+        '''
+        The view matrix of the parameters, without updating the camera. Set the point to look at as centre of the
+        coordinate system, then rotate the coordinate system according to phi and psi angles and move the camera to the
+        set distance from the point.
         '''
         # calculate the translation matrix for the view center.
         T0 = translationMatrix(self.center)
@@ -31,4 +37,4 @@ class Camera:
         T = translationMatrix([0., 0., -self.distance])
 
         # calculate the view matrix by combining the three matrices.
-        self.V = np.matmul(np.matmul(T, R), T0)
\ No newline at end of file
+        return np.matmul(np.matmul(T, R), T0)
\ No newline at end of file
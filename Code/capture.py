@@ -0,0 +1,225 @@
+# import requirements
+import ctypes
+import os
+import queue
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pygame
+
+from glbackend import gl
+
+from runtime import get_logger
+
+'''
+Capture of the rendered frames to PNG files or to a video encoder. The frame buffer is read into a ring of pixel
+buffer objects (PBO): glReadPixels into a PBO returns at once, and the pixels are only copied back a few frames later,
+once the GPU has finished the transfer, so the capture does not stall the rendering. The frames are then written by a
+separate thread, and frames are dropped rather than slowing down the scene when the writer cannot keep up.
+'''
+
+log = get_logger(__name__)
+
+
+class FrameCapture:
+    '''
+    Class to capture the frames of a scene.
+    '''
+    def __init__(self, window_size, directory='capture', encoder=None, fps=60, ring=3, queue_size=16):
+        '''
+        :param window_size: the size of the frames in pixels
+        :param directory: the directory of the captures, each written to its own subdirectory of PNG files or video
+        :param encoder: [optional] the encoder command, e.g. 'ffmpeg', which receives the raw RGB frames on its
+        standard input, PNG files are written if None
+        :param fps: the frame rate of the video
+        :param ring: the number of PBOs, i.e. the number of frames between reading a frame and getting its pixels
+        :param queue_size: the number of frames waiting for the writer before dropping frames
+        '''
+        self.width, self.height = window_size
+        self.directory = directory
+        self.path = None
+        self.encoder = encoder
+        self.fps = fps
+        self.ring = ring
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.recording = False
+        self.pbos = None
+        self.fences = [None] * ring
+        self.frame = 0
+        self.writer = None
+        self.process = None
+
+        # counts of the frames written and of the frames dropped by the GPU transfer or the writer.
+        self.captured = 0
+        self.dropped = 0
+
+    @property
+    def frame_size(self):
+        return self.width * self.height * 3
+
+    def start(self):
+        '''
+        Start capturing, creating the PBOs and starting the writer thread.
+        '''
+        if self.recording:
+            return
+
+        # each capture is written to a subdirectory named after its start time, so as not to overwrite the last.
+        name = time.strftime('%Y%m%d_%H%M%S')
+        self.path = os.path.join(self.directory, name)
+        suffix = 1
+        while os.path.exists(self.path):
+            suffix += 1
+            self.path = os.path.join(self.directory, '{}_{}'.format(name, suffix))
+        os.makedirs(self.path)
+
+        if self.pbos is None:
+            self.pbos = [int(pbo) for pbo in np.ravel(gl.glGenBuffers(self.ring))]
+            for pbo in self.pbos:
+                gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, pbo)
+                gl.glBufferData(gl.GL_PIXEL_PACK_BUFFER, self.frame_size, None, gl.GL_STREAM_READ)
+            gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+        if self.encoder is not None:
+            self.process = self._start_encoder()
+
+        self.captured = 0
+        self.dropped = 0
+        self.frame = 0
+        self.recording = True
+        self.writer = threading.Thread(target=self._write, daemon=True)
+        self.writer.start()
+        log.info('--> Capturing frames to %s', self.path)
+
+    def _start_encoder(self):
+        '''
+        Start the encoder process, reading raw RGB frames, bottom row first as OpenGL returns them.
+        '''
+        command = [self.encoder, '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+                   '-s', '{}x{}'.format(self.width, self.height), '-r', str(self.fps), '-i', '-',
+                   '-vf', 'vflip', '-pix_fmt', 'yuv420p', os.path.join(self.path, 'capture.mp4')]
+        try:
+            return subprocess.Popen(command, stdin=subprocess.PIPE)
+        except OSError as error:
+            log.warning('cannot start encoder %s (%s), writing PNG files instead', self.encoder, error)
+            return None
+
+    def stop(self):
+        '''
+        Stop capturing, read back the frames still in the PBOs and wait for the writer to finish.
+        '''
+        if not self.recording:
+            return
+        self.recording = False
+
+        for _ in range(self.ring):
+            self._read(self.frame % self.ring, wait=True)
+            self.frame += 1
+
+        # the writer may have died, and then would never make room in the queue.
+        while self.writer.is_alive():
+            try:
+                self.queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.writer.join()
+        if self.process is not None:
+            try:
+                self.process.stdin.close()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+        self.report()
+
+    def toggle(self):
+        if self.recording:
+            self.stop()
+        else:
+            self.start()
+
+    def capture(self):
+        '''
+        Capture the frame just rendered, to be called before swapping the buffers. The pixels of the frame captured
+        ring frames ago are handed to the writer, and the PBO is reused for this frame.
+        '''
+        if not self.recording:
+            return
+
+        index = self.frame % self.ring
+        self._read(index)
+
+        # start the asynchronous transfer of this frame into the PBO.
+        gl.glPixelStorei(gl.GL_PACK_ALIGNMENT, 1)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pbos[index])
+        gl.glReadPixels(0, 0, self.width, self.height, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+        self.fences[index] = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.frame += 1
+
+    def _read(self, index, wait=False):
+        '''
+        Copy back the pixels of a PBO if its transfer is complete, and queue them for the writer.
+        :param wait: whether to wait for the transfer, otherwise the frame is dropped if it is not complete
+        '''
+        fence = self.fences[index]
+        if fence is None:
+            return
+        self.fences[index] = None
+
+        status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 1000000000 if wait else 0)
+        gl.glDeleteSync(fence)
+        if status == gl.GL_TIMEOUT_EXPIRED or status == gl.GL_WAIT_FAILED:
+            self.dropped += 1
+            return
+
+        pixels = np.empty(self.frame_size, dtype=np.uint8)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, self.pbos[index])
+        gl.glGetBufferSubData(gl.GL_PIXEL_PACK_BUFFER, 0, self.frame_size, pixels)
+        gl.glBindBuffer(gl.GL_PIXEL_PACK_BUFFER, 0)
+
+        try:
+            self.queue.put_nowait(pixels)
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        '''
+        Writer thread, encoding the queued frames until stopped. Frames which cannot be written, e.g. when the encoder
+        has exited or the disk is full, are dropped, and the queue is still emptied so that the capture can be stopped.
+        '''
+        number = 0
+        failed = False
+        while True:
+            pixels = self.queue.get()
+            if pixels is None:
+                break
+
+            try:
+                if self.process is not None:
+                    self.process.stdin.write(pixels.tobytes())
+                else:
+                    surface = pygame.image.frombuffer(pixels.tobytes(), (self.width, self.height), 'RGB')
+                    pygame.image.save(pygame.transform.flip(surface, False, True),
+                                      os.path.join(self.path, 'frame_{:06d}.png'.format(number)))
+            except (OSError, pygame.error) as error:
+                if not failed:
+                    log.warning('cannot write the captured frames (%s), dropping them', error)
+                    failed = True
+                self.dropped += 1
+                continue
+            number += 1
+            self.captured += 1
+
+    def report(self):
+        log.info('--> Captured %d frames, dropped %d frames', self.captured, self.dropped)
+
+    def delete(self):
+        self.stop()
+        if self.pbos is not None:
+            gl.glDeleteBuffers(len(self.pbos), np.array(self.pbos, dtype=np.uint32))
+            self.pbos = None
@@ -0,0 +1,354 @@
+# import requirements
+import time
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+Collision detection between models. The broadphase keeps a uniform grid spatial hash of the world axis-aligned
+bounding boxes (AABB) of all objects, with the cells of each object computed in one vectorised pass, and emits the
+pairs of objects sharing a cell. A narrowphase then confirms the candidate pairs with AABB or oriented bounding box
+(OBB) overlap tests. Only numpy is needed, so it can run without an OpenGL context.
+'''
+
+log = get_logger(__name__)
+
+# cell coordinates are packed in 21 bits each to form the hash keys.
+_CELL_BITS = 21
+_CELL_OFFSET = 1 << (_CELL_BITS - 1)
+
+
+def mesh_bounds(vertices, faces=None):
+    '''
+    Local AABB of a mesh, only over the vertices used by its faces if given.
+    :return: the min and max corners as two (3,) arrays
+    '''
+    vertices = np.asarray(vertices)
+    if faces is not None:
+        vertices = vertices[np.unique(faces)]
+    return vertices.min(axis=0), vertices.max(axis=0)
+
+
+def world_aabbs(local_min, local_max, matrices):
+    '''
+    World AABBs of N local boxes transformed by their model matrices.
+    :param local_min: (N,3) min corners in the local frames
+    :param local_max: (N,3) max corners in the local frames
+    :param matrices: (N,4,4) model matrices
+    :return: (N,3) min and (N,3) max corners in the world frame
+    '''
+    centre = (local_min + local_max) / 2.
+    extent = (local_max - local_min) / 2.
+    R = matrices[:, :3, :3]
+    world_centre = np.matmul(R, centre[:, :, np.newaxis])[:, :, 0] + matrices[:, :3, 3]
+    world_extent = np.matmul(np.abs(R), extent[:, :, np.newaxis])[:, :, 0]
+    return world_centre - world_extent, world_centre + world_extent
+
+
+def world_obbs(local_min, local_max, matrices):
+    '''
+    World OBBs of N local boxes transformed by their model matrices.
+    :return: (N,3) centres, (N,3,3) unit axes as columns, and (N,3) half extents along them
+    '''
+    R = matrices[:, :3, :3]
+    scale = np.linalg.norm(R, axis=1)
+    axes = R / np.where(scale > 0., scale, 1.)[:, np.newaxis, :]
+    centre = np.matmul(R, (local_min + local_max)[:, :, np.newaxis] / 2.)[:, :, 0] + matrices[:, :3, 3]
+    return centre, axes, (local_max - local_min) / 2. * scale
+
+
+def aabb_overlap(mins, maxs, pairs):
+    '''
+    Test the AABBs of the pairs of objects for overlap.
+    :param pairs: (K,2) array of object indices
+    :return: (K,) boolean mask of the overlapping pairs
+    '''
+    a = pairs[:, 0]
+    b = pairs[:, 1]
+    return np.all((mins[a] <= maxs[b]) & (mins[b] <= maxs[a]), axis=1)
+
+
+def obb_overlap(centres, axes, extents, pairs, epsilon=1e-6):
+    '''
+    Test the OBBs of the pairs of objects for overlap using the separating axis theorem on the 15 candidate axes.
+    Source: Gottschalk et al., OBBTree: A Hierarchical Structure for Rapid Interference Detection, 1996.
+    :param pairs: (K,2) array of object indices
+    :return: (K,) boolean mask of the overlapping pairs
+    '''
+    A = axes[pairs[:, 0]]
+    B = axes[pairs[:, 1]]
+    a = extents[pairs[:, 0]]
+    b = extents[pairs[:, 1]]
+
+    # rotation of B in the frame of A, and translation between the centres in the frame of A.
+    R = np.matmul(np.swapaxes(A, 1, 2), B)
+    absR = np.abs(R) + epsilon
+    t = np.matmul((centres[pairs[:, 1]] - centres[pairs[:, 0]])[:, np.newaxis, :], A)[:, 0]
+
+    separated = np.zeros(pairs.shape[0], dtype=bool)
+
+    # axes of A and of B.
+    separated |= np.any(np.abs(t) > a + np.einsum('kij,kj->ki', absR, b), axis=1)
+    separated |= np.any(np.abs(np.einsum('ki,kij->kj', t, R)) > np.einsum('ki,kij->kj', a, absR) + b, axis=1)
+
+    # cross products of one axis of A with one axis of B.
+    for i in range(3):
+        i1, i2 = (i + 1) % 3, (i + 2) % 3
+        for j in range(3):
+            j1, j2 = (j + 1) % 3, (j + 2) % 3
+            ra = a[:, i1] * absR[:, i2, j] + a[:, i2] * absR[:, i1, j]
+            rb = b[:, j1] * absR[:, i, j2] + b[:, j2] * absR[:, i, j1]
+            separated |= np.abs(t[:, i2] * R[:, i1, j] - t[:, i1] * R[:, i2, j]) > ra + rb
+
+    return ~separated
+
+
+def _pairs_in_runs(keys, objects):
+    '''
+    All pairs of objects sharing a key, given entries sorted by key.
+    :return: (K,2) array of object indices, with the smallest index first and without duplicates
+    '''
+    if keys.shape[0] < 2:
+        return np.empty((0, 2), dtype=np.int64)
+
+    # end of the run of each entry, and number of entries after it in its run.
+    boundaries = np.flatnonzero(np.diff(keys)) + 1
+    run_end = np.repeat(np.append(boundaries, keys.shape[0]),
+                        np.diff(np.concatenate([[0], boundaries, [keys.shape[0]]])))
+    following = run_end - np.arange(keys.shape[0]) - 1
+
+    # pair each entry with each of the entries following it in its run.
+    total = following.sum()
+    if total == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    first = np.repeat(np.arange(keys.shape[0]), following)
+    step = np.arange(total) - np.repeat(np.cumsum(following) - following, following)
+    second = first + 1 + step
+
+    return _unique_pairs(objects[first], objects[second])
+
+
+def _unique_pairs(a, b):
+    '''
+    Sorted unique pairs of distinct objects, with the smallest index first.
+    :return: (K,2) array of object indices
+    '''
+    low = np.minimum(a, b)
+    high = np.maximum(a, b)
+    distinct = low != high
+
+    # objects sharing several cells are only reported once, deduplicated on a single integer key per pair.
+    keys = np.unique(low[distinct] << 32 | high[distinct])
+    return np.stack([keys >> 32, keys & 0xffffffff], axis=1)
+
+
+class SpatialHash:
+    '''
+    Class to hold a uniform grid spatial hash of AABBs. Objects covering more than max_cells cells are kept out of
+    the grid and tested against all other objects directly, so that large objects such as the ground do not fill
+    the hash.
+    '''
+    def __init__(self, cell_size=4., max_cells=64):
+        '''
+        :param cell_size: the size of the grid cells, ideally about the size of the typical object
+        :param max_cells: the maximum number of cells an object can be stored in
+        '''
+        self.cell_size = cell_size
+        self.max_cells = max_cells
+
+        self.low = np.empty((0, 3), dtype=np.int64)
+        self.high = np.empty((0, 3), dtype=np.int64)
+        self.keys = np.empty(0, dtype=np.int64)
+        self.objects = np.empty(0, dtype=np.int64)
+        self.oversized = np.empty(0, dtype=np.int64)
+        self.pairs = None
+
+        # statistics of the last update.
+        self.moved = 0
+
+    def _entries(self, indices, low, high):
+        '''
+        The (key, object) entries of the cells covered by the given objects.
+        '''
+        size = high - low + 1
+        counts = np.prod(size, axis=1)
+        total = counts.sum()
+
+        # local index of each entry within the cell box of its object, decomposed into x, y and z steps.
+        owner = np.repeat(np.arange(indices.shape[0]), counts)
+        local = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        sy = size[owner, 1]
+        sz = size[owner, 2]
+        cells = low[owner] + np.stack([local // (sy * sz), (local // sz) % sy, local % sz], axis=1)
+
+        cells = cells + _CELL_OFFSET
+        keys = cells[:, 0] | (cells[:, 1] << _CELL_BITS) | (cells[:, 2] << (2 * _CELL_BITS))
+        return keys, indices[owner]
+
+    def update(self, mins, maxs):
+        '''
+        Update the hash with the current AABBs of all objects. Only the objects which changed cells are re-inserted.
+        :param mins: (N,3) min corners
+        :param maxs: (N,3) max corners
+        '''
+        low = np.floor(mins / self.cell_size).astype(np.int64)
+        high = np.floor(maxs / self.cell_size).astype(np.int64)
+        n = low.shape[0]
+
+        if n != self.low.shape[0]:
+            changed = np.arange(n)
+            self.keys = np.empty(0, dtype=np.int64)
+            self.objects = np.empty(0, dtype=np.int64)
+        else:
+            changed = np.flatnonzero(np.any((low != self.low) | (high != self.high), axis=1))
+
+        self.moved = changed.shape[0]
+        self.low = low
+        self.high = high
+        if changed.shape[0] == 0:
+            return
+
+        oversized = np.prod(high - low + 1, axis=1) > self.max_cells
+        self.oversized = np.flatnonzero(oversized)
+
+        # drop the entries of the changed objects, and add their new ones.
+        keep = ~np.isin(self.objects, changed)
+        inserted = changed[~oversized[changed]]
+        keys, objects = self._entries(inserted, low[inserted], high[inserted])
+        keys = np.concatenate([self.keys[keep], keys])
+        objects = np.concatenate([self.objects[keep], objects])
+
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.objects = objects[order]
+        self.pairs = None
+
+    def candidate_pairs(self, mins=None, maxs=None):
+        '''
+        Pairs of objects sharing at least one cell, plus the pairs involving oversized objects whose AABBs overlap.
+        :param mins: (N,3) min corners, needed if there are oversized objects
+        :param maxs: (N,3) max corners, needed if there are oversized objects
+        :return: (K,2) array of object indices
+        '''
+        if self.pairs is None:
+            self.pairs = _pairs_in_runs(self.keys, self.objects)
+
+        if self.oversized.shape[0] == 0 or mins is None:
+            return self.pairs
+
+        # oversized objects are tested against all others directly.
+        n = mins.shape[0]
+        big = np.repeat(self.oversized, n)
+        other = np.tile(np.arange(n), self.oversized.shape[0])
+        pairs = _unique_pairs(big, other)
+        pairs = pairs[aabb_overlap(mins, maxs, pairs)]
+        return _unique_pairs(np.concatenate([self.pairs[:, 0], pairs[:, 0]]),
+                             np.concatenate([self.pairs[:, 1], pairs[:, 1]]))
+
+
+class CollisionWorld:
+    '''
+    Class to detect collisions between a set of models, each bounded by the box of its mesh in its local frame.
+    '''
+    def __init__(self, cell_size=4., max_cells=64):
+        self.hash = SpatialHash(cell_size, max_cells)
+        self.models = []
+        self.local_min = np.empty((0, 3))
+        self.local_max = np.empty((0, 3))
+
+        # statistics of the last query.
+        self.candidates = 0
+        self.collisions = 0
+
+    def add(self, model, bounds=None):
+        '''
+        Add a model, anything with a mesh and a model matrix M.
+        :param bounds: [optional] local min and max corners, the bounds of the model's mesh if None
+        '''
+        low, high = bounds if bounds is not None else mesh_bounds(model.mesh.vertices, model.mesh.faces)
+        self.models.append(model)
+        self.local_min = np.vstack([self.local_min, low])
+        self.local_max = np.vstack([self.local_max, high])
+
+    def remove(self, model):
+        index = self.models.index(model)
+        del self.models[index]
+        self.local_min = np.delete(self.local_min, index, axis=0)
+        self.local_max = np.delete(self.local_max, index, axis=0)
+
+    def query(self, matrices=None, obb=True):
+        '''
+        Find the colliding pairs of models.
+        :param matrices: [optional] (N,4,4) model matrices, gathered from the models if None
+        :param obb: whether to confirm the pairs with the oriented boxes, otherwise with the world AABBs
+        :return: (K,2) array of indices of colliding models
+        '''
+        if matrices is None:
+            matrices = np.stack([model.M for model in self.models])
+
+        mins, maxs = world_aabbs(self.local_min, self.local_max, matrices)
+        self.hash.update(mins, maxs)
+        pairs = self.hash.candidate_pairs(mins, maxs)
+        pairs = pairs[aabb_overlap(mins, maxs, pairs)]
+
+        if obb and pairs.shape[0] > 0:
+            centres, axes, extents = world_obbs(self.local_min, self.local_max, matrices)
+            pairs = pairs[obb_overlap(centres, axes, extents, pairs)]
+
+        self.candidates = self.hash.pairs.shape[0]
+        self.collisions = pairs.shape[0]
+        return pairs
+
+    def colliding_models(self, matrices=None, obb=True):
+        '''
+        Find the colliding pairs of models, as a list of tuples of models.
+        '''
+        return [(self.models[a], self.models[b]) for a, b in self.query(matrices, obb)]
+
+
+def benchmark(count=10000, frames=50, world=1000., cell_size=4.):
+    '''
+    Time the update of the spatial hash and the queries for moving objects.
+    '''
+    from matutils import poseMatrices
+
+    rng = np.random.default_rng(0)
+    world_size = world * np.array([1., 0.05, 1.])
+    positions = rng.uniform(0., 1., (count, 3)) * world_size
+    velocities = rng.standard_normal((count, 3)) * [1., 0., 1.]
+    local_min = np.tile([-1., 0., -2.5], (count, 1))
+    local_max = np.tile([1., 1.8, 2.5], (count, 1))
+
+    collisions = CollisionWorld(cell_size)
+    collisions.local_min = local_min
+    collisions.local_max = local_max
+    matrices = np.empty((count, 4, 4), dtype='f')
+
+    timings = {'transform': 0., 'broadphase': 0., 'narrowphase': 0.}
+    for frame in range(frames):
+        start = time.perf_counter()
+        positions = np.mod(positions + velocities / 60., world_size)
+        poseMatrices(positions, np.arctan2(velocities[:, 0], velocities[:, 2]), out=matrices)
+        mins, maxs = world_aabbs(local_min, local_max, matrices)
+        t1 = time.perf_counter()
+        collisions.hash.update(mins, maxs)
+        pairs = collisions.hash.candidate_pairs(mins, maxs)
+        t2 = time.perf_counter()
+        pairs = pairs[aabb_overlap(mins, maxs, pairs)]
+        centres, axes, extents = world_obbs(local_min, local_max, matrices)
+        pairs = pairs[obb_overlap(centres, axes, extents, pairs)]
+        t3 = time.perf_counter()
+
+        timings['transform'] += t1 - start
+        timings['broadphase'] += t2 - t1
+        timings['narrowphase'] += t3 - t2
+
+    log.info('%d moving objects, %d moved cells in the last frame, %d candidate pairs, %d collisions',
+             count, collisions.hash.moved, collisions.hash.pairs.shape[0], pairs.shape[0])
+    for name, total in timings.items():
+        log.info('- %-12s %7.3f ms per frame', name, 1000. * total / frames)
+
+
+if __name__ == '__main__':
+    benchmark()
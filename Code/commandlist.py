@@ -0,0 +1,339 @@
+# import requirements
+import ctypes
+import time
+
+import numpy as np
+
+from glbackend import gl
+
+from shaders import PhongShader
+
+# CPU profiler of the frame stages
+from profiler import profiler
+
+# leveled logging of the runtime profile
+from runtime import get_logger
+
+'''
+Command lists of the draws of a frame. Drawing a model through BaseModel.draw() and PhongShader.bind() decides again
+every frame which Vertex Array Object, program, textures, uniforms and draw call to use, although they rarely change.
+A CommandList records them once for a draw list, as rows of integers (operation, arguments) in a compact array, with
+the model matrices in a separate array of uniform slots, and leaves out the state changes which are redundant, such
+as binding the VAO of the arena again for the next model. Each frame the list is replayed in a tight loop, after
+patching the matrix slots of the models which moved. The list is recorded again when the draw list changes: models
+added, removed, hidden or culled, a model given another shader program or material, or an arena defragmented.
+Other changes, such as the textures of a mesh, need a call to invalidate().
+'''
+
+log = get_logger(__name__)
+
+# the operations of the commands, with their arguments.
+BIND_VAO = 0  # vao
+USE_PROGRAM = 1  # program, index of the shader in the objects
+SET_MATRIX = 2  # location, slot
+SET_INT = 3  # location, value
+BIND_TEXTURE = 4  # unit, texture, target
+DRAW_BASE_VERTEX = 5  # primitive, count, index of the offset pointer in the objects, base vertex
+DRAW_ELEMENTS = 6  # primitive, count
+DRAW_ARRAYS = 7  # primitive, first, count
+DRAW_MODEL = 8  # index of the model in the draw list, for models which cannot be recorded
+
+# number of integers of a command.
+COMMAND_WIDTH = 5
+
+
+class CommandList:
+    '''
+    Class to record and replay the GL commands drawing a list of models.
+    '''
+    def __init__(self):
+        # the commands, as an (N,5) array and as a list of rows to replay.
+        self.commands = np.zeros((0, COMMAND_WIDTH), dtype=np.int64)
+        self.rows = []
+
+        # the objects referred to by the commands: shaders and draw offsets.
+        self.objects = []
+
+        # the model matrices uploaded by the commands, and the slot used by each draw, -1 if not recorded.
+        self.matrices = np.zeros((0, 4, 4), dtype=np.float32)
+        self.slots = []
+        self.draw_slots = np.zeros(0, dtype=np.int64)
+
+        # what the list was recorded for, compared each frame to know whether to record it again.
+        self.key = None
+        self.arenas = []
+
+        # counters for the statistics.
+        self.records = 0
+        self.replays = 0
+        self.patches = 0
+        self.naive_calls = 0
+        self.record_time = 0.
+        self.replay_time = 0.
+
+    def invalidate(self):
+        '''
+        Record the list again at the next replay.
+        '''
+        self.key = None
+
+    def _key(self, models):
+        '''
+        What the commands of a draw list depend on, other than the model matrices.
+        '''
+        return [(model, model.shader.program, model.mesh.material, model.visible) for model, _ in models]
+
+    def _valid(self, key):
+        if key != self.key:
+            return False
+        return all(arena.defragment_count == count for arena, count in self.arenas)
+
+    def record(self, models, scene):
+        '''
+        Record the commands drawing a list of models, as model.draw() would. The GL state is not known at the start
+        of the list, and is tracked from there to leave out the commands which would not change it.
+        :param models: the list of (model, parent matrix) pairs to draw
+        :param scene: the scene the models belong to, with their material table
+        '''
+        start = time.perf_counter()
+        commands = []
+        objects = []
+        self.slots = []
+        draw_slots = []
+        arenas = {}
+        naive_calls = 0
+
+        # the state set by the commands so far, and the matrix slot and material set in each program.
+        vao = None
+        program = None
+        textures = {}
+        programs = {}
+
+        for index, (model, Mp) in enumerate(models):
+            draw_slots.append(-1)
+            if not model.visible:
+                continue
+
+            # models with other programs are drawn as they are, and may change any state.
+            if not isinstance(model.shader, PhongShader):
+                commands.append((DRAW_MODEL, index, 0, 0, 0))
+                vao = program = None
+                textures = {}
+                programs.pop(model.shader.program, None)
+                continue
+
+            shader = model.shader
+            if model.vao != vao:
+                vao = model.vao
+                commands.append((BIND_VAO, vao, 0, 0, 0))
+
+            if shader.program != program:
+                program = shader.program
+                commands.append((USE_PROGRAM, program, len(objects), 0, 0))
+                objects.append(shader)
+            uniforms = programs.setdefault(program, {})
+
+            # draws of the same program with the same model matrix share a slot.
+            M = np.matmul(np.asarray(Mp, dtype=np.float32), np.asarray(model.M, dtype=np.float32))
+            slot = uniforms.get('M')
+            if slot is None or not np.array_equal(self.slots[slot], M):
+                slot = len(self.slots)
+                self.slots.append(M)
+                uniforms['M'] = slot
+                commands.append((SET_MATRIX, shader.uniforms['M'].location, slot, 0, 0))
+            draw_slots[-1] = slot
+
+            material = scene.materials.index(model.mesh.material, int(len(model.mesh.textures) > 0))
+            if uniforms.get('material') != material:
+                uniforms['material'] = material
+                commands.append((SET_INT, shader.uniforms['material'].location, material, 0, 0))
+
+            for unit, texture in enumerate(model.mesh.textures):
+                if textures.get(unit) != texture.textureid:
+                    textures[unit] = texture.textureid
+                    commands.append((BIND_TEXTURE, unit, texture.textureid, texture.target, 0))
+
+            if model.allocation is not None:
+                arenas[id(model.arena)] = (model.arena, model.arena.defragment_count)
+                allocation = model.allocation
+                if allocation.index_count > 0:
+                    commands.append((DRAW_BASE_VERTEX, model.primitive, allocation.index_count, len(objects),
+                                     allocation.vertex_offset))
+                    objects.append(ctypes.c_void_p(allocation.index_offset * 4))
+                else:
+                    commands.append((DRAW_ARRAYS, model.primitive, allocation.vertex_offset, allocation.vertex_count, 0))
+            elif model.mesh.faces is not None:
+                commands.append((DRAW_ELEMENTS, model.primitive, model.mesh.faces.size, 0, 0))
+            else:
+                commands.append((DRAW_ARRAYS, model.primitive, 0, model.mesh.vertices.shape[0], 0))
+
+            # model.draw() binds the VAO and program, sets two uniforms, binds the textures, draws and unbinds.
+            naive_calls += 6 + 2 * len(model.mesh.textures)
+
+        self.commands = np.array(commands, dtype=np.int64).reshape(-1, COMMAND_WIDTH)
+        self.rows = self.commands.tolist()
+        self.objects = objects
+        self.matrices = np.array(self.slots, dtype=np.float32).reshape(-1, 4, 4)
+        self.slots = list(self.matrices)
+        self.draw_slots = np.array(draw_slots, dtype=np.int64)
+        self.key = self._key(models)
+        self.arenas = list(arenas.values())
+        self.naive_calls = naive_calls
+
+        self.records += 1
+        self.record_time += time.perf_counter() - start
+
+    def patch(self, models):
+        '''
+        Update the matrix slots of the draws whose model or parent matrix changed.
+        :return: whether the slots could be patched, otherwise the list must be recorded again
+        '''
+        recorded = np.flatnonzero(self.draw_slots >= 0)
+        if recorded.shape[0] == 0:
+            return True
+
+        Mp = np.array([models[i][1] for i in recorded], dtype=np.float32)
+        M = np.array([models[i][0].M for i in recorded], dtype=np.float32)
+        current = np.matmul(Mp, M)
+        slots = self.draw_slots[recorded]
+        changed = np.any((current != self.matrices[slots]).reshape(-1, 16), axis=1)
+        if not changed.any():
+            return True
+
+        self.matrices[slots[changed]] = current[changed]
+        self.patches += int(np.count_nonzero(changed))
+
+        # draws sharing a slot must all have moved the same way.
+        return np.array_equal(self.matrices[slots], current)
+
+    def replay(self, models, scene):
+        '''
+        Draw a list of models, recording the commands first if the list changed since they were recorded.
+        :param models: the list of (model, parent matrix) pairs to draw
+        :param scene: the scene the models belong to
+        '''
+        if not self._valid(self._key(models)) or not self.patch(models):
+            self.record(models, scene)
+
+        start = time.perf_counter()
+        self.execute(models, scene)
+        self.replay_time += time.perf_counter() - start
+        self.replays += 1
+        profiler.count('commands', len(self.rows))
+
+    def execute(self, models, scene):
+        '''
+        Run the recorded commands.
+        '''
+        # look up the GL functions once for the whole list.
+        glBindVertexArray = gl.glBindVertexArray
+        glUseProgram = gl.glUseProgram
+        glUniformMatrix4fv = gl.glUniformMatrix4fv
+        glUniform1i = gl.glUniform1i
+        glActiveTexture = gl.glActiveTexture
+        glBindTexture = gl.glBindTexture
+        glDrawElementsBaseVertex = gl.glDrawElementsBaseVertex
+        glDrawElements = gl.glDrawElements
+        glDrawArrays = gl.glDrawArrays
+        GL_TEXTURE0 = gl.GL_TEXTURE0
+        GL_UNSIGNED_INT = gl.GL_UNSIGNED_INT
+
+        slots = self.slots
+        objects = self.objects
+
+        # the most frequent commands are tested first.
+        for op, a, b, c, d in self.rows:
+            if op == SET_MATRIX:
+                glUniformMatrix4fv(a, 1, True, slots[b])
+            elif op == DRAW_BASE_VERTEX:
+                glDrawElementsBaseVertex(a, b, GL_UNSIGNED_INT, objects[c], d)
+            elif op == SET_INT:
+                glUniform1i(a, b)
+            elif op == USE_PROGRAM:
+                glUseProgram(a)
+                objects[b].bind_frame(scene)
+            elif op == BIND_TEXTURE:
+                glActiveTexture(GL_TEXTURE0 + a)
+                glBindTexture(c, b)
+            elif op == BIND_VAO:
+                glBindVertexArray(a)
+            elif op == DRAW_ELEMENTS:
+                glDrawElements(a, b, GL_UNSIGNED_INT, None)
+            elif op == DRAW_ARRAYS:
+                glDrawArrays(a, b, c)
+            elif op == DRAW_MODEL:
+                model, Mp = models[a]
+                model.draw(Mp=Mp)
+
+        # unbind the VAO to avoid side effects, as model.draw() does.
+        glBindVertexArray(0)
+
+    def stats(self):
+        '''
+        Return the statistics of the command list.
+        '''
+        return {
+            'commands': len(self.rows),
+            'naive_calls': self.naive_calls,
+            'matrix_slots': len(self.slots),
+            'records': self.records,
+            'replays': self.replays,
+            'patches': self.patches,
+            'record_ms': 1000. * self.record_time / max(self.records, 1),
+            'replay_ms': 1000. * self.replay_time / max(self.replays, 1),
+        }
+
+    def report(self):
+        '''
+        Print the statistics of the command list.
+        '''
+        stats = self.stats()
+        log.info('Command list: %d commands for %d calls of the model draws, %d matrix slots',
+                 stats['commands'], stats['naive_calls'], stats['matrix_slots'])
+        log.info('- %d replays, %d records (%.3f ms each), %d matrices patched',
+                 stats['replays'], stats['records'], stats['record_ms'], stats['patches'])
+        log.info('- %.3f ms per replay', stats['replay_ms'])
+
+
+def benchmark(frames=300):
+    '''
+    Draw the models of the project scene with the no-op recording backend, by calling model.draw() for each and by
+    replaying a command list, and report the Python time per frame of each and the GL calls.
+    '''
+    # imported by name, as this module is a different instance from the one used by the scene when run as a script.
+    import glbackend
+    from project import ProjectScene
+
+    scene = ProjectScene(headless=True)
+    scene.toggle_traffic()
+    scene.drive_car()
+    recorder = glbackend.backend()
+
+    results = {}
+    for label, enabled in (('model draws', False), ('command list', True)):
+        scene.commands_enabled = enabled
+        scene.commands = CommandList()
+        recorder.reset()
+        elapsed = 0.
+        for _ in range(frames):
+            scene.update(scene.timestep)
+            scene.time += scene.timestep
+            scene.camera.update()
+            scene.update_uniform_blocks()
+            models = scene.draw_list()
+
+            start = time.perf_counter()
+            scene.draw_models(models)
+            elapsed += time.perf_counter() - start
+            recorder.end_frame()
+
+        results[label] = elapsed / frames
+        calls = sum(recorder.frame_counts().values())
+        log.info('--> %s: %.3f ms per frame, %d GL calls', label, 1000. * results[label], calls)
+
+    scene.commands.report()
+    log.info('--> %.1fx faster', results['model draws'] / results['command list'])
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,284 @@
+# import requirements
+import time
+
+import numpy as np
+
+# the runtime profile sets the PyOpenGL flags, which must be done before importing OpenGL.GL.
+import runtime
+
+import OpenGL.GL
+from OpenGL.GL import shaders
+
+'''
+Pluggable OpenGL backend. The rendering modules call OpenGL through the gl object of this module, e.g.
+gl.glClear(gl.GL_COLOR_BUFFER_BIT), rather than importing PyOpenGL directly. By default gl forwards to PyOpenGL, and
+use() can switch it to another backend, such as a RecordingBackend which counts and times the calls of each frame,
+either forwarding them to PyOpenGL or, without any window or GPU, doing nothing.
+'''
+
+log = runtime.get_logger(__name__)
+
+
+class OpenGLBackend:
+    '''
+    Backend forwarding to PyOpenGL.
+    '''
+    def __getattr__(self, name):
+        if name == 'compileShader':
+            return shaders.compileShader
+        return getattr(OpenGL.GL, name)
+
+
+# categories of calls, used for budgets. Calls are put in the first category whose prefix they match.
+CATEGORIES = [
+    ('uniform', ('glUniform',)),
+    ('draw', ('glDraw', 'glMultiDraw')),
+    ('buffer', ('glBindBuffer', 'glBufferData', 'glBufferSubData', 'glGenBuffers', 'glDeleteBuffers',
+                'glCopyBufferSubData', 'glMapBuffer', 'glUnmapBuffer', 'glBindBufferBase')),
+    ('vertex array', ('glBindVertexArray', 'glGenVertexArrays', 'glDeleteVertexArrays', 'glVertexAttrib',
+                      'glEnableVertexAttribArray', 'glDisableVertexAttribArray')),
+    ('texture', ('glBindTexture', 'glActiveTexture', 'glTexImage', 'glTexSubImage', 'glTexParameter',
+                 'glGenTextures', 'glDeleteTextures', 'glGenerateMipmap')),
+    ('program', ('glUseProgram', 'glCreateProgram', 'glAttachShader', 'glLinkProgram', 'glBindAttribLocation',
+                 'glGetUniformLocation', 'compileShader')),
+    ('query', ('glGenQueries', 'glBeginQuery', 'glEndQuery', 'glQueryCounter', 'glGetQueryObject')),
+]
+
+
+def category(name):
+    '''
+    Returns the category of a GL call, 'state' for calls not in any other category.
+    '''
+    for label, prefixes in CATEGORIES:
+        if name.startswith(prefixes):
+            return label
+    return 'state'
+
+
+class RecordingBackend:
+    '''
+    Backend counting and timing the calls of each frame. Constants are taken from PyOpenGL. Calls are forwarded to
+    another backend if one is given, otherwise they do nothing and return placeholder values, so that a scene can be
+    built and drawn without an OpenGL context.
+    '''
+    def __init__(self, target=None, frames=1000):
+        '''
+        :param target: [optional] the backend to forward the calls to, e.g. an OpenGLBackend
+        :param frames: the maximum number of frames kept
+        '''
+        self.target = target
+        self.frames = frames
+        self.functions = {}
+
+        # counts and total times of each call, over the current frame and the past frames.
+        self.counts = {}
+        self.times = {}
+        self.history = []
+
+        # object names returned by the no-op generators.
+        self.next_name = 1
+
+    def __getattr__(self, name):
+        if name.startswith('GL_'):
+            return getattr(OpenGL.GL, name)
+
+        function = self.functions.get(name)
+        if function is None:
+            function = self._record(name)
+            self.functions[name] = function
+        return function
+
+    def _record(self, name):
+        '''
+        Returns a function recording the calls to the GL function of the given name.
+        '''
+        target = getattr(self.target, name) if self.target is not None else self._noop(name)
+
+        # PyOpenGL functions missing from the driver are falsy, and support is checked that way.
+        if not target:
+            return target
+
+        counts = self.counts
+        times = self.times
+
+        def function(*args, **kwargs):
+            start = time.perf_counter()
+            result = target(*args, **kwargs)
+            times[name] = times.get(name, 0.) + time.perf_counter() - start
+            counts[name] = counts.get(name, 0) + 1
+            return result
+
+        return function
+
+    def _names(self, n=1, *args):
+        '''
+        No-op generator of object names, returns a name or an array of n names as PyOpenGL does.
+        '''
+        names = np.arange(self.next_name, self.next_name + n, dtype=np.uint32)
+        self.next_name += n
+        return int(names[0]) if n == 1 else names
+
+    def _noop(self, name):
+        '''
+        The no-op implementation of a GL function, returning a value of the expected type.
+        '''
+        if name.startswith('glGen'):
+            return self._names
+        if name in ('glCreateProgram', 'glCreateShader', 'compileShader'):
+            return lambda *args, **kwargs: self._names()
+        if name in ('glGetUniformLocation', 'glGetAttribLocation', 'glGetIntegerv', 'glGetError'):
+            return lambda *args, **kwargs: 0
+        return lambda *args, **kwargs: None
+
+    def end_frame(self):
+        '''
+        Store the counts and times of the current frame, and start a new frame.
+        '''
+        self.history.append((dict(self.counts), dict(self.times)))
+        if len(self.history) > self.frames:
+            del self.history[0]
+        self.counts.clear()
+        self.times.clear()
+
+    def reset(self):
+        self.history = []
+        self.counts.clear()
+        self.times.clear()
+
+    def frame_counts(self, frame=-1, by_category=False):
+        '''
+        The number of calls of each GL function, or of each category, in a stored frame.
+        '''
+        counts = self.history[frame][0]
+        if not by_category:
+            return dict(counts)
+        categories = {}
+        for name, count in counts.items():
+            categories[category(name)] = categories.get(category(name), 0) + count
+        return categories
+
+    def summary(self):
+        '''
+        Mean number of calls and time per frame of each GL function over the stored frames, sorted by time.
+        :return: a list of (name, calls, milliseconds) tuples
+        '''
+        frames = max(len(self.history), 1)
+        calls = {}
+        total = {}
+        for counts, times in self.history:
+            for name, count in counts.items():
+                calls[name] = calls.get(name, 0) + count
+                total[name] = total.get(name, 0.) + times[name]
+        return sorted([(name, calls[name] / frames, 1000. * total[name] / frames) for name in calls],
+                      key=lambda entry: -entry[2])
+
+    def check_budgets(self, budgets, frame=-1):
+        '''
+        Compare the calls of a stored frame to budgets.
+        :param budgets: dictionary of the maximum number of calls of a GL function or a category per frame
+        :return: a list of messages describing the budgets exceeded, empty if all are respected
+        '''
+        counts = self.frame_counts(frame)
+        counts.update(self.frame_counts(frame, by_category=True))
+        return ['{} calls to {} exceed the budget of {}'.format(counts[name], name, budget)
+                for name, budget in budgets.items() if counts.get(name, 0) > budget]
+
+    def assert_budgets(self, budgets, frame=-1):
+        '''
+        Raise an AssertionError if a stored frame exceeds any of the budgets.
+        '''
+        exceeded = self.check_budgets(budgets, frame)
+        if exceeded:
+            raise AssertionError('; '.join(exceeded))
+
+    def report(self, top=10):
+        '''
+        Print the calls taking the most time per frame, and the calls per category of the last frame.
+        '''
+        log.info('--> GL calls per frame over %d frames', len(self.history))
+        for name, calls, elapsed in self.summary()[:top]:
+            log.info('- %-28s %8.1f calls %8.3f ms', name, calls, elapsed)
+        if self.history:
+            log.info('- by category: %s', ', '.join(
+                '{} {}'.format(name, count) for name, count in sorted(self.frame_counts(by_category=True).items())))
+
+
+class _GL:
+    '''
+    Proxy to the current backend. Attributes are looked up in the backend on first use and cached, so that calls
+    through the proxy cost a plain attribute access.
+    '''
+    def __init__(self, backend):
+        object.__setattr__(self, 'backend', backend)
+
+    def __getattr__(self, name):
+        value = getattr(self.backend, name)
+        object.__setattr__(self, name, value)
+        return value
+
+
+gl = _GL(OpenGLBackend())
+
+
+def use(backend):
+    '''
+    Switch all GL calls made through gl to a backend.
+    :return: the previous backend
+    '''
+    previous = gl.backend
+    gl.__dict__.clear()
+    object.__setattr__(gl, 'backend', backend)
+    return previous
+
+
+def backend():
+    return gl.backend
+
+
+def check_errors(where='frame'):
+    '''
+    Log the errors raised by the GL calls since the last check, in the debug profile only. PyOpenGL does not check
+    each call, so this is called at frame boundaries.
+    :return: the number of errors
+    '''
+    if not runtime.DEBUG:
+        return 0
+
+    errors = 0
+    error = gl.glGetError()
+    while error and error != gl.GL_NO_ERROR:
+        errors += 1
+        log.error('GL error 0x%04x at the end of the %s', error, where)
+        # without a current context glGetError() keeps returning an error.
+        if errors == 32:
+            break
+        error = gl.glGetError()
+    return errors
+
+
+def benchmark(frames=100):
+    '''
+    Draw frames of the project scene with the no-op recording backend, without any window or GPU, and report the
+    time per frame and the GL calls.
+    '''
+    # imported by name, as this module is a different instance from the one used by the scene when run as a script.
+    import glbackend
+    from project import ProjectScene
+
+    scene = ProjectScene(headless=True)
+    scene.toggle_traffic()
+    recorder = glbackend.backend()
+    recorder.reset()
+
+    start = time.perf_counter()
+    for _ in range(frames):
+        scene.update(scene.timestep)
+        scene.draw()
+    elapsed = (time.perf_counter() - start) / frames
+
+    log.info('--> %.3f ms per frame without GPU', 1000. * elapsed)
+    recorder.report()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,460 @@
+# import requirements
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from material import Material
+from mesh import Mesh, calculate_normals
+from matutils import *
+
+from runtime import get_logger
+
+'''
+Functions for reading and writing binary glTF 2.0 (.glb) files.
+Source:
+https://registry.khronos.org/glTF/specs/2.0/glTF-2.0.html
+
+The file is memory mapped and the accessors are exposed as numpy views on the binary chunk, so loading a model does
+not copy or parse its vertex data. Only the texture coordinates are copied, since glTF puts the origin of the UV
+space at the top of the image while the rest of the code uses the Blender convention.
+'''
+
+log = get_logger(__name__)
+
+GLB_MAGIC = 0x46546C67  # 'glTF'
+CHUNK_JSON = 0x4E4F534A  # 'JSON'
+CHUNK_BIN = 0x004E4942  # 'BIN\0'
+
+# accessor component types and element sizes, as defined by the specification.
+COMPONENT_TYPES = {5120: np.int8, 5121: np.uint8, 5122: np.int16, 5123: np.uint16, 5125: np.uint32, 5126: np.float32}
+TYPE_SIZES = {'SCALAR': 1, 'VEC2': 2, 'VEC3': 3, 'VEC4': 4, 'MAT2': 4, 'MAT3': 9, 'MAT4': 16}
+
+# primitive mode for triangle lists.
+MODE_TRIANGLES = 4
+
+
+class GlbFile:
+    '''
+    Class to access the content of a .glb file through a memory map.
+    '''
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.data = np.memmap(file_name, dtype=np.uint8, mode='r')
+
+        magic, version, length = struct.unpack_from('<III', self.data, 0)
+        if magic != GLB_MAGIC or version != 2:
+            raise ValueError('(E) {} is not a glTF 2.0 binary file'.format(file_name))
+
+        # the JSON chunk always comes first, the binary chunk is optional.
+        json_length, json_type = struct.unpack_from('<II', self.data, 12)
+        if json_type != CHUNK_JSON:
+            raise ValueError('(E) First chunk of {} is not JSON'.format(file_name))
+        self.json = json.loads(bytes(self.data[20:20 + json_length]).decode('utf-8'))
+
+        self.bin_offset = None
+        offset = 20 + json_length
+        if offset < length:
+            bin_length, bin_type = struct.unpack_from('<II', self.data, offset)
+            if bin_type == CHUNK_BIN:
+                self.bin_offset = offset + 8
+
+    def accessor(self, index):
+        '''
+        Return the data of an accessor as a read-only numpy view on the file, without copying.
+        :param index: the index of the accessor
+        :return: a (count,) array for scalars, (count, n) otherwise
+        '''
+        accessor = self.json['accessors'][index]
+        view = self.json['bufferViews'][accessor['bufferView']]
+        if view.get('buffer', 0) != 0 or self.bin_offset is None:
+            raise ValueError('(E) Only accessors to the binary chunk are supported')
+
+        dtype = np.dtype(COMPONENT_TYPES[accessor['componentType']])
+        width = TYPE_SIZES[accessor['type']]
+        count = accessor['count']
+        offset = self.bin_offset + view.get('byteOffset', 0) + accessor.get('byteOffset', 0)
+        stride = view.get('byteStride', width * dtype.itemsize)
+
+        # interleaved data is handled as a strided view.
+        array = np.ndarray((count, width), dtype=dtype, buffer=self.data, offset=offset,
+                           strides=(stride, dtype.itemsize))
+        if width == 1:
+            return array[:, 0]
+        return array
+
+    def image_uri(self, texture_index):
+        '''
+        Return the uri of the image used by a texture, or None if the image is embedded.
+        '''
+        texture = self.json['textures'][texture_index]
+        image = self.json['images'][texture['source']]
+        return image.get('uri')
+
+
+class Node:
+    '''
+    Class to hold a node of the glTF scene hierarchy.
+    '''
+    def __init__(self, name=None, M=None, meshes=None, children=None):
+        '''
+        :param name: the name of the node
+        :param M: 4x4 transformation matrix relative to the parent node
+        :param meshes: list of Mesh objects attached to this node, one per glTF primitive
+        :param children: list of child nodes
+        '''
+        self.name = name
+        self.M = M if M is not None else np.identity(4, dtype='f')
+        self.meshes = meshes if meshes is not None else []
+        self.children = children if children is not None else []
+
+    def flatten(self, Mp=None):
+        '''
+        Generator of (world matrix, mesh) pairs for this node and all its descendants.
+        :param Mp: the world matrix of the parent node
+        '''
+        M = self.M if Mp is None else np.matmul(Mp, self.M)
+        for mesh in self.meshes:
+            yield M, mesh
+        for child in self.children:
+            yield from child.flatten(M)
+
+
+def quaternion_matrix(q):
+    '''
+    Rotation matrix of a unit quaternion given as [x, y, z, w].
+    '''
+    x, y, z, w = q
+    return np.array([
+        [1 - 2*(y*y + z*z), 2*(x*y - z*w), 2*(x*z + y*w), 0],
+        [2*(x*y + z*w), 1 - 2*(x*x + z*z), 2*(y*z - x*w), 0],
+        [2*(x*z - y*w), 2*(y*z + x*w), 1 - 2*(x*x + y*y), 0],
+        [0, 0, 0, 1]
+    ], dtype='f')
+
+
+def _node_matrix(node):
+    '''
+    Local matrix of a glTF node, given either as a matrix or as translation, rotation and scale.
+    '''
+    if 'matrix' in node:
+        # glTF matrices are stored column-major.
+        return np.array(node['matrix'], dtype='f').reshape(4, 4).T
+
+    T = translationMatrix(node.get('translation', [0., 0., 0.]))
+    R = quaternion_matrix(node.get('rotation', [0., 0., 0., 1.]))
+    S = np.diag(list(node.get('scale', [1., 1., 1.])) + [1.]).astype('f')
+    return np.matmul(np.matmul(T, R), S)
+
+
+def _load_material(glb, index):
+    '''
+    Map a glTF material to the Material class. The Phong parameters written by export_glb() are used if present,
+    otherwise they are approximated from the PBR metallic-roughness model.
+    '''
+    if index is None:
+        return Material()
+
+    gltf_material = glb.json['materials'][index]
+    pbr = gltf_material.get('pbrMetallicRoughness', {})
+    base_color = np.array(pbr.get('baseColorFactor', [1., 1., 1., 1.])[:3], 'f')
+    roughness = pbr.get('roughnessFactor', 1.)
+    metallic = pbr.get('metallicFactor', 1.)
+
+    material = Material(gltf_material.get('name'))
+    material.Kd = base_color
+    material.Ka = base_color
+    material.Ks = np.array(0.04 * (1. - metallic) + base_color * metallic, 'f')
+    material.Ns = 2. / max(roughness, 0.01) ** 4 - 2.
+
+    phong = gltf_material.get('extras', {})
+    for name in ('Ka', 'Kd', 'Ks'):
+        if name in phong:
+            setattr(material, name, np.array(phong[name], 'f'))
+    if 'Ns' in phong:
+        material.Ns = float(phong['Ns'])
+
+    if 'baseColorTexture' in pbr:
+        uri = glb.image_uri(pbr['baseColorTexture']['index'])
+        if uri is None:
+            log.warning('Embedded images are not supported, material %s has no texture', material.name)
+        else:
+            # textures are loaded by name from the textures folder.
+            material.texture = os.path.basename(uri)
+
+    return material
+
+
+def load_glb(file_name):
+    '''
+    Load a binary glTF file.
+    :param file_name: the path to the .glb file
+    :return: the list of root nodes of the default scene
+    '''
+    log.info('Loading mesh(es) from glTF file: %s', file_name)
+    glb = GlbFile(file_name)
+    gltf = glb.json
+
+    materials = {}
+    meshes = []
+    for gltf_mesh in gltf.get('meshes', []):
+        primitives = []
+        for primitive in gltf_mesh['primitives']:
+            if primitive.get('mode', MODE_TRIANGLES) != MODE_TRIANGLES:
+                log.warning('Skipping primitive of mesh %s, only triangles are supported', gltf_mesh.get('name'))
+                continue
+
+            attributes = primitive['attributes']
+            vertices = glb.accessor(attributes['POSITION'])
+
+            if 'indices' in primitive:
+                faces = glb.accessor(primitive['indices']).reshape(-1, 3)
+                if faces.dtype != np.uint32:
+                    faces = faces.astype(np.uint32)
+            else:
+                faces = np.arange(vertices.shape[0], dtype=np.uint32).reshape(-1, 3)
+
+            normals = glb.accessor(attributes['NORMAL']) if 'NORMAL' in attributes else None
+
+            textureCoords = None
+            if 'TEXCOORD_0' in attributes:
+                textureCoords = np.array(glb.accessor(attributes['TEXCOORD_0']), dtype='f')
+                textureCoords[:, 1] = 1. - textureCoords[:, 1]
+
+            tangents = None
+            binormals = None
+            if normals is not None and 'TANGENT' in attributes:
+                tangent = glb.accessor(attributes['TANGENT'])
+                tangents = tangent[:, :3]
+                binormals = np.cross(normals, tangents) * tangent[:, 3:4]
+
+            material_index = primitive.get('material')
+            if material_index not in materials:
+                materials[material_index] = _load_material(glb, material_index)
+
+            primitives.append(Mesh(
+                vertices=vertices,
+                faces=faces,
+                normals=normals,
+                textureCoords=textureCoords,
+                material=materials[material_index],
+                tangents=tangents,
+                binormals=binormals
+            ))
+        meshes.append(primitives)
+
+    def build_node(index):
+        gltf_node = gltf['nodes'][index]
+        return Node(
+            name=gltf_node.get('name'),
+            M=_node_matrix(gltf_node),
+            meshes=meshes[gltf_node['mesh']] if 'mesh' in gltf_node else [],
+            children=[build_node(child) for child in gltf_node.get('children', [])]
+        )
+
+    if 'scenes' in gltf:
+        roots = gltf['scenes'][gltf.get('scene', 0)]['nodes']
+    else:
+        # without a scene, all nodes which are not children of another node are roots.
+        children = {child for node in gltf.get('nodes', []) for child in node.get('children', [])}
+        roots = [n for n in range(len(gltf.get('nodes', []))) if n not in children]
+
+    nodes = [build_node(index) for index in roots]
+    log.debug('--- Loaded %d mesh(es) in %d root node(s) from glTF file.',
+              sum(len(primitives) for primitives in meshes), len(nodes))
+    return nodes
+
+
+def load_glb_meshes(file_name):
+    '''
+    Load a binary glTF file as a flat list of meshes, like blender.load_obj_file(). The node transformations are
+    returned along with the meshes.
+    :return: a list of (world matrix, mesh) pairs
+    '''
+    return [pair for node in load_glb(file_name) for pair in node.flatten()]
+
+
+class _GlbWriter:
+    '''
+    Helper to pack arrays in the binary chunk and build the JSON description of a glTF file.
+    '''
+    def __init__(self):
+        self.gltf = {
+            'asset': {'version': '2.0', 'generator': 'graphics_learning_scene gltf.py'},
+            'buffers': [], 'bufferViews': [], 'accessors': [],
+            'images': [], 'textures': [], 'materials': [], 'meshes': [], 'nodes': [],
+        }
+        self.blocks = []
+        self.length = 0
+
+    def add_accessor(self, data, target=None, bounds=False):
+        data = np.ascontiguousarray(data)
+        component = {np.dtype(t): c for c, t in COMPONENT_TYPES.items()}[data.dtype]
+        width = 1 if data.ndim == 1 else data.shape[1]
+
+        view = {'buffer': 0, 'byteOffset': self.length, 'byteLength': data.nbytes}
+        if target is not None:
+            view['target'] = target
+        self.gltf['bufferViews'].append(view)
+
+        # keep all views aligned on 4 bytes.
+        self.blocks.append(data.tobytes())
+        self.length += data.nbytes
+        padding = -self.length % 4
+        if padding:
+            self.blocks.append(b'\0' * padding)
+            self.length += padding
+
+        accessor = {
+            'bufferView': len(self.gltf['bufferViews']) - 1,
+            'componentType': component,
+            'count': data.shape[0],
+            'type': {1: 'SCALAR', 2: 'VEC2', 3: 'VEC3', 4: 'VEC4'}[width],
+        }
+        if bounds:
+            accessor['min'] = data.min(axis=0).tolist()
+            accessor['max'] = data.max(axis=0).tolist()
+        self.gltf['accessors'].append(accessor)
+        return len(self.gltf['accessors']) - 1
+
+    def add_material(self, material):
+        gltf_material = {
+            'name': material.name,
+            'pbrMetallicRoughness': {
+                'baseColorFactor': list(map(float, material.Kd)) + [1.],
+                'metallicFactor': 0.,
+                # inverse of the Blinn-Phong exponent to roughness approximation used when loading.
+                'roughnessFactor': float((2. / (material.Ns + 2.)) ** 0.25),
+            },
+            # keep the exact Phong parameters so that the round trip does not change the rendering.
+            'extras': {
+                'Ka': list(map(float, material.Ka)),
+                'Kd': list(map(float, material.Kd)),
+                'Ks': list(map(float, material.Ks)),
+                'Ns': float(material.Ns),
+            },
+        }
+        if material.texture is not None:
+            self.gltf['images'].append({'uri': material.texture})
+            self.gltf['textures'].append({'source': len(self.gltf['images']) - 1})
+            gltf_material['pbrMetallicRoughness']['baseColorTexture'] = {'index': len(self.gltf['textures']) - 1}
+        self.gltf['materials'].append(gltf_material)
+        return len(self.gltf['materials']) - 1
+
+    def write(self, file_name):
+        self.gltf['buffers'].append({'byteLength': self.length})
+        for key in ('images', 'textures'):
+            if not self.gltf[key]:
+                del self.gltf[key]
+
+        json_chunk = json.dumps(self.gltf, separators=(',', ':')).encode('utf-8')
+        json_chunk += b' ' * (-len(json_chunk) % 4)
+        length = 12 + 8 + len(json_chunk) + 8 + self.length
+
+        with open(file_name, 'wb') as glb:
+            glb.write(struct.pack('<III', GLB_MAGIC, 2, length))
+            glb.write(struct.pack('<II', len(json_chunk), CHUNK_JSON))
+            glb.write(json_chunk)
+            glb.write(struct.pack('<II', self.length, CHUNK_BIN))
+            for block in self.blocks:
+                glb.write(block)
+
+
+def export_glb(meshes, file_name, name=None, M=None):
+    '''
+    Write a list of meshes to a binary glTF file, as the primitives of a single mesh attached to one node.
+    :param meshes: list of objects with vertices, faces, material and optionally normals and textureCoords attributes
+    :param file_name: the path of the .glb file to write
+    :param name: [optional] the name of the node
+    :param M: [optional] the transformation matrix of the node
+    '''
+    writer = _GlbWriter()
+    materials = {}
+    primitives = []
+
+    for mesh in meshes:
+        vertices = np.asarray(mesh.vertices, dtype=np.float32)
+        faces = np.asarray(mesh.faces, dtype=np.uint32)
+        normals = getattr(mesh, 'normals', None)
+        if normals is None:
+            normals, _, _ = calculate_normals(vertices, faces)
+
+        attributes = {
+            'POSITION': writer.add_accessor(vertices, target=34962, bounds=True),
+            'NORMAL': writer.add_accessor(np.nan_to_num(np.asarray(normals, dtype=np.float32)), target=34962),
+        }
+        if mesh.textureCoords is not None:
+            uvs = np.array(mesh.textureCoords, dtype=np.float32)
+            uvs[:, 1] = 1. - uvs[:, 1]
+            attributes['TEXCOORD_0'] = writer.add_accessor(uvs, target=34962)
+
+        if id(mesh.material) not in materials:
+            materials[id(mesh.material)] = writer.add_material(mesh.material)
+
+        primitives.append({
+            'attributes': attributes,
+            'indices': writer.add_accessor(faces.reshape(-1), target=34963),
+            'material': materials[id(mesh.material)],
+            'mode': MODE_TRIANGLES,
+        })
+
+    writer.gltf['meshes'].append({'name': name, 'primitives': primitives})
+    node = {'name': name, 'mesh': 0}
+    if M is not None:
+        node['matrix'] = np.asarray(M, dtype=float).T.reshape(-1).tolist()
+    writer.gltf['nodes'].append(node)
+    writer.gltf['scenes'] = [{'nodes': [0]}]
+    writer.gltf['scene'] = 0
+    writer.write(file_name)
+
+    log.info('--- Exported %d mesh(es) to glTF file %s', len(meshes), file_name)
+
+
+def convert_obj_to_glb(obj_file, glb_file):
+    '''
+    Convert a Blender3D object file to binary glTF. The file is read with the streaming reader, so the conversion
+    does not need an OpenGL context.
+    '''
+    # imported here to keep the loader independent of the Blender readers.
+    from objstream import iter_obj_groups
+
+    groups = list(iter_obj_groups(obj_file))
+    export_glb(groups, glb_file, name=os.path.splitext(os.path.basename(obj_file))[0])
+
+
+def benchmark(obj_file='models/test.obj', repeats=5):
+    '''
+    Compare the time to read the geometry of a model from its .obj file and from the converted .glb file.
+    '''
+    # imported here to keep the loader independent of the Blender readers.
+    from objstream import iter_obj_groups
+
+    with tempfile.TemporaryDirectory() as directory:
+        glb_file = os.path.join(directory, 'model.glb')
+        convert_obj_to_glb(obj_file, glb_file)
+
+        def read_obj():
+            return [group.vertices for group in iter_obj_groups(obj_file)]
+
+        def read_glb():
+            glb = GlbFile(glb_file)
+            return [glb.accessor(index) for index in range(len(glb.json['accessors']))]
+
+        for label, read in (('obj', read_obj), ('glb', read_glb)):
+            timings = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                read()
+                timings.append(time.perf_counter() - start)
+            log.info('%s: %.3f ms', label, 1000 * min(timings))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3:
+        convert_obj_to_glb(sys.argv[1], sys.argv[2])
+    else:
+        benchmark(*sys.argv[1:])
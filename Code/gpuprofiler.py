@@ -0,0 +1,217 @@
+# import requirements
+import contextlib
+
+import numpy as np
+
+from glbackend import gl
+from OpenGL.extensions import hasGLExtension
+
+from profiler import profiler
+
+from runtime import get_logger
+
+'''
+GPU profiler using OpenGL queries. Each frame is bracketed by two GL_TIMESTAMP queries, each model draw can be timed
+with a GL_TIME_ELAPSED query, and where ARB_pipeline_statistics_query is available the primitives submitted and the
+fragment shader invocations of the frame are counted. Query results are only read back several frames later, from a
+ring of query sets, so that reading them never waits for the GPU. The results are fed to the CPU profiler, under the
+'gpu' stage, so both are reported together.
+'''
+
+log = get_logger(__name__)
+
+try:
+    from OpenGL.GL.ARB.pipeline_statistics_query import GL_PRIMITIVES_SUBMITTED_ARB, GL_FRAGMENT_SHADER_INVOCATIONS_ARB
+except ImportError:
+    GL_PRIMITIVES_SUBMITTED_ARB = GL_FRAGMENT_SHADER_INVOCATIONS_ARB = None
+
+# the context manager returned when draws are not timed.
+_NULL_SCOPE = contextlib.nullcontext()
+
+
+def _gen_queries(n):
+    '''
+    Returns a list of n new query object names.
+    '''
+    return [int(query) for query in np.ravel(gl.glGenQueries(n))]
+
+
+class _QuerySet:
+    '''
+    Class to hold the queries issued during one frame.
+    '''
+    def __init__(self):
+        self.timestamps = _gen_queries(2)
+        self.statistics = {}
+        self.draws = []
+        self.used = 0
+        self.names = []
+        self.pending = False
+
+    def draw_query(self):
+        '''
+        Returns an unused GL_TIME_ELAPSED query of the set, generating more queries as needed.
+        '''
+        if self.used == len(self.draws):
+            self.draws += _gen_queries(1)
+        self.used += 1
+        return self.draws[self.used - 1]
+
+    def delete(self):
+        queries = self.timestamps + list(self.statistics.values()) + self.draws
+        gl.glDeleteQueries(len(queries), np.array(queries, dtype=np.uint32))
+
+
+class _DrawScope:
+    '''
+    Context manager timing one draw with a GL_TIME_ELAPSED query.
+    '''
+    __slots__ = ('query',)
+
+    def __init__(self, query):
+        self.query = query
+
+    def __enter__(self):
+        gl.glBeginQuery(gl.GL_TIME_ELAPSED, self.query)
+        return self
+
+    def __exit__(self, *exc):
+        gl.glEndQuery(gl.GL_TIME_ELAPSED)
+        return False
+
+
+class GPUProfiler:
+    '''
+    Class to time frames and draws on the GPU.
+    '''
+    def __init__(self, latency=4, per_draw=False):
+        '''
+        :param latency: the number of frames between issuing the queries and reading them back
+        :param per_draw: whether each model draw is timed, in addition to the whole frame
+        '''
+        self.latency = latency
+        self.per_draw = per_draw
+        self.enabled = False
+
+        # the queries need an OpenGL context, they are created when first enabled.
+        self.supported = None
+        self.statistics = {}
+        self.ring = []
+        self.frame = 0
+
+        # number of frames whose results were not yet available when read back.
+        self.dropped = 0
+
+    def _initialise(self):
+        '''
+        Check the support for the queries in the current context, and create the query ring.
+        '''
+        # timer queries are core since OpenGL 3.3, and the function is a null function if the driver lacks them.
+        self.supported = bool(gl.glQueryCounter) and (
+            hasGLExtension('GL_ARB_timer_query') or hasGLExtension('GL_VERSION_3_3'))
+        if not self.supported:
+            log.warning('GL_ARB_timer_query is not supported, GPU timings are disabled')
+            return
+
+        if GL_PRIMITIVES_SUBMITTED_ARB is not None and hasGLExtension('GL_ARB_pipeline_statistics_query'):
+            self.statistics = {
+                'gpu primitives': GL_PRIMITIVES_SUBMITTED_ARB,
+                'gpu fragments': GL_FRAGMENT_SHADER_INVOCATIONS_ARB,
+            }
+        else:
+            log.warning('GL_ARB_pipeline_statistics_query is not supported, only GPU timings are collected')
+
+        self.ring = []
+        for _ in range(self.latency):
+            queries = _QuerySet()
+            queries.statistics = dict(zip(self.statistics, _gen_queries(len(self.statistics))))
+            self.ring.append(queries)
+
+    def enable(self, enabled=True):
+        '''
+        Enable or disable the GPU profiler, it stays disabled if the queries are not supported.
+        '''
+        if enabled and self.supported is None:
+            self._initialise()
+        self.enabled = enabled and bool(self.supported)
+
+        # results pending in the ring are discarded.
+        for queries in self.ring:
+            queries.pending = False
+
+    def begin_frame(self):
+        '''
+        Read back the results of the oldest frame of the ring, and start the queries of the new frame in its place.
+        '''
+        if not self.enabled:
+            return
+
+        queries = self.ring[self.frame % self.latency]
+        if queries.pending:
+            self._read(queries)
+
+        queries.used = 0
+        queries.names = []
+        queries.pending = True
+        gl.glQueryCounter(queries.timestamps[0], gl.GL_TIMESTAMP)
+        for name, target in self.statistics.items():
+            gl.glBeginQuery(target, queries.statistics[name])
+
+    def end_frame(self):
+        '''
+        End the queries of the frame.
+        '''
+        if not self.enabled:
+            return
+
+        queries = self.ring[self.frame % self.latency]
+        for target in self.statistics.values():
+            gl.glEndQuery(target)
+        gl.glQueryCounter(queries.timestamps[1], gl.GL_TIMESTAMP)
+        self.frame += 1
+
+    def scope(self, name):
+        '''
+        Returns a context manager timing a draw on the GPU, or a no-op one if draws are not timed. GL_TIME_ELAPSED
+        queries cannot be nested, so draw scopes must not be either.
+        '''
+        if not (self.enabled and self.per_draw):
+            return _NULL_SCOPE
+
+        queries = self.ring[self.frame % self.latency]
+        queries.names.append(name)
+        return _DrawScope(queries.draw_query())
+
+    def _read(self, queries):
+        '''
+        Feed the results of a set of queries to the CPU profiler, if they are available.
+        '''
+        available = np.zeros(1, dtype=np.uint32)
+        gl.glGetQueryObjectuiv(queries.timestamps[1], gl.GL_QUERY_RESULT_AVAILABLE, available)
+        if not available[0]:
+            self.dropped += 1
+            return
+
+        result = np.zeros(1, dtype=np.uint64)
+
+        def value(query):
+            gl.glGetQueryObjectui64v(query, gl.GL_QUERY_RESULT, result)
+            return int(result[0])
+
+        # timestamps and elapsed times are in nanoseconds.
+        profiler.add('gpu', (value(queries.timestamps[1]) - value(queries.timestamps[0])) * 1e-9)
+        for name, query in zip(queries.names, queries.draws):
+            profiler.add('gpu/' + name, value(query) * 1e-9)
+        for name, query in queries.statistics.items():
+            profiler.count(name, value(query))
+
+    def delete(self):
+        for queries in self.ring:
+            queries.delete()
+        self.ring = []
+        self.supported = None
+        self.enabled = False
+
+
+# the GPU profiler used by the scene and the models.
+gpu_profiler = GPUProfiler()
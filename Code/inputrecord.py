@@ -0,0 +1,191 @@
+# import requirements
+import json
+import sys
+
+import numpy as np
+import pygame
+
+from runtime import get_logger
+
+'''
+Recording and replay of the user input, to run the same session of the scene several times, e.g. before and after a
+change, and compare the frame times. Events are stored with the simulation step at which they were handled, and a
+replay delivers them at the same steps while advancing exactly one fixed timestep per frame, so that the replayed
+session does not depend on the wall-clock time. The camera and light state is saved at the start and at the end of
+the recording, to restore the starting point and to check that the replay ended in the same state.
+'''
+
+log = get_logger(__name__)
+
+# event attributes stored, when the event has them.
+EVENT_ATTRIBUTES = ('key', 'mod', 'button', 'pos', 'rel', 'buttons')
+
+
+def scene_state(scene):
+    '''
+    Returns the camera and light state of a scene as a dictionary.
+    '''
+    return {
+        'phi': float(scene.camera.phi),
+        'psi': float(scene.camera.psi),
+        'distance': float(scene.camera.distance),
+        'center': [float(c) for c in scene.camera.center],
+        'light': [float(c) for c in scene.light.position],
+    }
+
+
+def restore_state(scene, state):
+    '''
+    Set the camera and light of a scene to a state saved by scene_state().
+    '''
+    scene.camera.phi = state['phi']
+    scene.camera.psi = state['psi']
+    scene.camera.distance = state['distance']
+    scene.camera.center = list(state['center'])
+    scene.light.position = np.array(state['light'], 'f')
+    scene.camera.update()
+
+
+class InputRecorder:
+    '''
+    Class to record the events handled by a scene.
+    '''
+    def __init__(self, scene):
+        self.scene = scene
+        self.start = self.step()
+        self.initial = scene_state(scene)
+        self.events = []
+
+    def step(self):
+        '''
+        The current simulation step of the scene.
+        '''
+        return int(round(self.scene.time / self.scene.timestep))
+
+    def record(self, event):
+        '''
+        Record an event, with the state of the modifier keys and mouse buttons when pygame does not provide it.
+        '''
+        record = {'step': self.step() - self.start, 'type': event.type}
+        for name in EVENT_ATTRIBUTES:
+            if hasattr(event, name):
+                value = getattr(event, name)
+                record[name] = list(value) if isinstance(value, tuple) else value
+        if 'mod' not in record:
+            record['mod'] = pygame.key.get_mods()
+        if event.type == pygame.MOUSEMOTION and 'buttons' not in record:
+            record['buttons'] = list(pygame.mouse.get_pressed())
+        self.events.append(record)
+
+    def save(self, file_name):
+        with open(file_name, 'w') as file:
+            json.dump({
+                'window_size': list(self.scene.window_size),
+                'timestep': self.scene.timestep,
+                'steps': self.step() - self.start,
+                'initial': self.initial,
+                'final': scene_state(self.scene),
+                'events': self.events,
+            }, file, indent=1)
+        log.info('--> Saved %d events over %d steps to %s', len(self.events), self.step() - self.start, file_name)
+
+
+class InputReplay:
+    '''
+    Class to feed recorded events back to a scene.
+    '''
+    def __init__(self, file_name):
+        with open(file_name, 'r') as file:
+            self.recording = json.load(file)
+        self.steps = self.recording['steps']
+        self.next = 0
+
+    def restore(self, scene):
+        '''
+        Put the scene in the state it was in when the recording started.
+        '''
+        if scene.timestep != self.recording['timestep']:
+            log.warning('replaying a recording made with a timestep of %s s', self.recording['timestep'])
+        scene.timestep = self.recording['timestep']
+        scene.time = 0.
+        scene.mouse_mvt = None
+        restore_state(scene, self.recording['initial'])
+        self.next = 0
+
+    def events(self, step):
+        '''
+        The events recorded up to a step, not yet delivered, as pygame events.
+        '''
+        events = []
+        recorded = self.recording['events']
+        while self.next < len(recorded) and recorded[self.next]['step'] <= step:
+            attributes = {name: tuple(value) if isinstance(value, list) else value
+                          for name, value in recorded[self.next].items() if name not in ('step', 'type')}
+            events.append(pygame.event.Event(recorded[self.next]['type'], attributes))
+            self.next += 1
+        return events
+
+    def check(self, scene):
+        '''
+        Compare the final state of the scene to the recorded one.
+        :return: whether they match
+        '''
+        final = scene_state(scene)
+        matches = all(np.allclose(final[name], value, atol=1e-4) for name, value in self.recording['final'].items())
+        if not matches:
+            log.warning('the replay ended in a different camera or light state than the recording')
+        return matches
+
+
+def save_frame_times(file_name, frame_times, label=None):
+    '''
+    Save the frame times of a run, in milliseconds, with their distribution.
+    '''
+    times = 1000. * np.asarray(frame_times)
+    with open(file_name, 'w') as file:
+        json.dump({'label': label, 'summary': distribution(times), 'frame_times': times.tolist()}, file, indent=1)
+
+
+def distribution(times):
+    '''
+    Statistics of the distribution of frame times.
+    '''
+    return {
+        'frames': int(times.shape[0]),
+        'mean': float(times.mean()),
+        'p50': float(np.percentile(times, 50)),
+        'p95': float(np.percentile(times, 95)),
+        'p99': float(np.percentile(times, 99)),
+        'max': float(times.max()),
+        'jitter': float(times.std()),
+    }
+
+
+def compare(before, after):
+    '''
+    Print the difference between the frame time distributions of two runs saved by save_frame_times().
+    '''
+    runs = []
+    for file_name in (before, after):
+        with open(file_name, 'r') as file:
+            runs.append(distribution(np.array(json.load(file)['frame_times'])))
+
+    log.info('%-8s %10s %10s %10s', '(ms)', 'before', 'after', 'change')
+    for name in ('mean', 'p50', 'p95', 'p99', 'max', 'jitter'):
+        a = runs[0][name]
+        b = runs[1][name]
+        log.info('%-8s %10.3f %10.3f %+9.1f%%', name, a, b, 100. * (b - a) / a if a > 0. else 0.)
+    return runs
+
+
+if __name__ == '__main__':
+    # usage: python inputrecord.py replay input.json [frame_times.json] [--headless]
+    #        python inputrecord.py compare before.json after.json
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    if arguments[0] == 'compare':
+        compare(arguments[1], arguments[2])
+    else:
+        from project import ProjectScene
+
+        scene = ProjectScene(headless='--headless' in sys.argv)
+        scene.replay(arguments[1], arguments[2] if len(arguments) > 2 else 'frame_times.json')
@@ -0,0 +1,328 @@
+# import requirements
+import time
+
+import numpy as np
+
+from glbackend import gl
+
+# CPU profiler of the frame stages
+from profiler import profiler
+
+# leveled logging of the runtime profile
+from runtime import get_logger
+
+'''
+Clustered assignment of many point lights. The view frustum is divided into a grid of clusters, tiles of the screen
+by slices of depth spaced exponentially between the near and far planes, and each frame the lights are assigned to
+the clusters their sphere of influence overlaps. The lights, the (offset, count) of each cluster and the flat list
+of light indices of all clusters are uploaded to texture buffers, so that the clustered fragment shader only loops
+over the lights of its own cluster. The lights are stored in NumPy arrays, and the assignment is vectorised over the
+lights and the tiles of each depth slice.
+'''
+
+log = get_logger(__name__)
+
+# texture units of the texture buffers, after the unit of the model textures.
+LIGHT_DATA_UNIT = 1
+CLUSTER_GRID_UNIT = 2
+LIGHT_INDICES_UNIT = 3
+
+
+def depth_range(P):
+    '''
+    Returns the near and far distances of a perspective projection matrix.
+    '''
+    return P[2, 3] / (P[2, 2] - 1.), P[2, 3] / (P[2, 2] + 1.)
+
+
+class _TextureBuffer:
+    '''
+    Class to hold a buffer read by the shaders as a texture buffer.
+    '''
+    def __init__(self, internal_format):
+        self.internal_format = internal_format
+        self.buffer = gl.glGenBuffers(1)
+        self.texture = gl.glGenTextures(1)
+        self.capacity = 0
+
+    def upload(self, data):
+        '''
+        Replace the content of the buffer, reallocating it when it grows.
+        '''
+        gl.glBindBuffer(gl.GL_TEXTURE_BUFFER, self.buffer)
+        if data.nbytes > self.capacity:
+            self.capacity = max(data.nbytes, 2 * self.capacity)
+            gl.glBufferData(gl.GL_TEXTURE_BUFFER, self.capacity, None, gl.GL_STREAM_DRAW)
+            gl.glBindTexture(gl.GL_TEXTURE_BUFFER, self.texture)
+            gl.glTexBuffer(gl.GL_TEXTURE_BUFFER, self.internal_format, self.buffer)
+            gl.glBindTexture(gl.GL_TEXTURE_BUFFER, 0)
+        if data.nbytes > 0:
+            gl.glBufferSubData(gl.GL_TEXTURE_BUFFER, 0, data.nbytes, data)
+        gl.glBindBuffer(gl.GL_TEXTURE_BUFFER, 0)
+
+    def bind(self, unit):
+        gl.glActiveTexture(gl.GL_TEXTURE0 + unit)
+        gl.glBindTexture(gl.GL_TEXTURE_BUFFER, self.texture)
+
+    def delete(self):
+        gl.glDeleteTextures([self.texture])
+        gl.glDeleteBuffers(1, [self.buffer])
+
+
+class LightManager:
+    '''
+    Class to hold point lights and assign them to the clusters of the view frustum.
+    '''
+    def __init__(self, P, window_size, grid=(16, 9, 24), capacity=256, max_indices=1 << 18, upload=True):
+        '''
+        :param P: the projection matrix
+        :param window_size: the size of the window in pixels, used by the shader to find the tile of a fragment
+        :param grid: the number of clusters along x, y and depth
+        :param capacity: the initial number of lights, grown as needed
+        :param max_indices: the maximum number of light indices over all clusters, assignments beyond are dropped
+        :param upload: whether to create the texture buffers, False to only run the assignment
+        '''
+        self.grid = grid
+        self.window_size = window_size
+        self.max_indices = max_indices
+
+        self.positions = np.zeros((capacity, 3), dtype=np.float32)
+        self.colors = np.zeros((capacity, 3), dtype=np.float32)
+        self.radii = np.zeros(capacity, dtype=np.float32)
+        self.active = np.zeros(capacity, dtype=bool)
+
+        self.set_projection(P)
+
+        # the cluster grid and light indices of the last assignment.
+        self.cluster_grid = np.zeros((self.cluster_count, 2), dtype=np.uint32)
+        self.light_indices = np.zeros(0, dtype=np.uint32)
+        self.dropped = 0
+        self.warned_dropped = 0
+
+        self.buffers = None
+        if upload:
+            self.buffers = {
+                'lights': _TextureBuffer(gl.GL_RGBA32F),
+                'grid': _TextureBuffer(gl.GL_RG32UI),
+                'indices': _TextureBuffer(gl.GL_R32UI),
+            }
+        self.uploaded_empty = False
+
+    @property
+    def count(self):
+        return int(np.count_nonzero(self.active))
+
+    @property
+    def cluster_count(self):
+        return self.grid[0] * self.grid[1] * self.grid[2]
+
+    def set_projection(self, P):
+        '''
+        Compute the view space bounding box of each cluster for a projection matrix.
+        '''
+        nx, ny, nz = self.grid
+        self.near, self.far = depth_range(P)
+
+        # depth of the slice boundaries, spaced exponentially so that clusters are about as deep as they are wide.
+        self.slices = self.near * (self.far / self.near) ** (np.arange(nz + 1) / nz)
+
+        # corners of the tiles on the near plane, unprojected from normalised device coordinates.
+        x = np.linspace(-1., 1., nx + 1)
+        y = np.linspace(-1., 1., ny + 1)
+        X, Y = np.meshgrid(x, y)
+        corners = np.stack([X.ravel(), Y.ravel(), -np.ones(X.size), np.ones(X.size)], axis=1)
+        corners = corners @ np.linalg.inv(P).T
+        corners = (corners[:, :3] / corners[:, 3:]).reshape(ny + 1, nx + 1, 3)
+
+        # with no skew in the projection, the x extent of a cluster only depends on its column and depth slice, and its
+        # y extent on its row and slice, so the boxes of the clusters are stored as separate x, y and depth ranges.
+        x = corners[0, :, 0] / self.near
+        y = corners[:, 0, 1] / self.near
+        self.column_min, self.column_max = self._extents(x)
+        self.row_min, self.row_max = self._extents(y)
+
+    def _extents(self, edges):
+        '''
+        The view space extents along one axis of the clusters between tile edges on the near plane, for each slice.
+        '''
+        near = self.slices[:-1, np.newaxis, np.newaxis]
+        far = self.slices[1:, np.newaxis, np.newaxis]
+        sides = np.stack([edges[:-1], edges[1:]], axis=-1)
+        points = np.concatenate([sides * near, sides * far], axis=-1)
+        return points.min(axis=-1).astype(np.float32), points.max(axis=-1).astype(np.float32)
+
+    def _grow(self, capacity):
+        for name in ('positions', 'colors', 'radii', 'active'):
+            array = getattr(self, name)
+            grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            grown[:array.shape[0]] = array
+            setattr(self, name, grown)
+
+    def add(self, positions, colors, radii):
+        '''
+        Add point lights.
+        :param positions: (N,3) array of world positions
+        :param colors: (N,3) array of colours, or one colour for all lights
+        :param radii: (N,) array of the radii of influence, or one radius for all lights
+        :return: the indices of the new lights
+        '''
+        positions = np.reshape(positions, (-1, 3))
+        n = positions.shape[0]
+        free = np.flatnonzero(~self.active)
+        if free.shape[0] < n:
+            self._grow(max(2 * self.active.shape[0], self.active.shape[0] + n))
+            free = np.flatnonzero(~self.active)
+        indices = free[:n]
+
+        self.positions[indices] = positions
+        self.colors[indices] = colors
+        self.radii[indices] = radii
+        self.active[indices] = True
+        return indices
+
+    def set_positions(self, indices, positions):
+        self.positions[indices] = positions
+
+    def remove(self, indices):
+        self.active[indices] = False
+
+    def clear(self):
+        self.active[:] = False
+
+    def assign(self, V):
+        '''
+        Assign the lights to the clusters they overlap, for a view matrix.
+        :return: the (clusters, 2) array of the offset and count of the light indices of each cluster, and the flat
+        array of light indices, as positions in the list of active lights
+        '''
+        nz = self.grid[2]
+        tiles = self.grid[0] * self.grid[1]
+        lights = np.flatnonzero(self.active)
+
+        # light centres in view coordinates, at depth -z.
+        centres = self.positions[lights] @ V[:3, :3].T + V[:3, 3]
+        radii = self.radii[lights]
+        depth = -centres[:, 2]
+
+        # slices overlapped by each light, lights wholly behind the camera or beyond the far plane get none.
+        first = np.searchsorted(self.slices, depth - radii, side='right') - 1
+        last = np.searchsorted(self.slices, depth + radii, side='right') - 1
+        first = np.maximum(first, 0)
+        last = np.minimum(last, nz - 1)
+
+        clusters = []
+        indices = []
+        for k in range(nz):
+            candidates = np.flatnonzero((first <= k) & (last >= k))
+            if candidates.shape[0] == 0:
+                continue
+
+            # sphere against box test of the candidates and all tiles of the slice: the squared distance from the centre
+            # to the closest point of each box is the sum of the squared distances along x, y and depth.
+            c = centres[candidates]
+            dz = np.maximum(depth[candidates] - self.slices[k + 1], 0.) + np.maximum(self.slices[k] - depth[candidates], 0.)
+            dx = np.maximum(self.column_min[k][:, np.newaxis] - c[:, 0], 0.) + np.maximum(c[:, 0] - self.column_max[k][:, np.newaxis], 0.)
+            dy = np.maximum(self.row_min[k][:, np.newaxis] - c[:, 1], 0.) + np.maximum(c[:, 1] - self.row_max[k][:, np.newaxis], 0.)
+            hits = (dy[:, np.newaxis] ** 2 + dx ** 2) <= (radii[candidates] ** 2 - dz ** 2)
+            hits = hits.reshape(tiles, candidates.shape[0])
+            tile, light = np.nonzero(hits)
+            clusters.append(k * tiles + tile)
+            indices.append(candidates[light])
+
+        if clusters:
+            clusters = np.concatenate(clusters)
+            indices = np.concatenate(indices)
+        else:
+            clusters = indices = np.zeros(0, dtype=np.int64)
+
+        # clusters are produced in order, so the indices of each cluster are contiguous.
+        self.dropped = max(0, indices.shape[0] - self.max_indices)
+        if self.dropped:
+            clusters = clusters[:self.max_indices]
+            indices = indices[:self.max_indices]
+            profiler.count('dropped light indices', self.dropped)
+
+            # warned again only when more are dropped, rather than every frame.
+            if self.dropped > self.warned_dropped:
+                log.warning('%d light indices over the maximum of %d dropped, the far clusters lose their lights',
+                            self.dropped, self.max_indices)
+                self.warned_dropped = self.dropped
+
+        counts = np.bincount(clusters, minlength=self.cluster_count)
+        self.cluster_grid[:, 0] = np.cumsum(counts) - counts
+        self.cluster_grid[:, 1] = counts
+        self.light_indices = indices.astype(np.uint32)
+        return self.cluster_grid, self.light_indices
+
+    def update(self, V):
+        '''
+        Assign the lights for this frame, upload them and bind the texture buffers.
+        '''
+        if self.buffers is None:
+            return
+
+        if self.count == 0:
+            # an empty grid is uploaded once, and kept until lights are added.
+            if not self.uploaded_empty:
+                self.cluster_grid[:] = 0
+                self.buffers['grid'].upload(self.cluster_grid)
+                self.buffers['lights'].upload(np.zeros(8, dtype=np.float32))
+                self.buffers['indices'].upload(np.zeros(1, dtype=np.uint32))
+                self.uploaded_empty = True
+        else:
+            self.assign(V)
+            lights = np.flatnonzero(self.active)
+
+            # each light takes two texels: its view position and radius, and its colour.
+            data = np.zeros((lights.shape[0], 2, 4), dtype=np.float32)
+            data[:, 0, :3] = self.positions[lights] @ V[:3, :3].T + V[:3, 3]
+            data[:, 0, 3] = self.radii[lights]
+            data[:, 1, :3] = self.colors[lights]
+
+            self.buffers['lights'].upload(data)
+            self.buffers['grid'].upload(self.cluster_grid)
+            self.buffers['indices'].upload(self.light_indices if self.light_indices.shape[0] else np.zeros(1, np.uint32))
+            self.uploaded_empty = False
+
+        self.buffers['lights'].bind(LIGHT_DATA_UNIT)
+        self.buffers['grid'].bind(CLUSTER_GRID_UNIT)
+        self.buffers['indices'].bind(LIGHT_INDICES_UNIT)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+    def delete(self):
+        if self.buffers is not None:
+            for buffer in self.buffers.values():
+                buffer.delete()
+            self.buffers = None
+
+
+def benchmark(counts=(100, 300, 1000, 3000, 10000), repeats=20):
+    '''
+    Report the time to assign lights to the clusters against the number of lights, with lights of radius 3 scattered
+    over the view frustum of the scene. The light indices are not capped, so that all counts time the whole
+    assignment.
+    '''
+    from matutils import frustumMatrix
+
+    P = frustumMatrix(-1., 1., -1., 1., 1.5, 50.)
+    V = np.eye(4, dtype=np.float32)
+    rng = np.random.default_rng(0)
+
+    for count in counts:
+        manager = LightManager(P, (1800, 960), capacity=count, max_indices=1 << 30, upload=False)
+        depth = rng.uniform(manager.near, manager.far, count)
+        positions = np.column_stack([rng.uniform(-1., 1., (count, 2)) * depth[:, np.newaxis] / manager.near, -depth])
+        manager.add(positions, [1., 0.9, 0.7], 3.)
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            manager.assign(V)
+        elapsed = 1000. * (time.perf_counter() - start) / repeats
+
+        log.info('%6d lights: %8.3f ms per assignment, %7d light indices (%d dropped), %5.1f lights per non-empty '
+                 'cluster', count, elapsed, manager.light_indices.shape[0], manager.dropped,
+                 manager.light_indices.shape[0] / max(1, np.count_nonzero(manager.cluster_grid[:, 1])))
+
+
+if __name__ == '__main__':
+    benchmark()
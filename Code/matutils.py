@@ -3,8 +3,7 @@ import numpy as np
 
 # matrix to define scale of the object.
 def scaleMatrix(s):
-    s.append(1)
-    return np.diag(s)
+    return np.diag(np.append(np.asarray(s, dtype='f'), np.float32(1)))
 
 # matrix to define translation of the object.
 def translationMatrix(t):
@@ -17,7 +16,7 @@ def translationMatrix(t):
 def rotationMatrixZ(angle):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4,dtype='f')
     R[0,0] = c
     R[0,1] = s
     R[1,0] = -s
@@ -28,7 +27,7 @@ def rotationMatrixZ(angle):
 def rotationMatrixX(angle):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4,dtype='f')
     R[1,1] = c
     R[1,2] = s
     R[2,1] = -s
@@ -39,7 +38,7 @@ def rotationMatrixX(angle):
 def rotationMatrixY(angle):
     c = np.cos(angle)
     s = np.sin(angle)
-    R = np.identity(4)
+    R = np.identity(4,dtype='f')
     R[0,0] = c
     R[0,2] = s
     R[2,0] = -s
@@ -55,16 +54,7 @@ def poseMatrix(position=[0,0,0], orientation=0, scale=1):
     :param scale: the model scale, either a scalar for isotropic scaling, or vector of scale factors
     :return: 4x4 TRS matrix
     '''
-    # apply the position and orientation of the object.
-    R = rotationMatrixZ(orientation)
-    T = translationMatrix(position)
-
-    # scale factor.
-    if np.isscalar(scale):
-        scale = [scale, scale, scale]
-
-    S = scaleMatrix(scale)
-    return np.matmul(np.matmul(T,R),S)
+    return poseMatrices(np.reshape(position, (1, 3)), orientation, np.reshape(scale, (1, -1)))[0]
 
 def frustumMatrix(l,r,t,b,n,f):
     '''
@@ -83,12 +73,236 @@ def frustumMatrix(l,r,t,b,n,f):
             [ 0,              -2*n/(t-b),  (t+b)/(t-b),    0 ],
             [ 0,              0,          -(f+n)/(f-n),   -2*f*n/(f-n) ],
             [ 0,              0,          -1,             0 ]
-            ]
+            ],
+        dtype='f'
+    )
+
+def orthoMatrix(l,r,t,b,n,f):
+    '''
+    Returns an orthographic projection matrix
+    :param l: left clip plane
+    :param r: right clip plane
+    :param t: top clip plane
+    :param b: bottom clip plane
+    :param n: near clip plane
+    :param f: far clip plane
+    :return: A 4x4 orthographic projection matrix
+    '''
+    return np.array(
+        [
+            [ 2/(r-l),  0,          0,          -(r+l)/(r-l) ],
+            [ 0,        2/(t-b),    0,          -(t+b)/(t-b) ],
+            [ 0,        0,          -2/(f-n),   -(f+n)/(f-n) ],
+            [ 0,        0,          0,          1 ]
+            ],
+        dtype='f'
     )
 
+def lookAtMatrix(eye, target, up=[0,1,0]):
+    '''
+    Returns the view matrix of a camera at eye looking at target
+    :param eye: the position of the camera
+    :param target: the point looked at, on the -Z axis of the view
+    :param up: the up direction, must not be parallel to the direction looked at
+    :return: A 4x4 view matrix
+    '''
+    eye = np.asarray(eye, dtype='f')
+    forward = np.asarray(target, dtype='f') - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    true_up = np.cross(right, forward)
+
+    V = np.identity(4, dtype='f')
+    V[0, :3] = right
+    V[1, :3] = true_up
+    V[2, :3] = -forward
+    V[:3, 3] = -np.matmul(V[:3, :3], eye)
+    return V
+
 # homogeneous coordinates helpers for use in shaders.
 def homog(v):
     return np.hstack([v,1])
 
 def unhomog(vh):
     return vh[:-1]/vh[-1]
+
+
+'''
+Batched versions of the functions above. Each builds N float32 matrices at once from arrays of parameters, and can
+write into a preallocated (N,4,4) output array so that per-frame updates do not allocate.
+'''
+
+def _identities(n, out=None):
+    '''
+    Returns an (n,4,4) float32 array set to identity, reusing out if provided.
+    '''
+    if out is None:
+        out = np.empty((n, 4, 4), dtype='f')
+    out[...] = 0.
+    out[:, [0, 1, 2, 3], [0, 1, 2, 3]] = 1.
+    return out
+
+# (N,4,4) matrices to define translations from an (N,3) array.
+def translationMatrices(t, out=None):
+    t = np.asarray(t, dtype='f').reshape(-1, 3)
+    T = _identities(t.shape[0], out)
+    T[:, :3, 3] = t
+    return T
+
+# (N,4,4) matrices to define scales from an (N,3) array, or an (N,) array for isotropic scaling.
+def scaleMatrices(s, out=None):
+    s = np.asarray(s, dtype='f')
+    if s.ndim == 1:
+        s = s[:, np.newaxis]
+    S = _identities(s.shape[0], out)
+    S[:, [0, 1, 2], [0, 1, 2]] = s
+    return S
+
+def _rotationMatrices(angles, i, j, out=None):
+    '''
+    (N,4,4) matrices of rotations in the plane of axes i and j, with the same convention as rotationMatrixX/Y/Z.
+    '''
+    angles = np.asarray(angles, dtype='f').reshape(-1)
+    R = _identities(angles.shape[0], out)
+    c = np.cos(angles)
+    s = np.sin(angles)
+    R[:, i, i] = c
+    R[:, i, j] = s
+    R[:, j, i] = -s
+    R[:, j, j] = c
+    return R
+
+# (N,4,4) matrices to define rotations about the X axis from an (N,) array of angles.
+def rotationMatricesX(angles, out=None):
+    return _rotationMatrices(angles, 1, 2, out)
+
+# (N,4,4) matrices to define rotations about the Y axis from an (N,) array of angles.
+def rotationMatricesY(angles, out=None):
+    return _rotationMatrices(angles, 0, 2, out)
+
+# (N,4,4) matrices to define rotations about the Z axis from an (N,) array of angles.
+def rotationMatricesZ(angles, out=None):
+    return _rotationMatrices(angles, 0, 1, out)
+
+
+def poseMatrices(positions, orientations=0, scales=1, out=None):
+    '''
+    Returns N combined TRS matrices, built directly rather than by multiplying the T, R and S matrices.
+    :param positions: (N,3) array of positions
+    :param orientations: (N,) array of orientations around the Z axis, or a scalar
+    :param scales: (N,3) or (N,1) array of scale factors, or a scalar for isotropic scaling
+    :param out: [optional] (N,4,4) float32 array to write the result into
+    :return: (N,4,4) array of TRS matrices
+    '''
+    positions = np.asarray(positions, dtype='f').reshape(-1, 3)
+    n = positions.shape[0]
+    orientations = np.broadcast_to(np.asarray(orientations, dtype='f').reshape(-1), (n,))
+    scales = np.broadcast_to(np.asarray(scales, dtype='f').reshape(n if np.size(scales) > 1 else 1, -1), (n, 3))
+
+    M = _identities(n, out)
+    c = np.cos(orientations)
+    s = np.sin(orientations)
+
+    # R*S scales the columns of the rotation matrix.
+    M[:, 0, 0] = c * scales[:, 0]
+    M[:, 0, 1] = s * scales[:, 1]
+    M[:, 1, 0] = -s * scales[:, 0]
+    M[:, 1, 1] = c * scales[:, 1]
+    M[:, 2, 2] = scales[:, 2]
+    M[:, :3, 3] = positions
+    return M
+
+
+def _inverse3x3(A):
+    '''
+    Inverse of a stack of (...,3,3) matrices using the cross products of their columns.
+    '''
+    a0 = A[..., :, 0]
+    a1 = A[..., :, 1]
+    a2 = A[..., :, 2]
+    r0 = np.cross(a1, a2)
+    r1 = np.cross(a2, a0)
+    r2 = np.cross(a0, a1)
+    det = np.sum(a0 * r0, axis=-1)[..., np.newaxis, np.newaxis]
+    return np.stack([r0, r1, r2], axis=-2) / det
+
+
+def affineInverse(M, out=None):
+    '''
+    Inverse of affine transformation matrices, i.e. whose last row is [0,0,0,1].
+    :param M: a 4x4 matrix or a (...,4,4) stack of matrices
+    :param out: [optional] float32 array of the same shape to write the result into
+    :return: the inverse matrices
+    '''
+    M = np.asarray(M)
+    if out is None:
+        out = np.empty(M.shape, dtype='f')
+    Ainv = _inverse3x3(M[..., :3, :3])
+    out[..., :3, :3] = Ainv
+    out[..., :3, 3] = -np.einsum('...ij,...j->...i', Ainv, M[..., :3, 3])
+    out[..., 3, :3] = 0.
+    out[..., 3, 3] = 1.
+    return out
+
+
+def rigidInverse(M, out=None):
+    '''
+    Inverse of rigid transformation matrices, made of a rotation and a translation only, using the transpose.
+    :param M: a 4x4 matrix or a (...,4,4) stack of matrices
+    :param out: [optional] float32 array of the same shape to write the result into
+    :return: the inverse matrices
+    '''
+    M = np.asarray(M)
+    if out is None:
+        out = np.empty(M.shape, dtype='f')
+    Rt = np.swapaxes(M[..., :3, :3], -1, -2)
+    out[..., :3, 3] = -np.einsum('...ij,...j->...i', Rt, M[..., :3, 3])
+    out[..., :3, :3] = Rt
+    out[..., 3, :3] = 0.
+    out[..., 3, 3] = 1.
+    return out
+
+
+def benchmark(n=1000, repeats=20):
+    '''
+    Compare building n matrices with the single-matrix functions and with the batched ones.
+    '''
+    import timeit
+    from runtime import get_logger
+
+    log = get_logger(__name__)
+
+    rng = np.random.default_rng(0)
+    positions = rng.standard_normal((n, 3)).astype('f')
+    angles = rng.uniform(0., 2. * np.pi, n).astype('f')
+    scales = rng.uniform(0.5, 2., (n, 3)).astype('f')
+    out = np.empty((n, 4, 4), dtype='f')
+    poses = poseMatrices(positions, angles, scales)
+
+    cases = [
+        ('translation', lambda: [translationMatrix(p) for p in positions],
+         lambda: translationMatrices(positions, out=out)),
+        ('rotationY', lambda: [rotationMatrixY(a) for a in angles],
+         lambda: rotationMatricesY(angles, out=out)),
+        ('scale', lambda: [scaleMatrix(s) for s in scales],
+         lambda: scaleMatrices(scales, out=out)),
+        ('pose', lambda: [np.matmul(np.matmul(translationMatrix(p), rotationMatrixZ(a)), scaleMatrix(s))
+                          for p, a, s in zip(positions, angles, scales)],
+         lambda: poseMatrices(positions, angles, scales, out=out)),
+        ('inverse', lambda: np.linalg.inv(poses),
+         lambda: affineInverse(poses, out=out)),
+        ('rigid inverse', lambda: np.linalg.inv(poses),
+         lambda: rigidInverse(poses, out=out)),
+    ]
+
+    log.info('Building %d matrices, best of %d runs:', n, repeats)
+    for name, single, batched in cases:
+        t_single = min(timeit.repeat(single, number=1, repeat=repeats))
+        t_batched = min(timeit.repeat(batched, number=1, repeat=repeats))
+        log.info('%-14s single %9.3f ms   batched %7.3f ms   x%.0f',
+                 name, 1000 * t_single, 1000 * t_batched, t_single / t_batched)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -3,19 +3,26 @@ import numpy as np
 
 from material import Material
 from texture import Texture
+from texstream import texture_streamer
+
+from runtime import get_logger
+
+log = get_logger(__name__)
 
 
 class Mesh:
     '''
     Class to hold a mesh data.
     '''
-    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material()):
+    def __init__(self, vertices=None, faces=None, normals=None, textureCoords=None, material=Material(), tangents=None, binormals=None):
         '''
         Initialise mesh object.
         :param vertices: A numpy array containing all vertices
         :param faces: [optional] An int array containing the vertex indices for all faces.
         :param normals: [optional] An array of normal vectors, calculated from the faces if not provided.
         :param material: [optional] An object containing the material information for this object
+        :param tangents: [optional] Precomputed tangent vectors, only used when normals are provided too.
+        :param binormals: [optional] Precomputed binormal vectors, only used when normals are provided too.
         '''
         self.vertices = vertices
         self.faces = faces
@@ -23,57 +30,75 @@ class Mesh:
         self.colors = None
         self.textureCoords = textureCoords
         self.textures = []
-        self.tangents = None
-        self.binormals = None
+        self.tangents = tangents
+        self.binormals = binormals
 
         if vertices is not None:
-            print('Creating mesh')
-            print('- {} vertices, {} faces'.format(self.vertices.shape[0], self.faces.shape[0]))
+            log.debug('Creating mesh with %d vertices, %d faces', self.vertices.shape[0], self.faces.shape[0])
 
         if normals is None:
             if faces is None:
-                print('(W) Warning: the current code only calculates normals using the face vector of indices, which was not provided here.')
+                log.warning('the current code only calculates normals using the face vector of indices, which was not provided here.')
             else:
                 self.calculate_normals()
         else:
             self.normals = normals
 
         if material.texture is not None:
-            self.textures.append(Texture(material.texture))
+            # streamed textures are shared by the meshes using the same image.
+            if texture_streamer.enabled:
+                self.textures.append(texture_streamer.texture(material.texture))
+            else:
+                self.textures.append(Texture(material.texture))
 
     def calculate_normals(self):
         '''
         Calculate normals from the mesh faces by calculating normal for each face using cross product and setting each
         vertex normal as the average of the normals over all faces it belongs to.
         '''
+        self.normals, self.tangents, self.binormals = calculate_normals(self.vertices, self.faces, self.textureCoords)
+
+
+def calculate_normals(vertices, faces, textureCoords=None):
+    '''
+    Calculate per-vertex normals, and tangents and binormals if texture coordinates are given, from the mesh faces.
+    Kept separate from the Mesh class so that it can run in worker processes without creating any OpenGL object.
+    :param vertices: (N,3) array of vertex positions
+    :param faces: (M,3) array of vertex indices
+    :param textureCoords: [optional] (N,2) array of texture coordinates
+    :return: a tuple (normals, tangents, binormals), the last two are None if no texture coordinates are given.
+    '''
+    normals = np.zeros((vertices.shape[0], 3), dtype='f')
+    tangents = None
+    binormals = None
+    if textureCoords is not None:
+        tangents = np.zeros((vertices.shape[0], 3), dtype='f')
+        binormals = np.zeros((vertices.shape[0], 3), dtype='f')
+
+    for f in range(faces.shape[0]):
+        # calculate the face normal using the cross product of the triangle's sides.
+        a = vertices[faces[f, 1]] - vertices[faces[f, 0]]
+        b = vertices[faces[f, 2]] - vertices[faces[f, 0]]
+        face_normal = np.cross(a, b)
+
+        # find tangent.
+        if textureCoords is not None:
+            txa = textureCoords[faces[f, 1], :] - textureCoords[faces[f, 0], :]
+            txb = textureCoords[faces[f, 2], :] - textureCoords[faces[f, 0], :]
+            face_tangent = txb[0]*a - txa[0]*b
+            face_binormal = -txb[1]*a + txa[1]*b
+
+        # blend normal on all 3 vertices.
+        for j in range(3):
+            normals[faces[f, j], :] += face_normal
+            if textureCoords is not None:
+                tangents[faces[f, j], :] += face_tangent
+                binormals[faces[f, j], :] += face_binormal
+
+    # normalise the vectors.
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    if textureCoords is not None:
+        tangents /= np.linalg.norm(tangents, axis=1, keepdims=True)
+        binormals /= np.linalg.norm(binormals, axis=1, keepdims=True)
 
-        self.normals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-        if self.textureCoords is not None:
-            self.tangents = np.zeros((self.vertices.shape[0], 3), dtype='f')
-            self.binormals = np.zeros((self.vertices.shape[0], 3), dtype='f')
-
-        for f in range(self.faces.shape[0]):
-            # calculate the face normal using the cross product of the triangle's sides.
-            a = self.vertices[self.faces[f, 1]] - self.vertices[self.faces[f, 0]]
-            b = self.vertices[self.faces[f, 2]] - self.vertices[self.faces[f, 0]]
-            face_normal = np.cross(a, b)
-
-            # find tangent.
-            if self.textureCoords is not None:
-                txa = self.textureCoords[self.faces[f, 1], :] - self.textureCoords[self.faces[f, 0], :]
-                txb = self.textureCoords[self.faces[f, 2], :] - self.textureCoords[self.faces[f, 0], :]
-                face_tangent = txb[0]*a - txa[0]*b
-                face_binormal = -txb[1]*a + txa[1]*b
-
-            # blend normal on all 3 vertices.
-            for j in range(3):
-                self.normals[self.faces[f, j], :] += face_normal
-                if self.textureCoords is not None:
-                    self.tangents[self.faces[f, j], :] += face_tangent
-                    self.binormals[self.faces[f, j], :] += face_binormal
-
-        # normalise the vectors.
-        self.normals /= np.linalg.norm(self.normals, axis=1, keepdims=True)
-        if self.textureCoords is not None:
-            self.tangents /= np.linalg.norm(self.tangents, axis=1, keepdims=True)
-            self.binormals /= np.linalg.norm(self.binormals, axis=1, keepdims=True)
+    return normals, tangents, binormals
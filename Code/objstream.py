@@ -0,0 +1,323 @@
+# import requirements
+import os
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+
+from blender import fix_blender_textures, load_material_library
+from mesh import Mesh
+
+from runtime import get_logger
+
+'''
+Streaming reader for Blender3D object files. Unlike blender.load_obj_file(), the file is read in large chunks and the
+data is accumulated in typed arrays which grow geometrically, instead of Python lists of lists. Each material group
+is handed over as soon as the next one starts, so a caller consuming the generator only keeps the vertex arrays of
+the whole file and the faces of the current group in memory.
+'''
+
+log = get_logger(__name__)
+
+
+class GrowableArray:
+    '''
+    Class to hold a 2D array with a fixed number of columns that can be appended to, doubling its capacity when full.
+    '''
+    def __init__(self, width, dtype='f', capacity=1024):
+        '''
+        :param width: number of columns
+        :param dtype: numpy type of the data
+        :param capacity: initial number of rows allocated
+        '''
+        self.buffer = np.empty((max(1, capacity), width), dtype=dtype)
+        self.size = 0
+
+    def extend(self, rows):
+        '''
+        Append a block of rows at the end of the array.
+        '''
+        rows = np.asarray(rows, dtype=self.buffer.dtype).reshape(-1, self.buffer.shape[1])
+        end = self.size + rows.shape[0]
+        if end > self.buffer.shape[0]:
+            capacity = self.buffer.shape[0]
+            while capacity < end:
+                capacity *= 2
+            buffer = np.empty((capacity, self.buffer.shape[1]), dtype=self.buffer.dtype)
+            buffer[:self.size] = self.buffer[:self.size]
+            self.buffer = buffer
+
+        self.buffer[self.size:end] = rows
+        self.size = end
+
+    def clear(self):
+        '''
+        Empty the array, keeping the allocated capacity.
+        '''
+        self.size = 0
+
+    @property
+    def data(self):
+        '''
+        View of the filled part of the array, only valid until the next call to extend().
+        '''
+        return self.buffer[:self.size]
+
+    def __len__(self):
+        return self.size
+
+
+class ObjGroup:
+    '''
+    Class to hold the raw data of one material group read from a Blender file, without any OpenGL object.
+    '''
+    def __init__(self, material, vertices, faces, textureCoords, line_nb):
+        '''
+        :param material: the Material object of the group
+        :param vertices: (N,3) array of the vertices used by the group
+        :param faces: (M,3) array of indices in the vertex array of the group
+        :param textureCoords: (N,2) array of texture coordinates re-indexed on the vertices, or None
+        :param line_nb: line of the file where the group starts
+        '''
+        self.material = material
+        self.vertices = vertices
+        self.faces = faces
+        self.textureCoords = textureCoords
+        self.line_nb = line_nb
+
+    def create_mesh(self):
+        '''
+        Create the Mesh object for this group.
+        '''
+        return Mesh(
+            vertices=self.vertices,
+            faces=self.faces,
+            material=self.material,
+            textureCoords=self.textureCoords
+        )
+
+
+def _face_indices(fields):
+    '''
+    Convert the fields of a face line into a list of (vertex, texture) indices, or vertex indices only.
+    '''
+    indices = []
+    for field in fields:
+        parts = field.split(b'/')
+        indices.append(int(parts[0]))
+        if len(parts) > 1 and parts[1]:
+            indices.append(int(parts[1]))
+    return indices
+
+
+def iter_obj_groups(file_name, chunk_size=1 << 22):
+    '''
+    Read a Blender3D object file in chunks and yield each material group once it is complete.
+    :param file_name: the path to the .obj file
+    :param chunk_size: number of bytes read from the file at once
+    :return: a generator of ObjGroup objects
+    '''
+    log.info('Streaming mesh(es) from Blender file: %s', file_name)
+
+    vertices = GrowableArray(3, 'f')
+    uvs = GrowableArray(2, 'f')
+    faces = None  # faces of the current group, allocated once we know the number of indices per corner.
+
+    # data parsed from the current chunk, appended to the arrays in blocks.
+    vbuf = []
+    tbuf = []
+    fbuf = []
+
+    library = None
+    material = None
+    group_line = 0
+    line_nb = 0
+    ngroups = 0
+
+    def flush():
+        nonlocal faces
+        if vbuf:
+            vertices.extend(np.array(vbuf, dtype='f'))
+            vbuf.clear()
+        if tbuf:
+            uvs.extend(np.array(tbuf, dtype='f'))
+            tbuf.clear()
+        if fbuf:
+            block = np.array(fbuf, dtype=np.uint32)
+            if faces is None:
+                faces = GrowableArray(block.shape[1], np.uint32)
+            faces.extend(block)
+            fbuf.clear()
+
+    def close_group():
+        # faces are stored as corners of (vertex, texture) indices, 1-based as in the file.
+        farray = faces.data.reshape(faces.size, 3, -1)
+        vmax = int(farray[:, :, 0].max())
+        vmin = int(farray[:, :, 0].min()) - 1
+        textures = None
+        if farray.shape[2] > 1:
+            textures = fix_blender_textures(uvs.data, farray, vertices.data, vmin, vmax)
+
+        # copy the vertex range, so that the group does not keep the growing buffer alive.
+        group = ObjGroup(
+            material=library.materials[material],
+            vertices=vertices.data[vmin:vmax].copy(),
+            faces=farray[:, :, 0].astype(np.uint32) - vmin - 1,
+            textureCoords=textures,
+            line_nb=group_line
+        )
+        faces.clear()
+        return group
+
+    with open(file_name, 'rb') as objfile:
+        tail = b''
+        while True:
+            chunk = objfile.read(chunk_size)
+            lines = (tail + chunk).split(b'\n')
+
+            # the last line may continue in the next chunk.
+            tail = lines.pop() if chunk else b''
+
+            for line in lines:
+                line_nb += 1
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+
+                label = fields[0]
+                if label == b'v':
+                    if len(fields) != 4:
+                        log.error('3 entries expected for vertex, line %d', line_nb)
+                        continue
+                    vbuf.append(fields[1:])
+
+                elif label == b'vt':
+                    if len(fields) != 3:
+                        log.error('2 entries expected for vertex texture, line %d', line_nb)
+                        continue
+                    tbuf.append(fields[1:])
+
+                elif label == b'f':
+                    if len(fields) == 4:
+                        fbuf.append(_face_indices(fields[1:]))
+                    elif len(fields) == 5:
+                        # converts quads into pairs of triangles.
+                        corners = [fields[1], fields[2], fields[3], fields[1], fields[3], fields[4]]
+                        indices = _face_indices(corners)
+                        half = len(indices) // 2
+                        fbuf.append(indices[:half])
+                        fbuf.append(indices[half:])
+                    else:
+                        log.error('3 or 4 entries expected for faces, line %d', line_nb)
+
+                elif label == b'usemtl':
+                    # a new material starts a new mesh, so we hand over the previous one if not empty.
+                    flush()
+                    if faces is not None and faces.size > 0:
+                        ngroups += 1
+                        yield close_group()
+                    material = library.names[fields[1].decode()]
+                    group_line = line_nb
+
+                elif label == b'mtllib':
+                    library = load_material_library(
+                        os.path.join(os.path.dirname(file_name), fields[1].decode()))
+
+            # move the parsed lines of this chunk to the typed arrays.
+            flush()
+
+            if not chunk:
+                break
+
+    flush()
+    if faces is not None and faces.size > 0:
+        ngroups += 1
+        yield close_group()
+
+    log.debug('File streamed. Found %d vertices and %d material groups.', vertices.size, ngroups)
+
+
+def stream_obj_file(file_name, chunk_size=1 << 22):
+    '''
+    Generator of the meshes of a Blender3D object file, each mesh is created once its material group is complete.
+    '''
+    for group in iter_obj_groups(file_name, chunk_size):
+        yield group.create_mesh()
+
+
+def load_obj_file_streaming(file_name, chunk_size=1 << 22):
+    '''
+    Drop-in replacement for blender.load_obj_file() using the streaming reader.
+    '''
+    return list(stream_obj_file(file_name, chunk_size))
+
+
+def write_synthetic_obj(directory, groups=100, size=40):
+    '''
+    Write a synthetic Blender file made of grid patches with one untextured material each, for benchmarking.
+    :return: the path to the .obj file
+    '''
+    mtl_name = os.path.join(directory, 'synthetic.mtl')
+    with open(mtl_name, 'w') as mtl:
+        for g in range(groups):
+            mtl.write('newmtl synthetic.{:03d}\nKa 1 1 1\nKd 0.8 0.8 0.8\nKs 0.5 0.5 0.5\nNs 100\n\n'.format(g))
+
+    obj_name = os.path.join(directory, 'synthetic.obj')
+    u, v = np.meshgrid(np.linspace(0., 1., size), np.linspace(0., 1., size))
+    cells = (np.arange(size - 1)[:, None] * size + np.arange(size - 1)[None, :]).ravel()
+    with open(obj_name, 'w') as obj:
+        obj.write('mtllib synthetic.mtl\n')
+        for g in range(groups):
+            base = g * size * size + 1
+            np.savetxt(obj, np.column_stack([u.ravel() + g, np.zeros(u.size), v.ravel()]), fmt='v %.6f %.6f %.6f')
+            np.savetxt(obj, np.column_stack([u.ravel(), v.ravel()]), fmt='vt %.6f %.6f')
+            obj.write('usemtl synthetic.{:03d}\n'.format(g))
+            quads = np.stack([cells, cells + 1, cells + size + 1, cells + size], axis=1) + base
+            np.savetxt(obj, np.repeat(quads, 2, axis=1), fmt='f %d/%d %d/%d %d/%d %d/%d')
+
+    return obj_name
+
+
+def _peak_rss(mode, file_name):
+    '''
+    Load the file with the given reader in a fresh interpreter and return its peak RSS in MB before and after.
+    '''
+    script = '''
+import resource, sys
+import blender, objstream, runtime
+base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+with runtime.quiet():
+    if sys.argv[1] == 'lists':
+        meshes = blender.load_obj_file(sys.argv[2])
+    elif sys.argv[1] == 'stream':
+        meshes = objstream.load_obj_file_streaming(sys.argv[2])
+    else:
+        for group in objstream.iter_obj_groups(sys.argv[2]):
+            pass
+print(base, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+    output = subprocess.run([sys.executable, '-c', script, mode, file_name], capture_output=True, text=True,
+                            check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    base, peak = output.split()[-2:]
+    # ru_maxrss is in kB on Linux.
+    return int(base) / 1024., int(peak) / 1024.
+
+
+def benchmark(groups=100, size=40):
+    '''
+    Compare the peak memory of the list-based reader and the streaming reader on a synthetic file.
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = write_synthetic_obj(directory, groups, size)
+        log.info('Synthetic file: %.1f MB, %d groups', os.path.getsize(file_name) / 2**20, groups)
+
+        for mode, label in (('lists', 'blender.load_obj_file'),
+                            ('stream', 'objstream.load_obj_file_streaming'),
+                            ('groups', 'objstream.iter_obj_groups')):
+            base, peak = _peak_rss(mode, file_name)
+            log.info('%-36s peak RSS %8.1f MB (%+.1f MB over imports)', label, peak, peak - base)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,317 @@
+# import requirements
+import time
+
+import numpy as np
+
+from collision import mesh_bounds
+from lights import depth_range
+from softrender import _clip_near
+
+# CPU profiler of the frame stages.
+from profiler import profiler
+
+from runtime import get_logger
+
+'''
+Occlusion culling against a software hierarchical depth buffer. A few large occluders, such as the houses of the
+street, are rasterized each frame into a low resolution depth buffer with vectorised NumPy code, and a pyramid is
+built from it in which each texel holds the farthest depth of the 2x2 texels below it. Each model is then tested
+before being drawn: the 8 corners of its bounding box are projected to the screen, and the model is occluded if the
+nearest corner is behind the farthest occluder depth over the pyramid texels covering its screen rectangle, which
+is one to four texels of the level where a texel is about the size of the rectangle.
+
+Depths are normalised device coordinates z, and pixels not covered by any occluder are at infinity, so that nothing
+is culled against them.
+'''
+
+log = get_logger(__name__)
+
+# the 8 corners of the unit cube, as weights of the min (0) and max (1) corners of a box.
+_CORNERS = np.array([[i & 1, (i >> 1) & 1, (i >> 2) & 1] for i in range(8)], dtype=np.float32)
+
+
+def _rasterize_depth(xy, z, width, height, tile=32, chunk=64):
+    '''
+    Rasterize the nearest depth of triangles in a depth buffer, conservatively: a pixel is only written where a
+    triangle covers it whole, with the farthest depth of the triangle over the pixel, so that a thin occluder crossing
+    a pixel does not hide what is seen beside it.
+    :param xy: (T,3,2) window coordinates of the triangle vertices, in pixels
+    :param z: (T,3) depths of the vertices
+    :return: the (height,width) depth buffer, infinity where no triangle covers a pixel
+    '''
+    depth = np.full((height, width), np.inf, dtype=np.float32)
+
+    # the edge functions and the depth are linear in the pixel coordinates, e = A x + B y + C, with the edges turned
+    # so that they are positive inside, as occluders are seen from both sides.
+    a, b, c = xy[:, 0], xy[:, 1], xy[:, 2]
+    A = np.stack([b[:, 1] - c[:, 1], c[:, 1] - a[:, 1], a[:, 1] - b[:, 1]], axis=1)
+    B = np.stack([c[:, 0] - b[:, 0], a[:, 0] - c[:, 0], b[:, 0] - a[:, 0]], axis=1)
+    C = np.stack([b[:, 0] * c[:, 1] - c[:, 0] * b[:, 1], c[:, 0] * a[:, 1] - a[:, 0] * c[:, 1],
+                  a[:, 0] * b[:, 1] - b[:, 0] * a[:, 1]], axis=1)
+    area = C.sum(axis=1)
+    keep = np.abs(area) > 1e-6
+    sign = np.sign(area[keep])[:, np.newaxis]
+    A, B, C = A[keep] * sign, B[keep] * sign, C[keep] * sign
+    area = np.abs(area[keep])
+    z = z[keep]
+    xy = xy[keep]
+    if xy.shape[0] == 0:
+        return depth
+
+    # depth plane, from the barycentric weights of the vertices.
+    ZA = (A * z).sum(axis=1) / area
+    ZB = (B * z).sum(axis=1) / area
+    ZC = (C * z).sum(axis=1) / area
+    edges = np.stack([A, B, C], axis=2).astype(np.float32)
+    plane = np.stack([ZA, ZB, ZC], axis=1).astype(np.float32)
+
+    # a linear function is smallest, or largest, at a corner of the pixel, half a pixel from the centre along x and y:
+    # the pixel is inside an edge if the edge function minus that margin is positive at its centre, and the depth
+    # plus the margin is the farthest depth over the pixel.
+    edges[:, :, 2] -= 0.5 * (np.abs(edges[:, :, 0]) + np.abs(edges[:, :, 1]))
+    plane[:, 2] += 0.5 * (np.abs(plane[:, 0]) + np.abs(plane[:, 1]))
+
+    low = np.floor(xy.min(axis=1)).astype(int) // tile
+    high = np.floor(xy.max(axis=1)).astype(int) // tile
+
+    for ty in range(0, (height + tile - 1) // tile):
+        for tx in range(0, (width + tile - 1) // tile):
+            ids = np.flatnonzero((low[:, 0] <= tx) & (high[:, 0] >= tx) & (low[:, 1] <= ty) & (high[:, 1] >= ty))
+            if ids.shape[0] == 0:
+                continue
+
+            x0 = tx * tile
+            y0 = ty * tile
+            w = min(tile, width - x0)
+            h = min(tile, height - y0)
+            px = np.tile(np.arange(x0, x0 + w, dtype=np.float32) + 0.5, h)
+            py = np.repeat(np.arange(y0, y0 + h, dtype=np.float32) + 0.5, w)
+
+            nearest = np.full(w * h, np.inf, dtype=np.float32)
+            for start in range(0, ids.shape[0], chunk):
+                k = ids[start:start + chunk]
+                e = edges[k]
+                p = plane[k]
+
+                # pixels inside all three edges, and in front of the far plane.
+                inside = np.ones((k.shape[0], w * h), dtype=bool)
+                for i in range(3):
+                    inside &= e[:, i, 0, np.newaxis] * px + e[:, i, 1, np.newaxis] * py + e[:, i, 2, np.newaxis] >= 0.
+                fragment = p[:, 0, np.newaxis] * px + p[:, 1, np.newaxis] * py + p[:, 2, np.newaxis]
+                inside &= fragment <= 1.
+                nearest = np.minimum(nearest, np.where(inside, fragment, np.inf).min(axis=0))
+
+            depth[y0:y0 + h, x0:x0 + w] = nearest.reshape(h, w)
+    return depth
+
+
+def depth_pyramid(depth):
+    '''
+    Build the hierarchical depth buffer of a depth buffer.
+    :return: the list of levels, from the full resolution to a single texel, each texel holding the farthest depth of
+    the texels it covers
+    '''
+    levels = [depth]
+    while max(depth.shape) > 1:
+        h, w = depth.shape
+        padded = np.full((h + h % 2, w + w % 2), np.inf, dtype=depth.dtype)
+        padded[:h, :w] = depth
+        depth = padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(axis=(1, 3))
+        levels.append(depth)
+    return levels
+
+
+class OcclusionCuller:
+    '''
+    Class to cull the models hidden behind occluders.
+    '''
+    def __init__(self, occluders=(), width=128, height=64, tile=16):
+        '''
+        :param occluders: the models rasterized as occluders, they are always drawn
+        :param width: the width of the depth buffer in pixels
+        :param height: the height of the depth buffer in pixels
+        :param tile: the size of the tiles the occluders are binned to
+        '''
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.enabled = True
+
+        self.occluders = []
+        for model in occluders:
+            self.add_occluder(model)
+
+        # local bounding boxes, by mesh.
+        self.bounds = {}
+
+        self.levels = []
+
+        # what the pyramid was rasterized for, compared each frame to build it again only when it changed.
+        self.key = None
+        self.rasterized = 0
+
+        # statistics of the last frame, and totals since the last report.
+        self.tested = 0
+        self.occluded = 0
+        self.elapsed = 0.
+        self.frames = 0
+        self.total_tested = 0
+        self.total_occluded = 0
+        self.total_elapsed = 0.
+
+    def add_occluder(self, model, triangles=None):
+        '''
+        Add an occluder.
+        :param model: the model of the occluder
+        :param triangles: [optional] (T,3,3) local triangles of a simplified occluder mesh, the model mesh is used if
+        None. They must lie inside the model so that the occluder does not hide what the model does not.
+        '''
+        if triangles is None:
+            faces = model.mesh.faces
+            if faces.shape[1] == 4:
+                faces = np.concatenate([faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]])
+            triangles = model.mesh.vertices[faces]
+        self.occluders.append((model, np.asarray(triangles, dtype=np.float32)))
+        self.key = None
+
+    def local_bounds(self, mesh):
+        bounds = self.bounds.get(id(mesh))
+        if bounds is None:
+            bounds = mesh_bounds(mesh.vertices, mesh.faces)
+            self.bounds[id(mesh)] = bounds
+        return bounds
+
+    def rasterize(self, P, V, parents=None):
+        '''
+        Rasterize the occluders and build the depth pyramid, unless the camera and the occluders have not moved since
+        the last pyramid was built.
+        :param parents: [optional] dictionary of the parent matrix of occluders, by model
+        '''
+        visible = []
+        for model, local in self.occluders:
+            if not model.visible:
+                continue
+            M = model.M if parents is None or model not in parents else np.matmul(parents[model], model.M)
+            visible.append((local, np.asarray(M, dtype=np.float32)))
+
+        key = np.concatenate([np.ravel(P), np.ravel(V)] + [np.ravel(M) for _, M in visible]).astype(np.float32)
+        if self.key is not None and np.array_equal(key, self.key):
+            return
+        self.key = key
+        self.rasterized += 1
+
+        triangles = []
+        for local, M in visible:
+            VM = np.matmul(V, M)
+            triangles.append(local @ VM[:3, :3].T + VM[:3, 3])
+
+        if triangles:
+            view = np.concatenate(triangles)
+            view, _, _ = _clip_near(view, np.zeros(view.shape[:2] + (2,)), depth_range(P)[0])
+
+            clip = view @ P[:3, :3].T + P[:3, 3]
+            w = -view[..., 2]
+            ndc = clip / w[..., np.newaxis]
+            xy = np.stack([(ndc[..., 0] + 1.) * 0.5 * self.width, (ndc[..., 1] + 1.) * 0.5 * self.height], axis=-1)
+            depth = _rasterize_depth(xy, ndc[..., 2], self.width, self.height, self.tile)
+        else:
+            depth = np.full((self.height, self.width), np.inf, dtype=np.float32)
+
+        self.levels = depth_pyramid(depth)
+
+    def occluded_mask(self, bounds_min, bounds_max, matrices, PV):
+        '''
+        Test boxes against the depth pyramid.
+        :param bounds_min: (N,3) min corners of the local bounding boxes
+        :param bounds_max: (N,3) max corners of the local bounding boxes
+        :param matrices: (N,4,4) model matrices
+        :param PV: the projection view matrix
+        :return: (N,) mask of the occluded boxes
+        '''
+        n = bounds_min.shape[0]
+        corners = bounds_min[:, np.newaxis] + _CORNERS * (bounds_max - bounds_min)[:, np.newaxis]
+        PVM = np.matmul(PV, matrices)
+        clip = np.einsum('nij,nkj->nki', PVM[:, :, :3], corners) + PVM[:, np.newaxis, :, 3]
+
+        # boxes crossing the near plane are kept, their projection is not bounded.
+        w = clip[..., 3]
+        testable = np.all(w > 1e-5, axis=1)
+        w = np.where(testable[:, np.newaxis], w, 1.)
+        ndc = clip[..., :3] / w[..., np.newaxis]
+
+        x0 = np.floor((ndc[..., 0].min(axis=1) + 1.) * 0.5 * self.width)
+        x1 = np.floor((ndc[..., 0].max(axis=1) + 1.) * 0.5 * self.width)
+        y0 = np.floor((ndc[..., 1].min(axis=1) + 1.) * 0.5 * self.height)
+        y1 = np.floor((ndc[..., 1].max(axis=1) + 1.) * 0.5 * self.height)
+        nearest = ndc[..., 2].min(axis=1)
+
+        # boxes off the screen are left to the clipping of the GPU.
+        testable &= (x1 >= 0) & (x0 < self.width) & (y1 >= 0) & (y0 < self.height)
+        x0 = np.clip(x0, 0, self.width - 1).astype(int)
+        x1 = np.clip(x1, 0, self.width - 1).astype(int)
+        y0 = np.clip(y0, 0, self.height - 1).astype(int)
+        y1 = np.clip(y1, 0, self.height - 1).astype(int)
+
+        # the level where the rectangle spans at most 2x2 texels.
+        size = np.maximum(x1 - x0, y1 - y0) + 1
+        level = np.minimum(np.ceil(np.log2(np.maximum(size, 1))).astype(int), len(self.levels) - 1)
+
+        farthest = np.full(n, -np.inf)
+        for l in np.unique(level[testable]):
+            k = np.flatnonzero(testable & (level == l))
+            texels = self.levels[l]
+            for x, y in ((x0[k], y0[k]), (x1[k], y0[k]), (x0[k], y1[k]), (x1[k], y1[k])):
+                farthest[k] = np.maximum(farthest[k], texels[y >> l, x >> l])
+
+        return testable & (nearest > farthest)
+
+    def cull(self, models, P, V):
+        '''
+        Remove the occluded models from a draw list, after rasterizing the occluders for this frame.
+        :param models: the list of (model, parent matrix) pairs to draw
+        :return: the list of the pairs which may be visible
+        '''
+        if not self.enabled:
+            return models
+
+        start = time.perf_counter()
+        with profiler.scope('occlusion'):
+            occluders = {model for model, _ in self.occluders}
+            self.rasterize(P, V, parents={model: Mp for model, Mp in models if model in occluders})
+
+            # occluders are not tested, as they cannot be hidden by themselves.
+            tested = [i for i, (model, _) in enumerate(models) if model not in occluders and model.visible]
+            occluded = np.zeros(len(tested), dtype=bool)
+            if tested:
+                bounds = [self.local_bounds(models[i][0].mesh) for i in tested]
+                matrices = np.matmul(np.array([models[i][1] for i in tested]), np.array([models[i][0].M for i in tested]))
+                occluded = self.occluded_mask(np.array([low for low, _ in bounds]), np.array([high for _, high in bounds]),
+                                              matrices, np.matmul(P, V))
+
+            keep = np.ones(len(models), dtype=bool)
+            keep[np.array(tested, dtype=int)[occluded]] = False
+            visible = [pair for pair, kept in zip(models, keep) if kept]
+
+        self.tested = len(tested)
+        self.occluded = int(np.count_nonzero(occluded))
+        self.elapsed = time.perf_counter() - start
+        self.frames += 1
+        self.total_tested += self.tested
+        self.total_occluded += self.occluded
+        self.total_elapsed += self.elapsed
+        profiler.count('occluded', self.occluded)
+        return visible
+
+    def report(self):
+        '''
+        Print the mean number of models tested and occluded, and the culling time per frame since the last report.
+        '''
+        frames = max(1, self.frames)
+        log.info('--> Occlusion culling: %.1f of %.1f models occluded per frame, %.3f ms per frame',
+                 self.total_occluded / frames, self.total_tested / frames, 1000. * self.total_elapsed / frames)
+        log.info('- depth pyramid rasterized in %d of %d frames', self.rasterized, self.frames)
+        self.frames = 0
+        self.rasterized = 0
+        self.total_tested = 0
+        self.total_occluded = 0
+        self.total_elapsed = 0.
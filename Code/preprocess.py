@@ -0,0 +1,294 @@
+# import requirements
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from blender import create_meshes_from_blender, fix_blender_textures
+from material import Material, MaterialLibrary
+from mesh import Mesh, calculate_normals
+
+from runtime import get_logger, quiet
+
+'''
+Parallel preprocessing of the meshes read from a Blender file. Each material group is independent once the file is
+parsed, so the texture welding and normal calculation are fanned out to a pool of worker processes. The vertex, UV
+and face arrays are passed to the workers through shared memory rather than pickled, and the workers write their
+results directly into shared output arrays which the Mesh objects then use without copying.
+'''
+
+log = get_logger(__name__)
+
+
+class _Pinned:
+    '''
+    Exposes a shared memory buffer through the numpy array interface while keeping a reference to its owner, so
+    that the memory cannot be unmapped while any array viewing it is still alive.
+    '''
+    def __init__(self, interface, owner):
+        self.__array_interface__ = interface
+        self.owner = owner
+
+
+class SharedArray:
+    '''
+    Class to hold a numpy array in a named shared memory segment.
+    '''
+    def __init__(self, shape, dtype, name=None):
+        '''
+        Create a new segment, or attach to an existing one if a name is given.
+        :param shape: the shape of the array
+        :param dtype: the numpy type of the array
+        :param name: [optional] the name of an existing segment to attach to
+        '''
+        self.shape = tuple(int(n) for n in shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+
+        # shared memory segments cannot be empty, so we always reserve at least one byte.
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        if self.owner:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.shm.buf)
+
+    @classmethod
+    def from_array(cls, data, dtype=None):
+        '''
+        Create a new segment holding a copy of the array.
+        '''
+        data = np.asarray(data, dtype=dtype)
+        shared = cls(data.shape, data.dtype)
+        shared.array[...] = data
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        '''
+        Attach to a segment described by spec(), typically in a worker process.
+        '''
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    def spec(self):
+        '''
+        Small picklable description of the segment.
+        '''
+        return self.shm.name, self.shape, self.dtype.str
+
+    def pinned(self):
+        '''
+        Returns a view of the array which keeps the segment mapped for as long as it, or any view taken from it,
+        is alive. Used to hand the data over to Mesh objects without copying.
+        '''
+        return np.asarray(_Pinned(self.array.__array_interface__, self))
+
+    def release(self):
+        '''
+        Close the segment, and remove it if we created it. Arrays from array must not be used afterwards.
+        '''
+        self.array = None
+        self.shm.close()
+        self.unlink()
+
+    def unlink(self):
+        '''
+        Remove the name of the segment, the memory stays valid for the processes which have it mapped.
+        '''
+        if self.owner:
+            self.owner = False
+            self.shm.unlink()
+
+
+# shared arrays attached once by each worker process.
+_shared = {}
+
+
+def _attach_shared(specs):
+    '''
+    Initialiser of the worker processes, attaches to all shared arrays.
+    '''
+    for key, spec in specs.items():
+        _shared[key] = SharedArray.attach(spec)
+
+
+def _preprocess_groups(tasks):
+    '''
+    Worker function, processes a batch of material groups and writes the results in the shared output arrays.
+    :param tasks: list of tuples (fstart, fend, vmin, vmax, voffset), with the face range of the group, its vertex
+    range in the file and the offset of its vertices in the output arrays.
+    '''
+    varray = _shared['vertices'].array
+    tarray = _shared['uvs'].array
+    farray = _shared['faces'].array
+
+    for fstart, fend, vmin, vmax, voffset in tasks:
+        faces = farray[fstart:fend]
+        local_faces = faces[:, :, 0] - vmin - 1
+        _shared['indices'].array[fstart:fend] = local_faces
+
+        textures = fix_blender_textures(tarray, faces, varray, vmin, vmax)
+        normals, tangents, binormals = calculate_normals(varray[vmin:vmax], local_faces, textures)
+
+        vrange = slice(voffset, voffset + vmax - vmin)
+        _shared['normals'].array[vrange] = normals
+        if textures is not None:
+            _shared['textureCoords'].array[vrange] = textures
+            _shared['tangents'].array[vrange] = tangents
+            _shared['binormals'].array[vrange] = binormals
+
+    return len(tasks)
+
+
+def group_ranges(farray, mesh_list):
+    '''
+    Find the face and vertex range of each material group.
+    :param farray: (F,3,k) array of Blender face indices
+    :param mesh_list: mesh id of each face, a new mesh starts each time it changes
+    :return: arrays fstart, fend, vmin, vmax, with the vertex range as 0-based [vmin, vmax[
+    '''
+    mesh_ids = np.asarray(mesh_list)
+    fstart = np.concatenate([[0], np.flatnonzero(np.diff(mesh_ids)) + 1])
+    fend = np.append(fstart[1:], mesh_ids.shape[0])
+
+    vertex_ids = farray[:, :, 0].astype(np.int64)
+    vmin = np.minimum.reduceat(vertex_ids.min(axis=1), fstart) - 1
+    vmax = np.maximum.reduceat(vertex_ids.max(axis=1), fstart)
+
+    return fstart, fend, vmin, vmax
+
+
+def create_meshes_parallel(vlist, flist, mlist, tlist, library, mesh_list, workers=None, batches_per_worker=4):
+    '''
+    Parallel version of blender.create_meshes_from_blender(), producing the same meshes.
+    :param workers: number of worker processes, all cores if None
+    :param batches_per_worker: number of task batches per worker, to balance groups of uneven sizes
+    :return: the list of meshes
+    '''
+    if workers is None:
+        workers = os.cpu_count()
+
+    farray = np.array(flist, dtype=np.uint32)
+    if farray.ndim == 2:
+        farray = farray[:, :, np.newaxis]
+
+    fstart, fend, vmin, vmax = group_ranges(farray, mesh_list)
+    vcount = vmax - vmin
+    voffset = np.concatenate([[0], np.cumsum(vcount)[:-1]])
+    has_uvs = farray.shape[2] > 1 and len(tlist) > 0
+
+    log.debug('Preprocessing %d mesh(es) using %d worker processes', fstart.shape[0], workers)
+
+    # the vertex positions stay in shared memory, the meshes view them directly.
+    shared = {
+        'vertices': SharedArray.from_array(vlist, dtype='f'),
+        'uvs': SharedArray.from_array(tlist if has_uvs else np.zeros((0, 2)), dtype='f'),
+        'faces': SharedArray.from_array(farray),
+        'indices': SharedArray((farray.shape[0], 3), np.uint32),
+        'normals': SharedArray((vcount.sum(), 3), 'f'),
+    }
+    if has_uvs:
+        for name, width in (('textureCoords', 2), ('tangents', 3), ('binormals', 3)):
+            shared[name] = SharedArray((vcount.sum(), width), 'f')
+
+    try:
+        tasks = list(zip(fstart.tolist(), fend.tolist(), vmin.tolist(), vmax.tolist(), voffset.tolist()))
+        nbatches = max(1, min(len(tasks), workers * batches_per_worker))
+        batches = [tasks[i::nbatches] for i in range(nbatches)]
+
+        specs = {key: array.spec() for key, array in shared.items()}
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared, initargs=(specs,)) as pool:
+            list(pool.map(_preprocess_groups, batches))
+
+    finally:
+        # the input arrays are not needed anymore, the output ones are pinned by the mesh views.
+        shared.pop('uvs').release()
+        shared.pop('faces').release()
+        for array in shared.values():
+            array.unlink()
+
+    views = {key: array.pinned() for key, array in shared.items()}
+
+    meshes = []
+    for g in range(fstart.shape[0]):
+        vrange = slice(voffset[g], voffset[g] + vcount[g])
+        meshes.append(Mesh(
+            vertices=views['vertices'][vmin[g]:vmax[g], :],
+            faces=views['indices'][fstart[g]:fend[g]],
+            normals=views['normals'][vrange],
+            textureCoords=views['textureCoords'][vrange] if has_uvs else None,
+            tangents=views['tangents'][vrange] if has_uvs else None,
+            binormals=views['binormals'][vrange] if has_uvs else None,
+            material=library.materials[mlist[fstart[g]]]
+        ))
+
+    log.debug('--- Created %d mesh(es) from Blender file.', len(meshes))
+    return meshes
+
+
+def synthetic_blender_model(groups=300, size=12):
+    '''
+    Build the parsed content of a synthetic Blender file, made of a number of independent grid patches each using
+    its own material, in the format produced by blender.load_obj_file().
+    :param groups: the number of material groups
+    :param size: the number of vertices along each side of a patch
+    :return: vlist, flist, mlist, tlist, library, mesh_list
+    '''
+    library = MaterialLibrary()
+    u, v = np.meshgrid(np.linspace(0., 1., size), np.linspace(0., 1., size))
+    uv = np.stack([u.ravel(), v.ravel()], axis=1)
+
+    # two triangles per grid cell, indices local to the patch.
+    cells = (np.arange(size - 1)[:, None] * size + np.arange(size - 1)[None, :]).ravel()
+    quads = np.stack([cells, cells + 1, cells + size + 1, cells + size], axis=1)
+    triangles = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+
+    vlist, tlist, flist, mlist, mesh_list = [], [], [], [], []
+    for g in range(groups):
+        library.add_material(Material('synthetic.{:03d}'.format(g), Kd=[0.8, 0.8, 0.8]))
+        base = g * uv.shape[0]
+        height = np.sin(uv[:, 0] * 6.28 + g) * 0.1
+        vlist.extend(np.column_stack([uv[:, 0] + g, height, uv[:, 1]]).tolist())
+        tlist.extend(uv.tolist())
+        idx = triangles + base + 1
+        flist.extend(np.stack([idx, idx], axis=2).tolist())
+        mlist.extend([g] * triangles.shape[0])
+        mesh_list.extend([g + 1] * triangles.shape[0])
+
+    return vlist, flist, mlist, tlist, library, mesh_list
+
+
+def benchmark(groups=300, size=12, max_workers=None, repeats=3):
+    '''
+    Measure the scaling of the mesh preprocessing from 1 to max_workers processes on a synthetic model.
+    '''
+    if max_workers is None:
+        max_workers = os.cpu_count()
+
+    vlist, flist, mlist, tlist, library, mesh_list = synthetic_blender_model(groups, size)
+    lnlist = [0] * len(flist)
+    log.info('Synthetic model: %d groups, %d vertices, %d faces', groups, len(vlist), len(flist))
+
+    serial = None
+    for workers in range(1, max_workers + 1):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            # silence the per-mesh output of the loaders while timing.
+            with quiet():
+                create_meshes_from_blender(vlist, flist, mlist, tlist, library, mesh_list, lnlist,
+                                           workers=workers)
+            timings.append(time.perf_counter() - start)
+
+        best = min(timings)
+        if serial is None:
+            serial = best
+        log.info('%2d worker(s): %8.3f s, speedup x%.2f', workers, best, serial / best)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,309 @@
+# import requirements
+import contextlib
+import json
+import time
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+CPU profiler of the stages of a frame. Stages are timed with nested named scopes:
+
+    with profiler.scope('draw'):
+        with profiler.scope('camera'):
+            ...
+
+The time spent in each stage is accumulated over the frame, keyed by its path in the scope tree (e.g. 'draw/camera'),
+and stored at the end of the frame in a ring buffer over the last frames, from which rolling statistics are computed.
+When the profiler is disabled, scope() returns a shared no-op context manager, so the scopes can stay in the code.
+'''
+
+log = get_logger(__name__)
+
+# the context manager returned by disabled profilers, it does nothing and is reused.
+_NULL_SCOPE = contextlib.nullcontext()
+
+
+class _Scope:
+    '''
+    Context manager timing one execution of a stage.
+    '''
+    __slots__ = ('profiler', 'name', 'column', 'start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.column = self.profiler._enter(self.name)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler._exit(self.column, time.perf_counter() - self.start)
+        return False
+
+
+class Profiler:
+    '''
+    Class to time nested stages over a window of frames.
+    '''
+    def __init__(self, frames=300, enabled=False, capacity=32):
+        '''
+        :param frames: the number of frames kept in the ring buffer
+        :param enabled: whether the profiler starts enabled
+        :param capacity: the initial number of stages, grown as needed
+        '''
+        self.enabled = enabled
+        self.frames = frames
+
+        # column of each stage path, in order of first use.
+        self.columns = {}
+        self.names = []
+
+        # time and number of calls of each stage in the current frame.
+        self.current = np.zeros(capacity)
+        self.calls = np.zeros(capacity, dtype=np.int64)
+
+        # ring buffer of the stage times of the past frames, NaN where a stage did not run.
+        self.history = np.full((frames, capacity), np.nan)
+        self.frame_count = 0
+
+        # stack of the columns of the open scopes.
+        self.stack = []
+
+        # ring buffers of counters recorded once per frame, such as GPU pipeline statistics.
+        self.counters = {}
+
+        # cached overlay image, re-rendered periodically.
+        self.overlay = None
+        self.font = None
+
+    def scope(self, name):
+        '''
+        Returns a context manager timing a stage, nested within the open scopes.
+        '''
+        if not self.enabled:
+            return _NULL_SCOPE
+        return _Scope(self, name)
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        self.stack = []
+        self.current[:] = 0.
+        self.calls[:] = 0
+
+    def _column(self, path):
+        column = self.columns.get(path)
+        if column is None:
+            column = len(self.names)
+            if column == self.current.shape[0]:
+                self._grow(2 * column)
+            self.columns[path] = column
+            self.names.append(path)
+        return column
+
+    def _grow(self, capacity):
+        extra = capacity - self.current.shape[0]
+        self.current = np.append(self.current, np.zeros(extra))
+        self.calls = np.append(self.calls, np.zeros(extra, dtype=np.int64))
+        self.history = np.hstack([self.history, np.full((self.frames, extra), np.nan)])
+
+    def _enter(self, name):
+        path = self.names[self.stack[-1]] + '/' + name if self.stack else name
+        column = self._column(path)
+        self.stack.append(column)
+        return column
+
+    def _exit(self, column, elapsed):
+        self.current[column] += elapsed
+        self.calls[column] += 1
+        self.stack.pop()
+
+    def add(self, path, elapsed):
+        '''
+        Add a duration measured outside of a scope to a stage of the current frame, e.g. a GPU timing read back.
+        :param path: the full path of the stage
+        :param elapsed: the duration in seconds
+        '''
+        if not self.enabled:
+            return
+        column = self._column(path)
+        self.current[column] += elapsed
+        self.calls[column] += 1
+
+    def count(self, name, value):
+        '''
+        Record the value of a counter for the current frame.
+        '''
+        if not self.enabled:
+            return
+        if name not in self.counters:
+            self.counters[name] = [np.full(self.frames, np.nan), 0]
+        history, count = self.counters[name]
+        history[count % self.frames] = value
+        self.counters[name][1] = count + 1
+
+    def end_frame(self):
+        '''
+        Store the stage times of the frame in the ring buffer and start a new frame.
+        '''
+        if not self.enabled:
+            return
+        row = self.history[self.frame_count % self.frames]
+        row[:] = np.where(self.calls > 0, self.current, np.nan)
+        self.frame_count += 1
+        self.current[:] = 0.
+        self.calls[:] = 0
+
+    def times(self):
+        '''
+        The stage times in seconds of the frames in the ring buffer, oldest first, as a (frames, stages) array.
+        '''
+        history = self.history[:, :len(self.names)]
+        if self.frame_count <= self.frames:
+            return history[:self.frame_count]
+        return np.roll(history, -(self.frame_count % self.frames), axis=0)
+
+    def summary(self):
+        '''
+        Rolling statistics of each stage over the frames in the ring buffer, in milliseconds.
+        :return: a dictionary of stage path to a dictionary of statistics
+        '''
+        times = 1000. * self.times()
+        summary = {}
+        for column, name in enumerate(self.names):
+            values = times[:, column]
+            values = values[~np.isnan(values)]
+            if values.shape[0] == 0:
+                continue
+            summary[name] = {
+                'frames': int(values.shape[0]),
+                'min': float(values.min()),
+                'mean': float(values.mean()),
+                'p95': float(np.percentile(values, 95)),
+                'p99': float(np.percentile(values, 99)),
+            }
+        return summary
+
+    def counter_summary(self):
+        '''
+        Rolling statistics of each counter over the frames in its ring buffer.
+        '''
+        summary = {}
+        for name, (history, count) in self.counters.items():
+            values = history[:min(count, self.frames)]
+            summary[name] = {
+                'frames': int(values.shape[0]),
+                'min': float(values.min()),
+                'mean': float(values.mean()),
+                'p95': float(np.percentile(values, 95)),
+                'p99': float(np.percentile(values, 99)),
+            }
+        return summary
+
+    def lines(self):
+        '''
+        The statistics as lines of text, with the stages indented by their depth.
+        '''
+        lines = ['{:32s} {:>8s} {:>8s} {:>8s} {:>8s}'.format('stage (ms)', 'min', 'mean', 'p95', 'p99')]
+        for name, stats in self.summary().items():
+            label = '  ' * name.count('/') + name.rsplit('/', 1)[-1]
+            lines.append('{:32s} {:8.3f} {:8.3f} {:8.3f} {:8.3f}'.format(
+                label, stats['min'], stats['mean'], stats['p95'], stats['p99']))
+        for name, stats in self.counter_summary().items():
+            lines.append('{:32s} {:8.0f} {:8.0f} {:8.0f} {:8.0f}'.format(
+                name, stats['min'], stats['mean'], stats['p95'], stats['p99']))
+        return lines
+
+    def report(self):
+        '''
+        Print the statistics.
+        '''
+        log.info('--> Profile of the last %d frames', min(self.frame_count, self.frames))
+        for line in self.lines():
+            log.info(line)
+
+    def export_csv(self, file_name):
+        '''
+        Save the stage times of the frames in the ring buffer, one row per frame, in milliseconds.
+        '''
+        times = 1000. * self.times()
+        with open(file_name, 'w') as file:
+            file.write(','.join(['frame'] + self.names) + '\n')
+            first = max(0, self.frame_count - self.frames)
+            for index, row in enumerate(times):
+                file.write(','.join([str(first + index)] + ['' if np.isnan(t) else '{:.4f}'.format(t) for t in row]) + '\n')
+
+    def export_json(self, file_name):
+        '''
+        Save the statistics and the stage times of the frames in the ring buffer, in milliseconds.
+        '''
+        times = 1000. * self.times()
+        with open(file_name, 'w') as file:
+            json.dump({
+                'stages': self.summary(),
+                'counters': self.counter_summary(),
+                'frames': [{name: float(t) for name, t in zip(self.names, row) if not np.isnan(t)} for row in times],
+            }, file, indent=1)
+
+    def draw_overlay(self, window_size, refresh=30):
+        '''
+        Draw the statistics over the frame, in the top left corner. The text is rendered with pygame and copied to
+        the frame buffer with glDrawPixels, it is only re-rendered every few frames.
+        :param window_size: the size of the window in pixels
+        :param refresh: the number of frames between updates of the text
+        '''
+        if not self.enabled:
+            return
+
+        import pygame
+        from glbackend import gl
+
+        if self.overlay is None or self.frame_count % refresh == 0:
+            if self.font is None:
+                pygame.font.init()
+                self.font = pygame.font.SysFont('monospace', 14)
+            lines = [self.font.render(line, True, (255, 255, 255)) for line in self.lines()]
+            height = self.font.get_linesize()
+            surface = pygame.Surface((max(line.get_width() for line in lines) + 8, height * len(lines) + 8),
+                                     pygame.SRCALPHA)
+            surface.fill((0, 0, 0, 160))
+            for index, line in enumerate(lines):
+                surface.blit(line, (4, 4 + index * height))
+            self.overlay = (surface.get_width(), surface.get_height(), pygame.image.tostring(surface, 'RGBA', True))
+
+        width, height, pixels = self.overlay
+        gl.glUseProgram(0)
+        gl.glDisable(gl.GL_DEPTH_TEST)
+        gl.glEnable(gl.GL_BLEND)
+        gl.glBlendFunc(gl.GL_SRC_ALPHA, gl.GL_ONE_MINUS_SRC_ALPHA)
+        gl.glWindowPos2i(0, max(0, window_size[1] - height))
+        gl.glDrawPixels(width, height, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, pixels)
+        gl.glDisable(gl.GL_BLEND)
+        gl.glEnable(gl.GL_DEPTH_TEST)
+
+
+# the profiler used by the scene and the models.
+profiler = Profiler()
+
+
+def benchmark(scopes=100000):
+    '''
+    Measure the cost of a scope when the profiler is disabled and enabled.
+    '''
+    test = Profiler()
+    for enabled in (False, True):
+        test.enable(enabled)
+        start = time.perf_counter()
+        for _ in range(scopes):
+            with test.scope('stage'):
+                pass
+        elapsed = time.perf_counter() - start
+        test.end_frame()
+        log.info('%s: %.3f us per scope', 'enabled' if enabled else 'disabled', 1e6 * elapsed / scopes)
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -1,3 +1,5 @@
+import sys
+
 # Imports pygame
 import pygame
 
@@ -16,38 +18,272 @@ from BaseModel import DrawModelFromMesh
 # Import everything from the shaders
 from shaders import *
 
+# Import the buffer arena shared by all models of the scene
+from bufferarena import BufferArena
+
+# Import the keyframe animation system
+from animation import Animator, quaternionFromAxisAngle
+
+# Import the traffic simulation
+from traffic import TrafficSimulation, lanes_from_road
+
+# Import the collision detection
+from collision import CollisionWorld, mesh_bounds
+
+# Import the shadow map with a cache of the static casters
+from shadows import ShadowMap
+
+# Import the occlusion culling
+from occlusion import OcclusionCuller
+
+# Import the texture streaming
+from texstream import texture_streamer
+
+# Import the streaming of the city around the street
+from worldstream import WorldStreamer, city_layout
+
+# Import the frame profiler
+from profiler import profiler
+
+# Import the leveled logging of the runtime profile
+from runtime import get_logger
+
+log = get_logger(__name__)
+
 
 '''
 Declaring an object of the scene class.
 '''
 class ProjectScene(Scene):
-    def __init__(self):
-        Scene.__init__(self)
+    def __init__(self, city=None, **kwargs):
+        '''
+        :param city: [optional] the (columns, rows) of a city of copies of the street around the first one, streamed
+        in chunks around the camera
+        '''
+        Scene.__init__(self, **kwargs)
 
         # Load a light source object representing the sun values other than position left at default.
         self.light = LightSource(self, position=[5., 3., -5.])
         
+        # Store the vertex data of all models in a few large buffers rather than a set of buffers per model.
+        self.arena = BufferArena()
+
+        # Stream the textures from low to high resolution rather than loading them before the first frame.
+        texture_streamer.enable()
+
         # Load the car obj file as an object by drawing each model as a mesh.
         car1 = load_obj_file('models/car2.obj')
-        self.car1 = [DrawModelFromMesh(scene=self, M=translationMatrix([5.5,-4.4,16]), mesh=mesh, shader=FlatShader()) for mesh in car1]
+        self.car_meshes = car1
+        self.car1 = [DrawModelFromMesh(scene=self, M=translationMatrix([5.5,-4.4,16]), mesh=mesh, shader=ClusteredShader(), arena=self.arena) for mesh in car1]
 
         # Same for the street obj file.
         street = load_obj_file('models/test.obj')
-        self.street = [DrawModelFromMesh(scene=self, M=translationMatrix([0,-5,-10]), mesh=mesh, shader=FlatShader()) for mesh in street]
+        self.street = [DrawModelFromMesh(scene=self, M=translationMatrix([0,-5,-10]), mesh=mesh, shader=ClusteredShader(), arena=self.arena) for mesh in street]
+
+        self.arena.report()
+
+        # Detect the car running into the houses and trees, the ground under it is left out.
+        self.collisions = CollisionWorld()
+        bounds = [mesh_bounds(mesh.vertices, mesh.faces) for mesh in car1]
+        self.collisions.add(self.car1[0], bounds=(np.min([low for low, _ in bounds], axis=0), np.max([high for _, high in bounds], axis=0)))
+        for model in self.tall_models(self.street):
+            self.collisions.add(model)
+
+        # Animates the car along the street when pressing a.
+        self.animator = Animator()
+        self.driving = False
+
+        # Traffic of cars driving round the street, toggled by pressing t.
+        self.traffic = None
+        self.traffic_models = []
+
+        # Shadows of the sun over the street, toggled by pressing h. The street is static, only the cars are drawn in the
+        # shadow map each frame.
+        self.shadows = ShadowMap(self.light, center=[6.5, -2.5, -12.], extent=40.)
+
+        # The houses and trees hide the cars behind them, toggled by pressing o. The flat road and grass hide nothing.
+        self.occlusion = OcclusionCuller(self.tall_models(self.street))
+
+        # Street lights and car headlights, toggled by pressing l.
+        self.street_lights = None
+        self.headlights = np.zeros(0, dtype=int)
+
+        # Copies of the street around this one, loaded as the camera moves.
+        if city is not None:
+            self.world = WorldStreamer(self, city_layout(*city))
+
+    def tall_models(self, models, height=1.):
+        '''
+        The models whose mesh is at least a given height, such as the houses and trees of the street, rather than the
+        flat road and grass.
+        '''
+        tall = []
+        for model in models:
+            low, high = mesh_bounds(model.mesh.vertices, model.mesh.faces)
+            if high[1] - low[1] >= height:
+                tall.append(model)
+        return tall
+
+    def road_lanes(self):
+        '''
+        The lanes following the road surface of the street model, at the height of the car.
+        '''
+        road = [model for model in self.street if model.mesh.material.texture == 'Road_Surface.png'][0]
+        return lanes_from_road(road.mesh.vertices, M=road.M, y=-4.4)
+
+    def toggle_traffic(self, count=12):
+        '''
+        Start or stop a traffic simulation on the road of the street model.
+        '''
+        if self.traffic is not None:
+            self.traffic = None
+            return
+
+        # the traffic steps with the scene, at its timestep.
+        self.traffic = TrafficSimulation(self.road_lanes(), count, dt=self.timestep)
+
+        # the car meshes are drawn once per vehicle, with the vehicle transform as parent matrix.
+        if not self.traffic_models:
+            self.traffic_models = [DrawModelFromMesh(scene=self, M=poseMatrix(), mesh=mesh, shader=ClusteredShader(), arena=self.arena) for mesh in self.car_meshes]
+
+    def toggle_lights(self, spacing=6.):
+        '''
+        Switch on or off street lights along the road, and the headlights of the cars.
+        :param spacing: the distance between street lights along the road
+        '''
+        self.lights.clear()
+        self.headlights = np.zeros(0, dtype=int)
+        if self.street_lights is not None:
+            self.street_lights = None
+            return
+
+        # the lights stand beside the lanes, on the right of the direction of travel.
+        lanes = self.road_lanes()
+        lane = np.repeat(np.arange(lanes.count), np.ceil(lanes.length / spacing).astype(int))
+        s = np.concatenate([np.arange(0., length, spacing) for length in lanes.length])
+        position, direction = lanes.locate(lane, s)
+        right = np.column_stack([-direction[:, 2], np.zeros(lane.shape[0]), direction[:, 0]])
+        self.street_lights = self.lights.add(position + 3. * right + [0., 3.5, 0.], [4., 3.2, 2.], 7.)
+        self.update_headlights()
+
+    def headlight_positions(self):
+        '''
+        The positions of two headlights in front of the car and of each vehicle of the traffic.
+        '''
+        transforms = [self.car1[0].M[np.newaxis]]
+        if self.traffic is not None:
+            transforms.append(self.traffic.transforms())
+        transforms = np.concatenate(transforms)
+
+        # the car models face -Z in their own frame.
+        lamps = np.array([[-0.7, 0.7, -2.6, 1.], [0.7, 0.7, -2.6, 1.]], dtype='f')
+        return np.einsum('nij,lj->nli', transforms[:, :3], lamps).reshape(-1, 3)
+
+    def capture_state(self):
+        '''
+        The headlights follow the cars, so their positions are taken with the snapshots of the simulation.
+        '''
+        if self.street_lights is None:
+            return {}
+        return {'headlights': self.headlight_positions()}
+
+    def update_headlights(self):
+        '''
+        Place the headlights where the cars are, in the snapshot being drawn if the simulation runs on its own thread.
+        '''
+        if self.street_lights is None:
+            return
+
+        if self.snapshot is None:
+            positions = self.headlight_positions()
+        else:
+            positions = self.snapshot.state.get('headlights')
+            if positions is None:
+                return
+
+        if positions.shape[0] != self.headlights.shape[0]:
+            self.lights.remove(self.headlights)
+            self.headlights = self.lights.add(positions, [3., 3., 2.7], 5.)
+        else:
+            self.lights.set_positions(self.headlights, positions)
+
+    def shadow_casters(self):
+        '''
+        The street and the chunks of the city cast static shadows, the car and the traffic dynamic ones.
+        '''
+        identity = poseMatrix()
+        static = [(model, identity) for model in self.street]
+        if self.world is not None:
+            static += self.world.draw_list()
+        ids = set(id(model) for model, _ in static)
+        dynamic = [(model, Mp) for model, Mp in self.draw_list() if id(model) not in ids]
+        return static, dynamic
+
+    def check_collisions(self):
+        '''
+        Report what the car overlaps at its current position.
+        '''
+        for a, b in self.collisions.colliding_models():
+            if a is self.car1[0] or b is self.car1[0]:
+                obstacle = b if a is self.car1[0] else a
+                log.info('### Car collides with %s (%s) ###', obstacle.mesh.material.name, obstacle.mesh.material.texture)
+
+    def drive_car(self):
+        '''
+        Start or stop a looping animation of the car driving down the street, turning round and driving back.
+        '''
+        self.driving = not self.driving
+        for model in self.car1:
+            if not self.driving:
+                self.animator.stop(model)
+            elif model in self.animator.targets:
+                self.animator.play(model)
+            else:
+                self.animator.add_clip(
+                    model,
+                    times=[0., 4., 5., 9., 10.],
+                    positions=[[5.5,-4.4,16], [5.5,-4.4,-16], [10,-4.4,-16], [10,-4.4,16], [5.5,-4.4,16]],
+                    rotations=[quaternionFromAxisAngle([0,1,0], angle) for angle in [0., 0., np.pi, np.pi, 2*np.pi]],
+                    start=self.time
+                )
 
     def keyboard(self, event):
         '''
         Process keyboard events for this demo.
         '''
         Scene.keyboard(self, event)
-        
+
+        # teleporting the car with keys 0-9 stops its animation.
+        if pygame.K_0 <= event.key <= pygame.K_9 and self.driving:
+            self.drive_car()
+
+        if event.key == pygame.K_a:
+            log.debug('### Toggling Animation ###')
+            self.drive_car()
+
+        elif event.key == pygame.K_t:
+            log.debug('### Toggling Traffic ###')
+            self.toggle_traffic()
+
+        elif event.key == pygame.K_h:
+            log.debug('### Toggling Shadows ###')
+            self.shadows_enabled = not self.shadows_enabled
+
+        elif event.key == pygame.K_o:
+            log.debug('### Toggling Occlusion Culling ###')
+            self.occlusion.enabled = not self.occlusion.enabled
+            self.occlusion.report()
+
+        elif event.key == pygame.K_l:
+            log.debug('### Toggling Lights ###')
+            self.toggle_lights()
+
         '''
         Handle keys 0-9 that translate and rotate the car.
         '''
         if event.key == pygame.K_1:
-            # print what is happening.
-            print('########################')
-            print('### Applying Translation ###')
+            # log what is happening.
+            log.debug('### Applying Translation ###')
 
             # iterate through each model in the car object.
             for model in self.car1:
@@ -57,79 +293,113 @@ class ProjectScene(Scene):
         
         # repeat for the rest using different positions and rotations.
         elif event.key == pygame.K_2:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = translationMatrix([5.5,-4.4,0])
         elif event.key == pygame.K_3:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = translationMatrix([5.5,-4.4,-8])
         elif event.key == pygame.K_4:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = translationMatrix([5.5,-4.4,-16])
         elif event.key == pygame.K_5:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
 
                 # calculate the overall position matrix with the translation matrix and rotation matrix of pi radians.
                 model.M = np.matmul(translationMatrix([10,-4.4,-16]), rotationMatrixY(np.pi))
         elif event.key == pygame.K_6:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = np.matmul(translationMatrix([10,-4.4,-8]), rotationMatrixY(np.pi))
         elif event.key == pygame.K_7:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = np.matmul(translationMatrix([10,-4.4,0]), rotationMatrixY(np.pi))
         elif event.key == pygame.K_8:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = np.matmul(translationMatrix([10,-4.4,8]), rotationMatrixY(np.pi))
         elif event.key == pygame.K_9:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = np.matmul(translationMatrix([10,-4.4,16]), rotationMatrixY(np.pi))
         elif event.key == pygame.K_0:
-            print('########################')
-            print('### Applying Translation ###')
+            log.debug('### Applying Translation ###')
             for model in self.car1:
                 model.M = translationMatrix([5.5,-4.4,16])
 
+        if pygame.K_0 <= event.key <= pygame.K_9:
+            self.check_collisions()
+
+
+    def update(self, dt):
+        '''
+        Advance the animation and the traffic by one simulation step.
+        '''
+        # evaluate the animation tracks.
+        if self.driving:
+            self.animator.update(self.time + dt)
+            self.invalidate()
+
+        # step the traffic simulation.
+        if self.traffic is not None:
+            self.traffic.step()
+            self.invalidate()
+
+    def draw_list(self):
+        '''
+        The car and street models, and the car models once for each vehicle of the traffic with the vehicle
+        transform as parent matrix.
+        '''
+        identity = poseMatrix()
+        models = [(model, identity) for model in self.car1 + self.street]
+        if self.world is not None:
+            models += self.world.draw_list()
+        if self.traffic is not None:
+            for M in self.traffic.transforms():
+                models += [(model, M) for model in self.traffic_models]
+        return models
 
     def draw(self):
         '''
         Draw all models in the scene
         '''
         # clear the scene and the depth buffer.
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
 
-        # update camera.
-        self.camera.update()
+        # update camera, a snapshot brings its own.
+        if self.snapshot is None:
+            with profiler.scope('camera'):
+                self.camera.update()
 
-        # draw each model in the car object.
-        for model in self.car1:
-            model.draw()
-        
-        # and draw each model in the street object as well.
-        for model in self.street:
-            model.draw()
+        # load the chunks of the city around the camera, render the shadow map and fill the uniform blocks once for all
+        # the draws of the frame, with the headlights where the cars are.
+        self.stream_world()
+        self.render_shadows()
+        self.update_headlights()
+        self.update_uniform_blocks()
+
+        # draw the car, the street and the traffic which may be visible, after streaming their textures.
+        visible = self.cull(self.frame_draw_list())
+        self.stream_textures(visible)
+        self.draw_models(visible)
+
+        # draw the profiler statistics over the scene if enabled.
+        profiler.draw_overlay(self.window_size)
 
         # display the scene, uses double buffering so draw on different buffer to one displayed and flip.
-        pygame.display.flip()
+        self.flip()
 
 
 if __name__ == '__main__':
-    # initialise the scene object.
-    scene = ProjectScene()
+    # initialise the scene object, only redrawing when something changes and at most at 60 frames per second.
+    scene = ProjectScene(max_fps=60, on_demand=True)
 
-    # start drawing the scene.
-    scene.run()
+    # start drawing the scene, with the simulation on its own thread if asked.
+    if '--threaded' in sys.argv:
+        scene.run_threaded()
+    else:
+        scene.run()
@@ -0,0 +1,58 @@
+# import requirements
+import contextlib
+import logging
+import os
+import sys
+
+import OpenGL
+
+'''
+Runtime profile of the scene, chosen with the SCENE_PROFILE environment variable or the --debug command line flag.
+The 'release' profile, the default, turns off PyOpenGL's error checking after every call and its logging, and only
+shows log messages of level INFO and above. The 'debug' profile shows all messages, and instead of checking every
+call it reads glGetError() once per frame, see glbackend.check_errors(). PyOpenGL reads its flags when OpenGL.GL is
+imported, so this module must be imported first, which glbackend does.
+'''
+
+PROFILES = ('release', 'debug')
+
+PROFILE = 'debug' if '--debug' in sys.argv else os.environ.get('SCENE_PROFILE', 'release')
+if PROFILE not in PROFILES:
+    raise ValueError('Unknown runtime profile {}, expected one of {}'.format(PROFILE, PROFILES))
+
+DEBUG = PROFILE == 'debug'
+
+# errors are checked once per frame in debug, so the per call checks are off in both profiles.
+OpenGL.ERROR_CHECKING = False
+OpenGL.ERROR_LOGGING = False
+OpenGL.FULL_LOGGING = False
+
+# the size of the arrays passed to GL is only checked when debugging.
+OpenGL.ARRAY_SIZE_CHECKING = DEBUG
+
+# messages are formatted only if their level is enabled, e.g. log.debug('%d faces', n).
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG if DEBUG else logging.INFO,
+                    format='%(levelname).1s %(name)s: %(message)s')
+
+# PyOpenGL's own messages, such as the array conversions, are only shown when debugging.
+if not DEBUG:
+    logging.getLogger('OpenGL').setLevel(logging.WARNING)
+
+
+def get_logger(name):
+    '''
+    Returns the logger of a module, e.g. log = get_logger(__name__).
+    '''
+    return logging.getLogger(name)
+
+
+@contextlib.contextmanager
+def quiet(level=logging.INFO):
+    '''
+    Context in which the messages up to a level are not logged, e.g. to time the loaders without their output.
+    '''
+    logging.disable(level)
+    try:
+        yield
+    finally:
+        logging.disable(logging.NOTSET)
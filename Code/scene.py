@@ -1,8 +1,11 @@
+import threading
+import time
+
 # pygame is just used to create a window with the operating system on which to draw.
 import pygame
 
 # imports all openGL functions
-from OpenGL.GL import *
+from glbackend import gl, use, backend, RecordingBackend, check_errors
 
 # import the shader class
 from shaders import *
@@ -15,13 +18,52 @@ from matutils import *
 
 from lightSource import LightSource
 
+# frame pacing and statistics of the main loop
+from timing import FramePacer, FrameStats
+
+# CPU profiler of the frame stages
+from profiler import profiler
+
+# GPU timings and pipeline statistics, reported with the CPU profile
+from gpuprofiler import gpu_profiler
+
+# uniform blocks shared by the shader programs
+from uniformblocks import FrameUniforms, MaterialTable
+
+# clustered point lights
+from lights import LightManager
+
+# asynchronous capture of the frames
+from capture import FrameCapture
+
+# recording and replay of the user input
+from inputrecord import InputRecorder, InputReplay, save_frame_times
+
+# progressive streaming of the textures
+from texstream import texture_streamer
+
+# recorded commands of the model draws
+from commandlist import CommandList
+
+# simulation on its own thread
+from simthread import SimulationThread
+
+# leveled logging of the runtime profile
+from runtime import get_logger
+
+log = get_logger(__name__)
+
 class Scene:
     '''
     This is the main class for drawing an OpenGL scene using the PyGame library
     '''
-    def __init__(self, width=1800, height=960, shaders='None'):
+    def __init__(self, width=1800, height=960, shaders='None', timestep=1./60., max_fps=None, on_demand=False, headless=False):
         '''
         Initialise the scene
+        :param timestep: the fixed duration of a simulation step, in seconds
+        :param max_fps: [optional] the maximum frame rate
+        :param on_demand: whether to redraw only when the scene has been invalidated
+        :param headless: whether to run without a window, the GL calls then go to a no-op recording backend
         '''
 
         # define the size of the pygame window as the given width and height.
@@ -30,24 +72,29 @@ class Scene:
         #  wireframe mode disabled by default.
         self.wireframe = False
 
-        # initialise the pygame window.
+        # initialise the pygame window, or record the GL calls without any window.
         pygame.init()
-        screen = pygame.display.set_mode(self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
+        self.headless = headless
+        if headless:
+            if not isinstance(backend(), RecordingBackend):
+                use(RecordingBackend())
+        else:
+            screen = pygame.display.set_mode(self.window_size, pygame.OPENGL | pygame.DOUBLEBUF, 24)
 
         # initialise the window in OpenGL.
-        glViewport(0, 0, self.window_size[0], self.window_size[1])
+        gl.glViewport(0, 0, self.window_size[0], self.window_size[1])
 
         # set the background colour, this corresponds to a light blue for a sky appearance.
-        glClearColor(0.1, 0.7, 1.0, 1.0)
+        gl.glClearColor(0.1, 0.7, 1.0, 1.0)
 
         # enable back face culling.
-        glEnable(GL_CULL_FACE)
+        gl.glEnable(gl.GL_CULL_FACE)
 
         # enable vertex array capability.
-        glEnableClientState(GL_VERTEX_ARRAY)
+        gl.glEnableClientState(gl.GL_VERTEX_ARRAY)
 
         # enable depth test for clean output.
-        glEnable(GL_DEPTH_TEST)
+        gl.glEnable(gl.GL_DEPTH_TEST)
 
         # set the default shader program, flat as default because it is the fastest.
         self.shaders = 'flat'
@@ -75,9 +122,95 @@ class Scene:
         # rendering mode for the shaders.
         self.mode = 1
 
+        # uniform blocks shared by all programs, with the camera and light of the frame and the materials table.
+        self.frame_uniforms = FrameUniforms()
+        self.materials = MaterialTable()
+
+        # point lights in addition to the main light, drawn by the clustered shader.
+        self.lights = LightManager(self.P, self.window_size)
+
+        # occlusion culling of the draw list, scenes with large occluders create it.
+        self.occlusion = None
+
+        # shadow map of the main light, scenes with shadows create it.
+        self.shadows = None
+        self.shadows_enabled = True
+
+        # chunks of a world streamed around the camera, scenes with a large world create it.
+        self.world = None
+
         # list of models to draw in the scene.
         self.models = []
 
+        # the model draws are recorded once into a command list and replayed each frame.
+        self.commands = CommandList()
+        self.commands_enabled = True
+
+        # the simulation advances by fixed steps, independently of the rendering.
+        self.timestep = timestep
+        self.time = 0.
+
+        # in render on demand mode, a frame is only drawn when something has invalidated the scene.
+        self.on_demand = on_demand
+        self.dirty = True
+        self.pacer = FramePacer(max_fps)
+        self.stats = FrameStats()
+
+        # capture of the rendered frames, started from the keyboard.
+        self.capture = FrameCapture(self.window_size)
+
+        # input recorder, while recording, and last relative mouse movement while dragging.
+        self.recorder = None
+        self.mouse_mvt = None
+
+        # the profiler is toggled from the keyboard at the end of the frame.
+        self.profiler_toggled = False
+
+        # when the simulation runs on its own thread, the lock guards the scene state shared with it, and the frames
+        # are drawn from its snapshots.
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+    def invalidate(self):
+        '''
+        Mark the scene as needing to be redrawn, e.g. after input, animation, a camera move or loading an asset.
+        '''
+        self.dirty = True
+
+    def update(self, dt):
+        '''
+        Advance the simulation by one fixed step, to be overridden by scenes with moving content. Scenes which change
+        should call invalidate() so that the change is drawn in render on demand mode.
+        :param dt: the duration of the step, in seconds
+        '''
+        pass
+
+    def draw_list(self):
+        '''
+        The models to draw, with the model matrix of their parent.
+        :return: a list of (model, parent matrix) pairs
+        '''
+        models = [(model, poseMatrix()) for model in self.models]
+        if self.world is not None:
+            models += self.world.draw_list()
+        return models
+
+    def capture_state(self):
+        '''
+        State of the simulation to add to the snapshots drawn by the render thread, other than the camera, the light
+        and the draw list, to be overridden by scenes which update such state.
+        :return: a dict of copies of the state
+        '''
+        return {}
+
+    def frame_draw_list(self):
+        '''
+        The draw list of the frame, from the snapshot being drawn when the simulation runs on its own thread.
+        '''
+        if self.snapshot is None:
+            return self.draw_list()
+        return self.snapshot.draws
+
     def draw(self):
         '''
         Draw all models in the scene
@@ -85,17 +218,123 @@ class Scene:
         '''
 
         # clear the scene and depth buffer.
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+        gl.glClear(gl.GL_COLOR_BUFFER_BIT | gl.GL_DEPTH_BUFFER_BIT)
+
+        # ensure that the camera view matrix is up to date, a snapshot brings its own.
+        if self.snapshot is None:
+            with profiler.scope('camera'):
+                self.camera.update()
+
+        # load the chunks of the world around the camera, render the shadow map and fill the uniform blocks once for
+        # all the draws of the frame.
+        self.stream_world()
+        self.render_shadows()
+        self.update_uniform_blocks()
 
-        # ensure that the camera view matrix is up to date.
-        self.camera.update()
+        # loop over all models in the list which may be visible and draw each, after streaming their textures.
+        visible = self.cull(self.frame_draw_list())
+        self.stream_textures(visible)
+        self.draw_models(visible)
 
-        # loop over all models in the list and draw each.
-        for model in self.models:
-            model.draw()
+        # draw the profiler statistics over the scene if enabled.
+        profiler.draw_overlay(self.window_size)
 
         # display the scene, uses double buffering so draw on different buffer to one displayed and flip.
-        pygame.display.flip()
+        self.flip()
+
+    def draw_models(self, models):
+        '''
+        Draw a list of models, by replaying the command list recorded for it, unless command lists are disabled or
+        each draw is timed on the GPU.
+        :param models: the list of (model, parent matrix) pairs to draw
+        '''
+        if not self.commands_enabled or gpu_profiler.per_draw:
+            for model, Mp in models:
+                model.draw(Mp=Mp)
+            return
+        with profiler.scope('commands'):
+            self.commands.replay(models, self)
+
+    def cull(self, models):
+        '''
+        Remove the models hidden behind the occluders from a draw list, if the scene has occlusion culling.
+        :param models: the list of (model, parent matrix) pairs to draw
+        :return: the list of the pairs which may be visible
+        '''
+        if self.occlusion is None:
+            return models
+        return self.occlusion.cull(models, self.P, self.camera.V)
+
+    def stream_world(self):
+        '''
+        Load and evict the chunks of the world around the camera, if the scene streams its world. The cached shadows
+        of the static casters are invalidated when the chunks drawn change, and the chunks evicted are removed from
+        the snapshot being drawn.
+        '''
+        if self.world is None:
+            return
+        with profiler.scope('world'), self.lock:
+            if self.world.update() and self.shadows is not None:
+                self.shadows.invalidate()
+            if self.snapshot is not None:
+                self.snapshot.drop_released()
+
+    def stream_textures(self, models):
+        '''
+        Upload the next mip levels of the streamed textures, in the order of the size on screen of the models using
+        them, if texture streaming is enabled.
+        :param models: the list of (model, parent matrix) pairs drawn in this frame
+        '''
+        if not texture_streamer.enabled:
+            return
+        with profiler.scope('textures'):
+            texture_streamer.update(models, self.P, self.camera.V, self.window_size)
+
+    def shadow_casters(self):
+        '''
+        The models casting shadows, split into static ones, whose shadow is cached, and dynamic ones, to be overridden
+        by scenes with static geometry.
+        :return: the lists of (model, parent matrix) pairs of the static and of the dynamic casters
+        '''
+        return [], self.draw_list()
+
+    def render_shadows(self):
+        '''
+        Update the shadow map of the frame, if the scene has shadows.
+        '''
+        if self.shadows is None or not self.shadows_enabled:
+            return
+        with profiler.scope('shadows'):
+            if self.snapshot is None:
+                static, dynamic = self.shadow_casters()
+                position = None
+            else:
+                static, dynamic = self.snapshot.static_casters, self.snapshot.dynamic_casters
+                position = self.snapshot.light
+            self.shadows.render(static, dynamic, self.window_size, position)
+
+    def update_uniform_blocks(self):
+        '''
+        Upload the camera, light and mode of the frame and the materials to the uniform blocks, and the point lights
+        assigned to the clusters, to be called once per frame after updating the camera and before the draws.
+        '''
+        with profiler.scope('uniform blocks'):
+            self.frame_uniforms.update(self)
+            self.materials.update()
+        with profiler.scope('lights'):
+            self.lights.update(self.camera.V)
+
+    def flip(self):
+        '''
+        Display the frame drawn, the frames of the recording backend end there too, and in the debug profile the GL
+        errors of the frame are checked there.
+        '''
+        self.capture.capture()
+        check_errors()
+        if isinstance(backend(), RecordingBackend):
+            backend().end_frame()
+        if not self.headless:
+            pygame.display.flip()
 
     def keyboard(self, event):
         '''
@@ -109,76 +348,282 @@ class Scene:
         # if space is pressed switch between fill and wireframe rendering.
         elif event.key == pygame.K_SPACE:
             if self.wireframe:
-                print('--> Rendering using colour fill')
-                glPolygonMode(GL_FRONT_AND_BACK, GL_FILL)
+                log.info('--> Rendering using colour fill')
+                gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_FILL)
                 self.wireframe = False
             else:
-                print('--> Rendering using colour wireframe')
-                glPolygonMode(GL_FRONT_AND_BACK, GL_LINE)
+                log.info('--> Rendering using colour wireframe')
+                gl.glPolygonMode(gl.GL_FRONT_AND_BACK, gl.GL_LINE)
                 self.wireframe = True
 
+        # if p is pressed, toggle the profiler at the end of the frame, as its scopes are open while handling events.
+        elif event.key == pygame.K_p:
+            self.profiler_toggled = True
+
+        # if c is pressed, start or stop capturing the frames, to a video with shift or as PNG files otherwise.
+        elif event.key == pygame.K_c:
+            if not self.capture.recording:
+                self.capture.encoder = 'ffmpeg' if event.mod & pygame.KMOD_SHIFT else None
+            self.capture.toggle()
+
+        # if g is pressed, toggle timing each draw on the GPU rather than only the whole frame.
+        elif event.key == pygame.K_g:
+            gpu_profiler.per_draw = not gpu_profiler.per_draw
+            log.info('--> GPU timing per draw: %s', gpu_profiler.per_draw)
+
+        # if k is pressed, toggle replaying the model draws from a command list.
+        elif event.key == pygame.K_k:
+            self.commands_enabled = not self.commands_enabled
+            self.commands.invalidate()
+            log.info('--> Command list: %s', self.commands_enabled)
+
+    def toggle_profiler(self):
+        '''
+        Toggle the profiler, and save its results when stopping it. Enabling or disabling it resets its open scopes,
+        so this is only called between frames.
+        '''
+        self.profiler_toggled = False
+        if profiler.enabled:
+            profiler.report()
+            profiler.export_csv('profile.csv')
+            profiler.export_json('profile.json')
+            log.info('--> Profile saved to profile.csv and profile.json')
+        profiler.enable(not profiler.enabled)
+        gpu_profiler.enable(profiler.enabled)
+
     def pygameEvents(self):
         '''
         Method to handle PyGame events for user interaction.
         '''
         # check whether the window has been closed
         for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                self.running = False
+            self.handle_event(event)
+
+    def handle_event(self, event):
+        '''
+        Method to handle one PyGame event. The state of the modifier keys and mouse buttons is read from the event
+        where pygame provides it, or from the attributes added by the input recorder, so that recorded events can be
+        replayed without any window.
+        '''
+        # the r key starts and stops recording the input, and is not recorded itself.
+        if event.type == pygame.KEYDOWN and event.key == pygame.K_r:
+            self.toggle_recording()
+            return
+        if self.recorder is not None:
+            self.recorder.record(event)
+
+        # any input but moving the mouse without a button pressed may change the scene.
+        buttons = getattr(event, 'buttons', (0, 0, 0))
+        if event.type != pygame.MOUSEMOTION or any(buttons):
+            self.invalidate()
+
+        if event.type == pygame.QUIT:
+            self.running = False
 
-            # keyboard events
-            elif event.type == pygame.KEYDOWN:
-                self.keyboard(event)
+        # keyboard events
+        elif event.type == pygame.KEYDOWN:
+            self.keyboard(event)
 
-            # move light and scroll camera.
-            elif event.type == pygame.MOUSEBUTTONDOWN:
+        # move light and scroll camera.
+        elif event.type == pygame.MOUSEBUTTONDOWN:
+            mods = getattr(event, 'mod', None)
+            if mods is None:
                 mods = pygame.key.get_mods()
-                if event.button == 4:
-                    #pass
-                    if mods & pygame.KMOD_CTRL:
-                        self.light.position *= 1.1
-                        self.light.update()
-                    else:
-                        self.camera.distance = max(1, self.camera.distance - 1)
-
-                elif event.button == 5:
-                    #pass
-                    if mods & pygame.KMOD_CTRL:
-                        self.light.position *= 0.9
-                        self.light.update()
-                    else:
-                        self.camera.distance += 1
-
-            # move camera.
-            elif event.type == pygame.MOUSEMOTION:
-                if pygame.mouse.get_pressed()[0]:
-                    if self.mouse_mvt is not None:
-                        self.mouse_mvt = pygame.mouse.get_rel()
-                        self.camera.center[0] -= (float(self.mouse_mvt[0]) / self.window_size[0])
-                        self.camera.center[1] -= (float(self.mouse_mvt[1]) / self.window_size[1])
-                    else:
-                        self.mouse_mvt = pygame.mouse.get_rel()
-
-                elif pygame.mouse.get_pressed()[2]:
-                    if self.mouse_mvt is not None:
-                        self.mouse_mvt = pygame.mouse.get_rel()
-                        self.camera.phi -= (float(self.mouse_mvt[0]) / self.window_size[0])
-                        self.camera.psi -= (float(self.mouse_mvt[1]) / self.window_size[1])
-                    else:
-                        self.mouse_mvt = pygame.mouse.get_rel()
+            if event.button == 4:
+                #pass
+                if mods & pygame.KMOD_CTRL:
+                    self.light.position *= 1.1
+                    self.light.update()
                 else:
-                    self.mouse_mvt = None
+                    self.camera.distance = max(1, self.camera.distance - 1)
 
-    def run(self):
+            elif event.button == 5:
+                #pass
+                if mods & pygame.KMOD_CTRL:
+                    self.light.position *= 0.9
+                    self.light.update()
+                else:
+                    self.camera.distance += 1
+
+        # move camera.
+        elif event.type == pygame.MOUSEMOTION:
+            if buttons[0]:
+                if self.mouse_mvt is not None:
+                    self.mouse_mvt = event.rel
+                    self.camera.center[0] -= (float(self.mouse_mvt[0]) / self.window_size[0])
+                    self.camera.center[1] -= (float(self.mouse_mvt[1]) / self.window_size[1])
+                else:
+                    self.mouse_mvt = event.rel
+
+            elif buttons[2]:
+                if self.mouse_mvt is not None:
+                    self.mouse_mvt = event.rel
+                    self.camera.phi -= (float(self.mouse_mvt[0]) / self.window_size[0])
+                    self.camera.psi -= (float(self.mouse_mvt[1]) / self.window_size[1])
+                else:
+                    self.mouse_mvt = event.rel
+            else:
+                self.mouse_mvt = None
+
+    def toggle_recording(self, file_name='input.json'):
+        '''
+        Start recording the input, or stop and save the recording.
+        '''
+        if self.recorder is None:
+            log.info('--> Recording input')
+            self.recorder = InputRecorder(self)
+        else:
+            self.recorder.save(file_name)
+            self.recorder = None
+
+    def run(self, max_steps=8):
         '''
         Draws the scene in a loop until exit.
+        :param max_steps: the maximum number of simulation steps per iteration, the remaining time is dropped when
+        the simulation cannot keep up
         '''
 
         # program loop.
         self.running = True
+        previous = time.perf_counter()
+        accumulator = 0.
         while self.running:
 
-            self.pygameEvents()
+            with profiler.scope('events'):
+                self.pygameEvents()
+
+            # advance the simulation by as many fixed steps as fit in the elapsed time.
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            steps = 0
+            while accumulator >= self.timestep and steps < max_steps:
+                with profiler.scope('update'):
+                    self.update(self.timestep)
+                self.time += self.timestep
+                accumulator -= self.timestep
+                steps += 1
+            if steps == max_steps:
+                accumulator = 0.
+
+            # draw if anything changed, or always when not rendering on demand.
+            rendered = self.dirty or not self.on_demand
+            if rendered:
+                self.dirty = False
+                gpu_profiler.begin_frame()
+                with profiler.scope('draw'):
+                    self.draw()
+                gpu_profiler.end_frame()
+                profiler.end_frame()
+            self.stats.record(rendered)
+            if self.profiler_toggled:
+                self.toggle_profiler()
+
+            # when idle, sleep until the next simulation step rather than polling.
+            if rendered:
+                self.pacer.wait()
+            else:
+                self.pacer.wait(max(self.pacer.period, self.timestep - accumulator))
+
+        self.finish()
+
+    def run_threaded(self, max_steps=8):
+        '''
+        Draws the scene in a loop until exit, with the simulation running on its own thread. This thread reads the
+        input, streams the world and draws the latest snapshot of the simulation, see simthread.
+        :param max_steps: the maximum number of simulation steps per snapshot
+        '''
+        simulation = SimulationThread(self, max_steps)
+        simulation.start()
 
-            # continue drawing while running.
-            self.draw()
\ No newline at end of file
+        # program loop.
+        self.running = True
+        while self.running:
+
+            # the input is handled with the snapshot of the frame in place, so that it changes the latest state.
+            with profiler.scope('events'), self.lock:
+                new = simulation.acquire()
+                self.pygameEvents()
+
+            # draw if anything changed, or always when not rendering on demand.
+            rendered = self.dirty or not self.on_demand
+            if rendered:
+                self.dirty = False
+                gpu_profiler.begin_frame()
+                with profiler.scope('draw'):
+                    self.draw()
+                gpu_profiler.end_frame()
+                profiler.end_frame()
+                simulation.drawn(new)
+            self.stats.record(rendered)
+            if self.profiler_toggled:
+                self.toggle_profiler()
+
+            # when idle, sleep until the next simulation step rather than polling.
+            if rendered:
+                self.pacer.wait()
+            else:
+                self.pacer.wait(max(self.pacer.period, self.timestep))
+
+        simulation.stop()
+        self.snapshot = None
+        simulation.report()
+        self.finish()
+
+    def finish(self):
+        '''
+        Stop the capture, report the statistics of the run and release the world.
+        '''
+        self.capture.stop()
+        self.stats.report()
+        if self.shadows is not None:
+            self.shadows.report()
+        if self.occlusion is not None:
+            self.occlusion.report()
+        if self.commands_enabled:
+            self.commands.report()
+        if texture_streamer.enabled:
+            texture_streamer.report()
+        if self.world is not None:
+            self.world.report()
+            self.world.close()
+
+    def replay(self, file_name, output=None):
+        '''
+        Replay recorded input, advancing exactly one simulation step and drawing one frame per iteration, whatever
+        the wall-clock time, so that runs of the same recording can be compared.
+        :param file_name: the recording saved by the input recorder
+        :param output: [optional] file to save the frame times to
+        '''
+        replay = InputReplay(file_name)
+        replay.restore(self)
+        self.stats = FrameStats(window=replay.steps + 1)
+        frame_times = []
+
+        self.running = True
+        step = 0
+        while self.running and step <= replay.steps:
+            for event in replay.events(step):
+                self.handle_event(event)
+
+            start = time.perf_counter()
+            with profiler.scope('update'):
+                self.update(self.timestep)
+            self.time += self.timestep
+            step += 1
+
+            gpu_profiler.begin_frame()
+            with profiler.scope('draw'):
+                self.draw()
+            gpu_profiler.end_frame()
+            profiler.end_frame()
+            frame_times.append(time.perf_counter() - start)
+            self.stats.record(True)
+            if self.profiler_toggled:
+                self.toggle_profiler()
+
+        replay.check(self)
+        self.finish()
+        if output is not None:
+            save_frame_times(output, frame_times, label=file_name)
+            log.info('--> Frame times saved to %s', output)
\ No newline at end of file
@@ -1,6 +1,5 @@
 # imports all openGL functions.
-from OpenGL.GL import *
-from OpenGL.GL import shaders
+from glbackend import gl
 
 # import manipulation functions.
 from matutils import *
@@ -8,6 +7,23 @@ from matutils import *
 # use numpy to store data in arrays.
 import numpy as np
 
+# CPU profiler of the frame stages.
+from profiler import profiler
+
+# uniform blocks shared by the programs.
+from uniformblocks import bind_blocks
+
+# texture units of the clustered lights.
+from lights import LIGHT_DATA_UNIT, CLUSTER_GRID_UNIT, LIGHT_INDICES_UNIT
+
+# leveled logging of the runtime profile.
+from runtime import get_logger
+
+# texture unit of the shadow map sampled by the phong shaders.
+SHADOW_MAP_UNIT = 4
+
+log = get_logger(__name__)
+
 
 class Uniform:
     '''
@@ -25,9 +41,9 @@ class Uniform:
         '''
         Fetch location of uniform in program by its name.
         '''
-        self.location = glGetUniformLocation(program=program, name=self.name)
+        self.location = gl.glGetUniformLocation(program=program, name=self.name)
         if self.location == -1:
-            print('(E) Warning, no uniform {}'.format(self.name))
+            log.warning('no uniform %s', self.name)
 
     def bind_matrix(self, M=None, number=1, transpose=True):
         '''
@@ -36,11 +52,11 @@ class Uniform:
         if M is not None:
             self.value = M
         if self.value.shape[0] == 4 and self.value.shape[1] == 4:
-            glUniformMatrix4fv(self.location, number, transpose, self.value)
+            gl.glUniformMatrix4fv(self.location, number, transpose, self.value)
         elif self.value.shape[0] == 3 and self.value.shape[1] == 3:
-            glUniformMatrix3fv(self.location, number, transpose, self.value)
+            gl.glUniformMatrix3fv(self.location, number, transpose, self.value)
         else:
-            print('(E) Error: Trying to bind as uniform a matrix of shape {}'.format(self.value.shape))
+            log.error('Trying to bind as uniform a matrix of shape %s', self.value.shape)
 
     # Bind values
     def bind(self,value):
@@ -57,32 +73,32 @@ class Uniform:
             elif self.value.ndim==2:
                 self.bind_matrix()
         else:
-            print('Wrong value bound: {}'.format(type(self.value)))
+            log.error('Wrong value bound: %s', type(self.value))
 
     # Bind int values.
     def bind_int(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1i(self.location, self.value)
+        gl.glUniform1i(self.location, self.value)
 
     # Bind float values.
     def bind_float(self, value=None):
         if value is not None:
             self.value = value
-        glUniform1f(self.location, self.value)
+        gl.glUniform1f(self.location, self.value)
 
     # Bind vectors.
     def bind_vector(self, value=None):
         if value is not None:
             self.value = value
         if value.shape[0] == 2:
-            glUniform2fv(self.location, 1, value)
+            gl.glUniform2fv(self.location, 1, value)
         elif value.shape[0] == 3:
-            glUniform3fv(self.location, 1, value)
+            gl.glUniform3fv(self.location, 1, value)
         elif value.shape[0] == 4:
-            glUniform4fv(self.location, 1, value)
+            gl.glUniform4fv(self.location, 1, value)
         else:
-            print('(E) Error in Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found {}'.format(value.shape[0]))
+            log.error('Uniform.bind_vector(): Vector should be of dimension 2,3 or 4, found %d', value.shape[0])
 
     def set(self, value):
         '''
@@ -104,7 +120,7 @@ class BaseShaderProgram:
         '''
 
         self.name = name
-        print('Creating shader program: {}'.format(name) )
+        log.debug('Creating shader program: %s', name)
 
         # load the GLSL files.
         if name is not None:
@@ -125,7 +141,7 @@ class BaseShaderProgram:
                 }
             '''
         else:
-            print('Load vertex shader from file: {}'.format(vertex_shader))
+            log.debug('Load vertex shader from file: %s', vertex_shader)
             with open(vertex_shader, 'r') as file:
                 self.vertex_shader_source = file.read()
 
@@ -138,7 +154,7 @@ class BaseShaderProgram:
                 }
             '''
         else:
-            print('Load fragment shader from file: {}'.format(fragment_shader))
+            log.debug('Load fragment shader from file: %s', fragment_shader)
             with open(fragment_shader, 'r') as file:
                 self.fragment_shader_source = file.read()
 
@@ -155,22 +171,22 @@ class BaseShaderProgram:
         '''
         Compile the GLSL codes for both shaders.
         '''
-        print('Compiling GLSL shaders [{}]...'.format(self.name))
+        log.debug('Compiling GLSL shaders [%s]...', self.name)
         try:
-            self.program = glCreateProgram()
-            glAttachShader(self.program, shaders.compileShader(self.vertex_shader_source, shaders.GL_VERTEX_SHADER))
-            glAttachShader(self.program, shaders.compileShader(self.fragment_shader_source, shaders.GL_FRAGMENT_SHADER))
+            self.program = gl.glCreateProgram()
+            gl.glAttachShader(self.program, gl.compileShader(self.vertex_shader_source, gl.GL_VERTEX_SHADER))
+            gl.glAttachShader(self.program, gl.compileShader(self.fragment_shader_source, gl.GL_FRAGMENT_SHADER))
 
         except RuntimeError as error:
-            print('(E) An error occured while compiling {} shader:\n {}\n... forwarding exception...'.format(self.name, error)),
+            log.error('An error occured while compiling %s shader:\n %s\n... forwarding exception...', self.name, error)
             raise error
 
         self.bindAttributes(attributes)
 
-        glLinkProgram(self.program)
+        gl.glLinkProgram(self.program)
 
         # OpenGL will use this shader program to render.
-        glUseProgram(self.program)
+        gl.glUseProgram(self.program)
 
         # link uniforms.
         for uniform in self.uniforms:
@@ -179,8 +195,8 @@ class BaseShaderProgram:
     def bindAttributes(self, attributes):
         # bind all shader attributes to the correct locations.
         for name, location in attributes.items():
-            glBindAttribLocation(self.program, location, name)
-            print('Binding attribute {} to location {}'.format(name, location))
+            gl.glBindAttribLocation(self.program, location, name)
+            log.debug('Binding attribute %s to location %s', name, location)
 
     def bind(self, model, M):
         '''
@@ -188,7 +204,7 @@ class BaseShaderProgram:
         '''
 
         # OpenGL will use this shader program to render.
-        glUseProgram(self.program)
+        gl.glUseProgram(self.program)
 
         P = model.scene.P
         V = model.scene.camera.V
@@ -210,82 +226,119 @@ class PhongShader(BaseShaderProgram):
 
         BaseShaderProgram.__init__(self, name=name)
 
-        # in order to simplify extension of the class in the future, we start storing uniforms in a dictionary.
+        # the camera, light and mode are in the Frame uniform block and the materials in the Materials block, only
+        # the model matrix and the material index are set for each draw.
         self.uniforms = {
-            'PVM': Uniform('PVM'),   # project view model matrix
-            'VM': Uniform('VM'),     # view model matrix
-            'VMiT': Uniform('VMiT'),  # inverse-transpose of the view model matrix
-            'mode': Uniform('mode',0),  # rendering mode
-            'Ka': Uniform('Ka'),
-            'Kd': Uniform('Kd'),
-            'Ks': Uniform('Ks'),
-            'Ns': Uniform('Ns'),
-            'light': Uniform('light', np.array([0.,0.,0.], 'f')),
-            'Ia': Uniform('Ia'),
-            'Id': Uniform('Id'),
-            'Is': Uniform('Is'),
-            'has_texture': Uniform('has_texture'),
-            'textureObject': Uniform('textureObject')
-
+            'M': Uniform('M'),  # model matrix
+            'material': Uniform('material', 0),  # index of the material in the materials table
+            'textureObject': Uniform('textureObject', 0),
+            'shadowMap': Uniform('shadowMap', SHADOW_MAP_UNIT)
         }
 
+    def compile(self, attributes):
+        '''
+        Compile the GLSL codes, assign the uniform blocks to their binding points and set the texture unit.
+        '''
+        BaseShaderProgram.compile(self, attributes)
+        bind_blocks(self.program)
+        self.uniforms['textureObject'].bind_int(0)
+        self.uniforms['shadowMap'].bind_int(SHADOW_MAP_UNIT)
+
     def bind(self, model, M):
         '''
         Enable this GLSL Program.
         '''
 
         # OpenGL will use this shader program to render.
-        glUseProgram(self.program)
+        gl.glUseProgram(self.program)
 
-        P = model.scene.P  # get projection matrix from the scene.
-        V = model.scene.camera.V  # get view matrix from the camera.
+        # upload the model matrix and the material index, the rest is in the uniform blocks.
+        with profiler.scope('uniforms'):
+            self.uniforms['M'].bind_matrix(M)
+            self.uniforms['material'].bind_int(
+                model.scene.materials.index(model.mesh.material, int(len(model.mesh.textures) > 0)))
 
-        # set the PVM matrix uniform.
-        self.uniforms['PVM'].bind(np.matmul(P, np.matmul(V, M)))
-
-        # set the VM matrix uniform.
-        self.uniforms['VM'].bind(np.matmul(V, M))
-
-        # set the inverse-transpose of the VM matrix uniform.
-        self.uniforms['VMiT'].bind(np.linalg.inv(np.matmul(V, M))[:3, :3].transpose())
-
-        # bind the mode to the program.
-        self.uniforms['mode'].bind(model.scene.mode)
-
-        if len(model.mesh.textures) > 0:
-            # bind the textures.
-            self.uniforms['textureObject'].bind(0)
-            self.uniforms['has_texture'].bind(1)
-        else:
-            self.uniforms['has_texture'].bind(0)
-
-        # bind material properties.
-        self.bind_material_uniforms(model.mesh.material)
-
-        # bind light properties.
-        self.bind_light_uniforms(model.scene.light, V)
-
-    def bind_light_uniforms(self, light, V):
-        self.uniforms['light'].bind_vector(unhomog(np.dot(V, homog(light.position))))
-        self.uniforms['Ia'].bind_vector(np.array(light.Ia, 'f'))
-        self.uniforms['Id'].bind_vector(np.array(light.Id, 'f'))
-        self.uniforms['Is'].bind_vector(np.array(light.Is, 'f'))
-
-    def bind_material_uniforms(self, material):
-        self.uniforms['Ka'].bind_vector(np.array(material.Ka, 'f'))
-        self.uniforms['Kd'].bind_vector(np.array(material.Kd, 'f'))
-        self.uniforms['Ks'].bind_vector(np.array(material.Ks, 'f'))
-        self.uniforms['Ns'].bind_float(material.Ns)
+    def bind_frame(self, scene):
+        '''
+        Set the uniforms which are the same for all the draws of a frame but not in the uniform blocks, the program
+        must be in use. Nothing to set for this program.
+        '''
+        pass
 
     def add_uniform(self, name):
         if name in self.uniforms:
-            print('(W) Warning re-defining already existing uniform %s' % name)
+            log.warning('re-defining already existing uniform %s', name)
         self.uniforms[name] = Uniform(name)
 
     def unbind(self):
-        glUseProgram(0)
+        gl.glUseProgram(0)
 
 # create flat shader object of phong shader class..
 class FlatShader(PhongShader):
     def __init__(self):
         PhongShader.__init__(self, name='flat')
+
+
+class ClusteredShader(PhongShader):
+    '''
+    Flat shader adding the point lights of the scene light manager, looping only over the lights of the cluster of
+    each fragment.
+    '''
+    def __init__(self):
+        PhongShader.__init__(self, name='clustered')
+        self.uniforms.update({
+            'lightData': Uniform('lightData', LIGHT_DATA_UNIT),
+            'clusterGrid': Uniform('clusterGrid', CLUSTER_GRID_UNIT),
+            'lightIndices': Uniform('lightIndices', LIGHT_INDICES_UNIT),
+            'clusters': Uniform('clusters'),
+            'tile_size': Uniform('tile_size'),
+            'depth_range': Uniform('depth_range'),
+        })
+
+        # the cluster parameters last set in the program, they only change with the light manager.
+        self.cluster_parameters = None
+
+    def compile(self, attributes):
+        PhongShader.compile(self, attributes)
+        for name in ('lightData', 'clusterGrid', 'lightIndices'):
+            self.uniforms[name].bind_int()
+        self.cluster_parameters = None
+
+    def bind(self, model, M):
+        PhongShader.bind(self, model, M)
+        self.bind_frame(model.scene)
+
+    def bind_frame(self, scene):
+        '''
+        Set the cluster parameters of the light manager, if they changed since they were last set.
+        '''
+        lights = scene.lights
+        parameters = (lights.grid, lights.window_size, lights.near, lights.far)
+        if parameters != self.cluster_parameters:
+            self.cluster_parameters = parameters
+            grid = np.array(lights.grid, 'f')
+            self.uniforms['clusters'].bind_vector(grid)
+            self.uniforms['tile_size'].bind_vector(np.array(lights.window_size, 'f') / grid[:2])
+            self.uniforms['depth_range'].bind_vector(np.array([lights.near, lights.far], 'f'))
+
+
+class ShadowShader(BaseShaderProgram):
+    '''
+    Depth only program rendering shadow casters into a shadow map.
+    '''
+    def __init__(self):
+        BaseShaderProgram.__init__(self, name='shadow')
+        self.uniforms = {
+            'LPV': Uniform('LPV'),  # projection view matrix of the light
+            'M': Uniform('M'),  # model matrix of the caster
+        }
+
+    def bind_light(self, LPV):
+        '''
+        Enable the program for the casters seen from a light.
+        '''
+        gl.glUseProgram(self.program)
+        self.uniforms['LPV'].bind_matrix(LPV)
+
+    def bind_caster(self, M):
+        self.uniforms['M'].bind_matrix(M)
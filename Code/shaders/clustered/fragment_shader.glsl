@@ -0,0 +1,142 @@
+#version 140 // required for uniform blocks
+
+//=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
+in vec3 fragment_color;        // the fragment colour
+in vec3 position_view_space;   // the position in view coordinates of this fragment
+in vec2 fragment_texCoord;
+in vec4 position_light_space;  // the position of this fragment seen from the shadow casting light
+
+//=== 'out' attributes are the output image, usually only one for the colour of each pixel
+out vec4 final_color;
+
+// === uniform block shared by all programs, filled once per frame
+layout(std140) uniform Frame {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    vec4 light;  // light source position in view coordinates
+    vec4 Ia;     // light source intensities
+    vec4 Id;
+    vec4 Is;
+    mat4 shadow_matrix;  // the Perspective-View matrix of the light
+    vec4 shadow;         // x: 1 if shadows are enabled, y: depth bias, z: texel size, w: filtering radius
+    int mode;    // the rendering mode (better to code different shaders!)
+};
+
+// === material table shared by all programs
+struct Material {
+    vec4 Ka;
+    vec4 Kd;
+    vec4 Ks;
+    vec4 parameters;  // x: the specular exponent Ns, y: 1 if the mesh has a texture
+};
+
+layout(std140) uniform Materials {
+    Material materials[256];
+};
+
+// index of the material in the table
+uniform int material;
+
+// texture samplers
+uniform sampler2D textureObject; // first texture object
+uniform sampler2DShadow shadowMap; // depth of the shadow casters seen from the light
+
+// fraction of the light reaching the fragment, filtered over the texels around it.
+float shadow_factor() {
+      if(shadow.x < 0.5f){
+          return 1.0f;
+      }
+
+      // fragments outside the shadow map are lit.
+      vec3 coords = position_light_space.xyz / position_light_space.w * 0.5f + 0.5f;
+      if(any(lessThan(coords, vec3(0.0f))) || any(greaterThan(coords, vec3(1.0f)))){
+          return 1.0f;
+      }
+      coords.z -= shadow.y;
+
+      int radius = int(shadow.w);
+      float lit = 0.0f;
+      for(int x = -radius; x <= radius; x++){
+          for(int y = -radius; y <= radius; y++){
+              lit += texture(shadowMap, vec3(coords.xy + vec2(x, y)*shadow.z, coords.z));
+          }
+      }
+      return lit / float((2*radius + 1)*(2*radius + 1));
+}
+
+// clustered point lights
+uniform samplerBuffer lightData;     // two texels per light: view position and radius, colour
+uniform usamplerBuffer clusterGrid;  // offset and count of the light indices of each cluster
+uniform usamplerBuffer lightIndices; // light indices of all clusters
+uniform vec3 clusters;               // the number of clusters along x, y and depth
+uniform vec2 tile_size;              // the size of a tile in pixels
+uniform vec2 depth_range;            // the near and far distances
+
+///=== main shader code
+void main() {
+      // 0. fetch the material and light parameters from the uniform blocks
+      vec3 Ka = materials[material].Ka.xyz;
+      vec3 Kd = materials[material].Kd.xyz;
+      vec3 Ks = materials[material].Ks.xyz;
+      float Ns = materials[material].parameters.x;
+      vec3 light_position = light.xyz;
+
+      // 1. calculate vectors used for shading calculations
+      vec3 camera_direction = -normalize(position_view_space);
+      vec3 light_direction = normalize(light_position-position_view_space);
+
+      // 2. Calculate the normal to the fragment using position of its neighbours
+      vec3 xTangent = dFdx( position_view_space );
+      vec3 yTangent = dFdy( position_view_space );
+      vec3 normal_view_space = normalize( cross( xTangent, yTangent ) );
+
+      // 3. now we calculate light components
+      vec4 ambient = vec4(Ia.xyz*Ka,1.0f);
+      vec4 diffuse = vec4(Id.xyz*Kd*max(0.0f,dot(light_direction, normal_view_space)),1.0f);
+      vec4 specular = vec4(Is.xyz*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), 1.0f);
+
+      // 4. we calculate the attenuation function
+      // in this formula, dist should be the distance between the surface and the light
+      float dist = length(light_position - position_view_space);
+      float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
+
+      // 5. sample from the first texture
+
+      vec4 texval = vec4(1.0f);
+      if(materials[material].parameters.y > 0.5f){
+          texval = texture(textureObject, fragment_texCoord);
+      }
+
+      // 6. find the cluster of the fragment from its tile and the exponential depth slice.
+      ivec3 cluster = ivec3(gl_FragCoord.xy / tile_size, 0);
+      float slice = log(-position_view_space.z / depth_range.x) / log(depth_range.y / depth_range.x);
+      cluster.z = int(clamp(slice, 0.0f, 0.999f) * clusters.z);
+      cluster.xy = min(cluster.xy, ivec2(clusters.xy) - 1);
+      int index = (cluster.z * int(clusters.y) + cluster.y) * int(clusters.x) + cluster.x;
+      uvec2 range = texelFetch(clusterGrid, index).xy;
+
+      // 7. add the point lights of the cluster, fading out to zero at their radius.
+      vec3 point_diffuse = vec3(0.0f);
+      vec3 point_specular = vec3(0.0f);
+      for(uint i = range.x; i < range.x + range.y; i++){
+          int light_index = int(texelFetch(lightIndices, int(i)).x);
+          vec4 point = texelFetch(lightData, 2*light_index);
+          vec3 point_color = texelFetch(lightData, 2*light_index + 1).xyz;
+
+          vec3 to_light = point.xyz - position_view_space;
+          float point_dist = length(to_light);
+          vec3 point_direction = to_light / point_dist;
+          float falloff = clamp(1.0f - pow(point_dist / point.w, 4.0f), 0.0f, 1.0f);
+          falloff = falloff * falloff / (1.0f + point_dist * point_dist);
+
+          point_diffuse += point_color*falloff*Kd*max(0.0f, dot(point_direction, normal_view_space));
+          point_specular += point_color*falloff*Ks*pow(max(0.0f, dot(reflect(point_direction, normal_view_space), -camera_direction)), Ns);
+      }
+
+      // 8. Finally, we combine the shading components
+      // we do not apply the texture to the specular component.
+      final_color = texval*ambient + shadow_factor()*attenuation*(texval*diffuse + specular) + vec4(texval.xyz*point_diffuse + point_specular, 0.0f);
+}
+
+
@@ -0,0 +1,52 @@
+#version 140		// required for uniform blocks
+
+//=== in attributes are read from the vertex array, one row per instance of the shader
+in vec3 position;	// the position attribute contains the vertex position
+//in vec3 normal;		// store the vertex normal
+in vec3 color; 		// store the vertex colour
+in vec2 texCoord;
+
+//=== out attributes are interpolated on the face, and passed on to the fragment shader
+out vec3 fragment_color;        // the output of the shader will be the colour of the vertex
+out vec3 position_view_space;   // the position of the vertex in view coordinates
+out vec2 fragment_texCoord;
+out vec4 position_light_space;  // the position of the vertex seen from the shadow casting light
+
+//=== uniform block shared by all programs, filled once per frame
+layout(std140) uniform Frame {
+    mat4 P;     // the Perspective matrix
+    mat4 V;     // the View matrix
+    mat4 PV;    // the Perspective-View matrix
+    vec4 light; // the light position in view coordinates
+    vec4 Ia;
+    vec4 Id;
+    vec4 Is;
+    mat4 shadow_matrix;     // the Perspective-View matrix of the light
+    vec4 shadow;            // x: 1 if shadows are enabled, y: depth bias, z: texel size, w: filtering radius
+    int mode;   // the rendering mode (better to code different shaders!)
+};
+
+//=== uniforms
+uniform mat4 M; 	// the Model matrix is the only matrix received for each draw
+
+void main(){
+    // 1. first, we transform the position to world coordinates with the model matrix.
+    vec4 position_world_space = M * vec4(position, 1.0f);
+
+    // 2. note that gl_Position is a standard output of the
+    // vertex shader.
+    gl_Position = PV * position_world_space;
+
+    // 3. calculate vectors used for shading calculations
+    // those will be interpolate before being sent to the
+    // fragment shader.
+    position_view_space = vec3(V*position_world_space);
+    position_light_space = shadow_matrix*position_world_space;
+    //normal_view_space = normalize(VMiT*normal);
+
+    // 4. forward the texture coordinates.
+    fragment_texCoord = texCoord;
+
+    // 5. for now, we just pass on the color from the data array.
+    fragment_color = color;
+}
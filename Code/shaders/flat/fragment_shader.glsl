@@ -1,38 +1,82 @@
-# version 130 // required to use OpenGL core standard
+#version 140 // required for uniform blocks
 
 //=== 'in' attributes are passed on from the vertex shader's 'out' attributes, and interpolated for each fragment
 in vec3 fragment_color;        // the fragment colour
 in vec3 position_view_space;   // the position in view coordinates of this fragment
 in vec2 fragment_texCoord;
+in vec4 position_light_space;  // the position of this fragment seen from the shadow casting light
 
 //=== 'out' attributes are the output image, usually only one for the colour of each pixel
 out vec4 final_color;
 
-// === uniform here the texture object to sample from
-uniform int mode;	// the rendering mode (better to code different shaders!)
-
-uniform int has_texture;
+// === uniform block shared by all programs, filled once per frame
+layout(std140) uniform Frame {
+    mat4 P;
+    mat4 V;
+    mat4 PV;
+    vec4 light;  // light source position in view coordinates
+    vec4 Ia;     // light source intensities
+    vec4 Id;
+    vec4 Is;
+    mat4 shadow_matrix;  // the Perspective-View matrix of the light
+    vec4 shadow;         // x: 1 if shadows are enabled, y: depth bias, z: texel size, w: filtering radius
+    int mode;    // the rendering mode (better to code different shaders!)
+};
+
+// === material table shared by all programs
+struct Material {
+    vec4 Ka;
+    vec4 Kd;
+    vec4 Ks;
+    vec4 parameters;  // x: the specular exponent Ns, y: 1 if the mesh has a texture
+};
+
+layout(std140) uniform Materials {
+    Material materials[256];
+};
+
+// index of the material in the table
+uniform int material;
 
 // texture samplers
 uniform sampler2D textureObject; // first texture object
+uniform sampler2DShadow shadowMap; // depth of the shadow casters seen from the light
 
-// material uniforms
-uniform vec3 Ka;
-uniform vec3 Kd;
-uniform vec3 Ks;
-uniform float Ns;
+// fraction of the light reaching the fragment, filtered over the texels around it.
+float shadow_factor() {
+      if(shadow.x < 0.5f){
+          return 1.0f;
+      }
 
-// light source
-uniform vec3 light;
-uniform vec3 Ia;
-uniform vec3 Id;
-uniform vec3 Is;
+      // fragments outside the shadow map are lit.
+      vec3 coords = position_light_space.xyz / position_light_space.w * 0.5f + 0.5f;
+      if(any(lessThan(coords, vec3(0.0f))) || any(greaterThan(coords, vec3(1.0f)))){
+          return 1.0f;
+      }
+      coords.z -= shadow.y;
+
+      int radius = int(shadow.w);
+      float lit = 0.0f;
+      for(int x = -radius; x <= radius; x++){
+          for(int y = -radius; y <= radius; y++){
+              lit += texture(shadowMap, vec3(coords.xy + vec2(x, y)*shadow.z, coords.z));
+          }
+      }
+      return lit / float((2*radius + 1)*(2*radius + 1));
+}
 
 ///=== main shader code
 void main() {
+      // 0. fetch the material and light parameters from the uniform blocks
+      vec3 Ka = materials[material].Ka.xyz;
+      vec3 Kd = materials[material].Kd.xyz;
+      vec3 Ks = materials[material].Ks.xyz;
+      float Ns = materials[material].parameters.x;
+      vec3 light_position = light.xyz;
+
       // 1. calculate vectors used for shading calculations
       vec3 camera_direction = -normalize(position_view_space);
-      vec3 light_direction = normalize(light-position_view_space);
+      vec3 light_direction = normalize(light_position-position_view_space);
 
       // 2. Calculate the normal to the fragment using position of its neighbours
       vec3 xTangent = dFdx( position_view_space );
@@ -40,25 +84,25 @@ void main() {
       vec3 normal_view_space = normalize( cross( xTangent, yTangent ) );
 
       // 3. now we calculate light components
-      vec4 ambient = vec4(Ia*Ka,1.0f);
-      vec4 diffuse = vec4(Id*Kd*max(0.0f,dot(light_direction, normal_view_space)),1.0f);
-      vec4 specular = vec4(Is*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), 1.0f);
+      vec4 ambient = vec4(Ia.xyz*Ka,1.0f);
+      vec4 diffuse = vec4(Id.xyz*Kd*max(0.0f,dot(light_direction, normal_view_space)),1.0f);
+      vec4 specular = vec4(Is.xyz*Ks*pow(max(0.0f, dot(reflect(light_direction, normal_view_space), -camera_direction)), Ns), 1.0f);
 
       // 4. we calculate the attenuation function
       // in this formula, dist should be the distance between the surface and the light
-      float dist = length(light - position_view_space);
+      float dist = length(light_position - position_view_space);
       float attenuation =  min(1.0/(dist*dist*0.005) + 1.0/(dist*0.05), 1.0);
 
       // 5. sample from the first texture
 
       vec4 texval = vec4(1.0f);
-      if(has_texture == 1){
-          texval = texture2D(textureObject, fragment_texCoord);
+      if(materials[material].parameters.y > 0.5f){
+          texval = texture(textureObject, fragment_texCoord);
       }
 
       // 5. Finally, we combine the shading components
       // we do not apply the texture to the specular component.
-      final_color = texval*ambient + attenuation*(texval*diffuse + specular);
+      final_color = texval*ambient + shadow_factor()*attenuation*(texval*diffuse + specular);
 }
 
 
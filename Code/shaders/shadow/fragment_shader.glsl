@@ -0,0 +1,5 @@
+#version 140 // required for uniform blocks
+
+///=== the depth is written by the fixed pipeline, there is no colour output
+void main() {
+}
@@ -0,0 +1,13 @@
+#version 140		// required for uniform blocks
+
+//=== in attributes are read from the vertex array, only the position is needed for depth
+in vec3 position;	// the position attribute contains the vertex position
+
+//=== uniforms
+uniform mat4 LPV; 	// the Perspective-View matrix of the light
+uniform mat4 M; 	// the Model matrix of the shadow caster
+
+void main(){
+    // the depth of the vertex seen from the light is all the shadow map stores.
+    gl_Position = LPV * M * vec4(position, 1.0f);
+}
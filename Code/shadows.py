@@ -0,0 +1,232 @@
+# import requirements
+import time
+
+import numpy as np
+
+from glbackend import gl
+
+# import manipulation functions.
+from matutils import *
+
+from shaders import ShadowShader, SHADOW_MAP_UNIT
+
+# CPU profiler of the frame stages.
+from profiler import profiler
+
+from runtime import get_logger
+
+'''
+Shadow mapping of the main light with a cache of the static casters. The depth of the static casters, such as the
+street and the houses, is rendered into a cached shadow map only when the light or the static geometry changes. Each
+frame, the cached depth is copied into a second shadow map and only the dynamic casters, such as the cars, are drawn
+on top of it, so that the full scene is not drawn twice per frame. Without dynamic casters the cached map is sampled
+directly.
+'''
+
+log = get_logger(__name__)
+
+# filtering modes: a single depth comparison, or percentage closer filtering over (2 radius + 1)^2 bilinear taps.
+FILTERING = ('hard', 'pcf')
+
+
+class ShadowMap:
+    '''
+    Class to hold the shadow maps of a light.
+    '''
+    def __init__(self, light, kind='directional', resolution=2048, filtering='pcf', pcf_radius=1, bias=0.002,
+                 center=[0., 0., 0.], extent=30., fov=np.pi / 2., near=0.5, far=100.):
+        '''
+        :param light: the LightSource casting the shadows
+        :param kind: 'directional' for parallel light towards center, or 'spot' for a light cone from the light
+        :param resolution: the width and height of the shadow maps in texels, fixed once they are allocated
+        :param filtering: 'hard' or 'pcf'
+        :param pcf_radius: the number of texels sampled around the fragment on each side when filtering
+        :param bias: depth offset against self shadowing, in shadow map depth units
+        :param center: the point the light is aimed at
+        :param extent: half the width of the area covered by a directional light
+        :param fov: the field of view of a spot light, in radians
+        :param near: the near distance of the light projection
+        :param far: the far distance of the light projection
+        '''
+        if filtering not in FILTERING:
+            raise ValueError('Unknown shadow filtering {}, expected one of {}'.format(filtering, FILTERING))
+
+        self.light = light
+        self.kind = kind
+        self.resolution = resolution
+        self.filtering = filtering
+        self.pcf_radius = pcf_radius if filtering == 'pcf' else 0
+        self.bias = bias
+        self.center = np.array(center, 'f')
+        self.extent = extent
+        self.fov = fov
+        self.near = near
+        self.far = far
+
+        self.shader = ShadowShader()
+        self.shader.compile({'position': 0})
+
+        # the cached depth of the static casters, and the depth of all casters of the frame.
+        self.static_texture, self.static_framebuffer = self._depth_target()
+        self.frame_texture, self.frame_framebuffer = self._depth_target()
+        self.texture = self.static_texture
+
+        self.LPV = np.identity(4, dtype='f')
+        self.key = None
+        self.dirty = True
+
+        # statistics of the cache and of the passes.
+        self.frames = 0
+        self.static_renders = 0
+        self.static_time = 0.
+        self.dynamic_time = 0.
+
+    def _depth_target(self):
+        '''
+        Create a depth texture, set up for depth comparisons, and a framebuffer rendering to it.
+        '''
+        texture = gl.glGenTextures(1)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, texture)
+        gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_DEPTH_COMPONENT24, self.resolution, self.resolution, 0,
+                        gl.GL_DEPTH_COMPONENT, gl.GL_FLOAT, None)
+
+        # linear filtering of a comparison texture averages the comparisons of 4 texels.
+        sample = gl.GL_LINEAR if self.filtering == 'pcf' else gl.GL_NEAREST
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MAG_FILTER, sample)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_MIN_FILTER, sample)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_S, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_WRAP_T, gl.GL_CLAMP_TO_EDGE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_COMPARE_MODE, gl.GL_COMPARE_REF_TO_TEXTURE)
+        gl.glTexParameteri(gl.GL_TEXTURE_2D, gl.GL_TEXTURE_COMPARE_FUNC, gl.GL_LEQUAL)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+        framebuffer = gl.glGenFramebuffers(1)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, framebuffer)
+        gl.glFramebufferTexture2D(gl.GL_FRAMEBUFFER, gl.GL_DEPTH_ATTACHMENT, gl.GL_TEXTURE_2D, texture, 0)
+        gl.glDrawBuffer(gl.GL_NONE)
+        gl.glReadBuffer(gl.GL_NONE)
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        return texture, framebuffer
+
+    def light_matrix(self, position=None):
+        '''
+        The projection view matrix of the light.
+        :param position: [optional] the position of the light, the position of the light source if None
+        '''
+        position = np.array(self.light.position if position is None else position, 'f')
+        direction = self.center - position
+        direction /= np.linalg.norm(direction)
+
+        # the up vector must not be parallel to the direction of the light.
+        up = [0., 0., 1.] if abs(direction[1]) > 0.99 else [0., 1., 0.]
+
+        if self.kind == 'spot':
+            V = lookAtMatrix(position, self.center, up)
+            size = self.near * np.tan(self.fov / 2.)
+            P = frustumMatrix(-size, size, -size, size, self.near, self.far)
+        else:
+            # the light looks at the centre from outside the covered area.
+            V = lookAtMatrix(self.center - direction * self.far / 2., self.center, up)
+            P = orthoMatrix(-self.extent, self.extent, self.extent, -self.extent, self.near, self.far)
+        return np.matmul(P, V)
+
+    def invalidate(self):
+        '''
+        Mark the cached static depth as out of date, e.g. after changing the static geometry.
+        '''
+        self.dirty = True
+
+    def _draw_casters(self, casters):
+        '''
+        Draw the depth of the casters, the framebuffer and shadow program must be bound.
+        '''
+        for model, Mp in casters:
+            if not model.visible:
+                continue
+            gl.glBindVertexArray(model.vao)
+            self.shader.bind_caster(np.matmul(Mp, model.M))
+            model.draw_call()
+        gl.glBindVertexArray(0)
+
+    def render(self, static, dynamic, window_size, position=None):
+        '''
+        Update the shadow map for this frame, re-rendering the static casters only if the cache is out of date.
+        :param static: the list of (model, parent matrix) pairs of the static casters
+        :param dynamic: the list of (model, parent matrix) pairs of the dynamic casters
+        :param window_size: the size of the window, to restore the viewport
+        :param position: [optional] the position of the light in this frame, the position of the light source if None
+        '''
+        self.frames += 1
+        if position is None:
+            position = self.light.position
+
+        # the cache is out of date when the light has moved or the settings of the light projection have changed.
+        key = (tuple(np.ravel(position)), self.kind, tuple(self.center), self.extent, self.fov, self.near, self.far)
+        if key != self.key:
+            self.key = key
+            self.dirty = True
+            self.LPV = self.light_matrix(position)
+
+        gl.glViewport(0, 0, self.resolution, self.resolution)
+        gl.glEnable(gl.GL_POLYGON_OFFSET_FILL)
+        gl.glPolygonOffset(2., 4.)
+        self.shader.bind_light(self.LPV)
+
+        if self.dirty:
+            start = time.perf_counter()
+            with profiler.scope('static'):
+                gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.static_framebuffer)
+                gl.glClear(gl.GL_DEPTH_BUFFER_BIT)
+                self._draw_casters(static)
+            self.static_time += time.perf_counter() - start
+            self.static_renders += 1
+            self.dirty = False
+
+        visible = [(model, Mp) for model, Mp in dynamic if model.visible]
+        if visible:
+            start = time.perf_counter()
+            with profiler.scope('dynamic'):
+                # start from the cached static depth, and add the dynamic casters.
+                gl.glBindFramebuffer(gl.GL_READ_FRAMEBUFFER, self.static_framebuffer)
+                gl.glBindFramebuffer(gl.GL_DRAW_FRAMEBUFFER, self.frame_framebuffer)
+                gl.glBlitFramebuffer(0, 0, self.resolution, self.resolution, 0, 0, self.resolution, self.resolution,
+                                     gl.GL_DEPTH_BUFFER_BIT, gl.GL_NEAREST)
+                gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, self.frame_framebuffer)
+                self._draw_casters(visible)
+            self.dynamic_time += time.perf_counter() - start
+            self.texture = self.frame_texture
+        else:
+            self.texture = self.static_texture
+
+        gl.glBindFramebuffer(gl.GL_FRAMEBUFFER, 0)
+        gl.glDisable(gl.GL_POLYGON_OFFSET_FILL)
+        gl.glViewport(0, 0, window_size[0], window_size[1])
+
+        # the shadow map of the frame is sampled by the phong shaders.
+        gl.glActiveTexture(gl.GL_TEXTURE0 + SHADOW_MAP_UNIT)
+        gl.glBindTexture(gl.GL_TEXTURE_2D, self.texture)
+        gl.glActiveTexture(gl.GL_TEXTURE0)
+
+    def parameters(self):
+        '''
+        The shadow parameters of the Frame uniform block: enabled, depth bias, texel size and filtering radius.
+        '''
+        return [1., self.bias, 1. / self.resolution, float(self.pcf_radius)]
+
+    @property
+    def hit_rate(self):
+        '''
+        The fraction of the frames which reused the cached static depth.
+        '''
+        return 1. - self.static_renders / self.frames if self.frames > 0 else 0.
+
+    def report(self):
+        log.info('--> Shadow map %dx%d (%s, %s): cache hit rate %.1f%% over %d frames',
+                 self.resolution, self.resolution, self.kind, self.filtering, 100. * self.hit_rate, self.frames)
+        log.info('- static pass: %d renders, %.3f ms each',
+                 self.static_renders, 1000. * self.static_time / max(1, self.static_renders))
+        log.info('- dynamic pass: %.3f ms per frame', 1000. * self.dynamic_time / max(1, self.frames))
+
+    def delete(self):
+        gl.glDeleteFramebuffers(2, [self.static_framebuffer, self.frame_framebuffer])
+        gl.glDeleteTextures([self.static_texture, self.frame_texture])
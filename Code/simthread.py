@@ -0,0 +1,419 @@
+# import requirements
+import threading
+import time
+
+import numpy as np
+
+# CPU profiler of the frame stages
+from profiler import profiler
+
+# leveled logging of the runtime profile
+from runtime import get_logger
+
+'''
+Simulation on its own thread. The simulation thread advances the scene by fixed steps with Scene.update(), the
+animation, traffic and any other per-step logic, and after each batch of steps takes a snapshot of what the render
+thread needs: the camera view matrix, the light position, the draw list with the model and parent matrices, which
+casters are static, and the state the scene adds with capture_state(), such as the headlights. Snapshots go through
+a triple buffer, so that the render thread always draws the latest one without waiting, and never one being written.
+
+The render thread keeps the window and the OpenGL context: pygame reads the input, and the models and textures are
+created there, so the input is handled and the world streamed on the render thread while holding the scene lock,
+which the simulation thread holds during its steps. The models are drawn through views which take their model
+matrix from the snapshot, so that the draws never read a matrix while the simulation writes it. NumPy releases the
+lock of the interpreter in its larger operations, e.g. evaluating the animation tracks, so these overlap with the
+draws.
+'''
+
+log = get_logger(__name__)
+
+
+class ModelView:
+    '''
+    A model as drawn from a snapshot: its model matrix is the one in the snapshot, and all the other attributes are
+    the model's. Views compare and hash as their model, so that they can be looked up among models, e.g. the
+    occluders.
+    '''
+    def __init__(self, model):
+        self.model = model
+        self.M = model.M
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def __eq__(self, other):
+        return other is self.model or (isinstance(other, ModelView) and other.model is self.model)
+
+    def __hash__(self):
+        return hash(self.model)
+
+    def draw(self, Mp):
+        type(self.model).draw(self, Mp=Mp)
+
+
+class Snapshot:
+    '''
+    Class to hold the state of the scene after a simulation step. It is written by the simulation thread, and is not
+    changed after being published until the render thread has moved to a newer one.
+    '''
+    def __init__(self, capacity=64):
+        self.step = 0
+        self.time = 0.
+        self.published = 0.
+
+        # the duration of the steps and of taking the snapshot, in seconds.
+        self.update_time = 0.
+        self.capture_time = 0.
+
+        self.V = np.identity(4, dtype=np.float32)
+        self.light = np.zeros(3, dtype=np.float32)
+
+        # the models of the draw list, with their parent and model matrices and whether they cast static shadows.
+        self.models = []
+        self.parents = np.zeros((capacity, 4, 4), dtype=np.float32)
+        self.matrices = np.zeros((capacity, 4, 4), dtype=np.float32)
+        self.static = []
+        self.state = {}
+
+        # the draw list of views and the static and dynamic casters, built by the render thread.
+        self.draws = []
+        self.static_casters = []
+        self.dynamic_casters = []
+
+    def capture(self, scene):
+        '''
+        Take the snapshot of a scene, the scene lock must be held.
+        '''
+        models = scene.draw_list()
+        static, _ = scene.shadow_casters()
+
+        n = len(models)
+        if n > self.parents.shape[0]:
+            capacity = max(n, 2 * self.parents.shape[0])
+            self.parents = np.zeros((capacity, 4, 4), dtype=np.float32)
+            self.matrices = np.zeros((capacity, 4, 4), dtype=np.float32)
+        if n > 0:
+            self.parents[:n] = [Mp for _, Mp in models]
+            self.matrices[:n] = [model.M for model, _ in models]
+
+        # static casters are the models of the draw list among those of the scene.
+        static_ids = set(id(model) for model, _ in static)
+        self.models = [model for model, _ in models]
+        self.static = [id(model) in static_ids for model in self.models]
+
+        self.V[:] = scene.camera.view()
+        self.light[:] = scene.light.position
+        self.state = scene.capture_state()
+        self.time = scene.time
+
+    def resolve(self, views):
+        '''
+        Build the draw list and the casters from the views of the models, on the render thread.
+        :param views: the views of the models, by model
+        '''
+        self.draws = []
+        self.static_casters = []
+        self.dynamic_casters = []
+        for i, model in enumerate(self.models):
+            view = views[model]
+            view.M = self.matrices[i]
+            pair = (view, self.parents[i])
+            self.draws.append(pair)
+            if self.static[i]:
+                self.static_casters.append(pair)
+            else:
+                self.dynamic_casters.append(pair)
+
+    def drop_released(self):
+        '''
+        Remove the models whose buffers were released since the snapshot was taken, such as the chunks of the world
+        evicted on the render thread.
+        '''
+        def kept(pairs):
+            return [(view, Mp) for view, Mp in pairs if view.arena is None or view.allocation is not None]
+
+        self.draws = kept(self.draws)
+        self.static_casters = kept(self.static_casters)
+        self.dynamic_casters = kept(self.dynamic_casters)
+
+
+class SnapshotBuffer:
+    '''
+    Triple buffer of snapshots. The simulation thread writes the back snapshot while the render thread draws the
+    front one, and the last snapshot published waits in the middle, so that neither thread waits for the other.
+    '''
+    def __init__(self):
+        self.back, self.middle, self.front = Snapshot(), Snapshot(), Snapshot()
+        self.fresh = False
+        self.lock = threading.Lock()
+
+        # counters for the statistics.
+        self.published = 0
+        self.skipped = 0
+
+    def publish(self):
+        '''
+        Publish the back snapshot, the one in the middle is dropped if it was not drawn.
+        '''
+        with self.lock:
+            self.back.published = time.perf_counter()
+            if self.fresh:
+                self.skipped += 1
+            self.back, self.middle = self.middle, self.back
+            self.fresh = True
+            self.published += 1
+
+    def acquire(self):
+        '''
+        Take the latest snapshot published.
+        :return: the snapshot to draw, and whether it is newer than the previous one
+        '''
+        with self.lock:
+            if not self.fresh:
+                return self.front, False
+            self.front, self.middle = self.middle, self.front
+            self.fresh = False
+            return self.front, True
+
+
+class SimulationThread:
+    '''
+    Class to run the simulation of a scene on its own thread and hand its snapshots to the render thread.
+    '''
+    def __init__(self, scene, max_steps=8):
+        '''
+        :param scene: the scene to simulate, its update() is called on the simulation thread
+        :param max_steps: the maximum number of steps per snapshot, the remaining time is dropped when the simulation
+        cannot keep up
+        '''
+        self.scene = scene
+        self.max_steps = max_steps
+        self.buffer = SnapshotBuffer()
+        self.thread = None
+        self.running = False
+
+        # the views of the models drawn, kept from one snapshot to the next so that command lists stay valid.
+        self.views = {}
+
+        # counters for the statistics.
+        self.steps = 0
+        self.behind = 0
+        self.update_time = 0.
+        self.capture_time = 0.
+        self.frames = 0
+        self.repeated = 0
+        self.render_time = 0.
+        self.latencies = []
+        self.started = 0.
+        self.elapsed = 0.
+        self.frame_start = 0.
+
+    def _capture(self, update_time):
+        start = time.perf_counter()
+        snapshot = self.buffer.back
+        snapshot.capture(self.scene)
+        snapshot.step = self.steps
+        snapshot.update_time = update_time
+        snapshot.capture_time = time.perf_counter() - start
+        self.update_time += update_time
+        self.capture_time += snapshot.capture_time
+
+    def start(self):
+        '''
+        Take a first snapshot, so that there is always one to draw, and start the thread.
+        '''
+        with self.scene.lock:
+            self._capture(0.)
+        self.buffer.publish()
+
+        self.running = True
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name='simulation', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        '''
+        Advance the simulation by as many fixed steps as fit in the elapsed time, and publish a snapshot after them.
+        '''
+        scene = self.scene
+        timestep = scene.timestep
+        previous = time.perf_counter()
+        accumulator = 0.
+        while self.running:
+            now = time.perf_counter()
+            accumulator += now - previous
+            previous = now
+            if accumulator < timestep:
+                time.sleep(timestep - accumulator)
+                continue
+
+            # the lock is released between the steps, so that the render thread can handle the input meanwhile.
+            update_time = 0.
+            steps = 0
+            while accumulator >= timestep and steps < self.max_steps:
+                with scene.lock:
+                    start = time.perf_counter()
+                    scene.update(timestep)
+                    scene.time += timestep
+                    update_time += time.perf_counter() - start
+                accumulator -= timestep
+                steps += 1
+            self.steps += steps
+            with scene.lock:
+                self._capture(update_time)
+            self.buffer.publish()
+
+            if steps == self.max_steps:
+                accumulator = 0.
+                self.behind += 1
+
+    def stop(self):
+        '''
+        Stop the thread after its current step.
+        '''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.elapsed += time.perf_counter() - self.started
+
+    def acquire(self):
+        '''
+        Take the latest snapshot to draw the next frame, on the render thread with the scene lock held. The scene
+        draws the snapshot, with the camera view of the snapshot, and reads the light position from the snapshot
+        rather than from the scene, where the light may have been moved since it was captured.
+        :return: whether the snapshot is newer than the one drawn in the previous frame
+        '''
+        self.frame_start = time.perf_counter()
+        snapshot, new = self.buffer.acquire()
+        scene = self.scene
+        if new:
+            views = {}
+            for model in snapshot.models:
+                view = self.views.get(model)
+                views[model] = view if view is not None else ModelView(model)
+            self.views = views
+            snapshot.resolve(views)
+            profiler.add('simulation', snapshot.update_time + snapshot.capture_time)
+
+        scene.snapshot = snapshot
+        scene.camera.V = snapshot.V
+        return new
+
+    def drawn(self, new):
+        '''
+        Count a frame drawn from the snapshot acquired, and the time from publishing the snapshot to the end of the
+        frame.
+        '''
+        now = time.perf_counter()
+        self.frames += 1
+        self.render_time += now - self.frame_start
+        if new:
+            latency = now - self.scene.snapshot.published
+            self.latencies.append(latency)
+            profiler.count('snapshot latency ms', 1000. * latency)
+        else:
+            self.repeated += 1
+
+    def stats(self):
+        '''
+        Return the statistics of the simulation and render threads.
+        '''
+        elapsed = self.elapsed + (time.perf_counter() - self.started if self.running else 0.)
+        snapshots = max(self.buffer.published, 1)
+        latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'steps': self.steps,
+            'snapshots': self.buffer.published,
+            'skipped': self.buffer.skipped,
+            'behind': self.behind,
+            'frames': self.frames,
+            'repeated': self.repeated,
+            'update_ms': 1000. * self.update_time / snapshots,
+            'capture_ms': 1000. * self.capture_time / snapshots,
+            'render_ms': 1000. * self.render_time / max(self.frames, 1),
+            'simulation_busy': (self.update_time + self.capture_time) / max(elapsed, 1e-9),
+            'render_busy': self.render_time / max(elapsed, 1e-9),
+            'latency_ms': 1000. * float(latencies.mean()),
+            'latency_p95_ms': 1000. * float(np.percentile(latencies, 95)),
+        }
+
+    def report(self):
+        '''
+        Print the statistics of the threads since the last report.
+        '''
+        stats = self.stats()
+        log.info('--> Simulation thread: %d steps in %d snapshots, %d not drawn, behind %d times',
+                 stats['steps'], stats['snapshots'], stats['skipped'], stats['behind'])
+        log.info('- update %.3f ms, capture %.3f ms per snapshot', stats['update_ms'], stats['capture_ms'])
+        log.info('- render thread: %d frames, %.3f ms each, %d redrawing a snapshot already drawn',
+                 stats['frames'], stats['render_ms'], stats['repeated'])
+        log.info('- busy: simulation %.0f%%, render %.0f%%',
+                 100. * stats['simulation_busy'], 100. * stats['render_busy'])
+        log.info('- snapshot latency: mean %.2f ms, p95 %.2f ms', stats['latency_ms'], stats['latency_p95_ms'])
+        self.latencies = []
+
+
+def benchmark(frames=300, tracks=10000, keys=16):
+    '''
+    Draw frames of the project scene headless with the traffic and a large number of animation tracks, once updating
+    and drawing serially and once with the simulation on its own thread, and report the frame time of the render
+    thread in both cases.
+    '''
+    from animation import Animator, quaternionFromAxisAngle
+    from project import ProjectScene
+
+    class Target:
+        def __init__(self):
+            self.M = np.identity(4, dtype='f')
+
+    scene = ProjectScene(headless=True)
+    scene.toggle_traffic()
+    scene.drive_car()
+
+    # heavy per-step logic: animation tracks on targets which are not drawn.
+    rng = np.random.default_rng(0)
+    animator = Animator()
+    for _ in range(tracks // 3):
+        times = np.sort(rng.uniform(0., 10., keys))
+        rotations = np.array([quaternionFromAxisAngle(axis, angle) for axis, angle in
+                              zip(rng.standard_normal((keys, 3)), rng.uniform(0., 6.28, keys))])
+        animator.add_clip(Target(), times, positions=rng.standard_normal((keys, 3)), rotations=rotations,
+                          scales=rng.uniform(0.5, 2., (keys, 3)))
+
+    update = scene.update
+
+    def heavy_update(dt):
+        update(dt)
+        animator.update(scene.time + dt)
+
+    scene.update = heavy_update
+
+    # serially, as Scene.run() does with one step per frame.
+    start = time.perf_counter()
+    for _ in range(frames):
+        scene.update(scene.timestep)
+        scene.time += scene.timestep
+        scene.draw()
+    serial = (time.perf_counter() - start) / frames
+    log.info('--> serial: %.3f ms per frame', 1000. * serial)
+
+    # threaded, drawing as fast as possible while the simulation steps in real time.
+    simulation = SimulationThread(scene)
+    simulation.start()
+    start = time.perf_counter()
+    for _ in range(frames):
+        with scene.lock:
+            new = simulation.acquire()
+        scene.draw()
+        simulation.drawn(new)
+    threaded = (time.perf_counter() - start) / frames
+    simulation.stop()
+    scene.snapshot = None
+
+    log.info('--> threaded: %.3f ms per frame', 1000. * threaded)
+    simulation.report()
+
+
+if __name__ == '__main__':
+    benchmark()
@@ -0,0 +1,385 @@
+# import requirements
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pygame
+
+from runtime import get_logger
+
+'''
+Software renderer reproducing the flat shader on the CPU with numpy, to render scenes without any GPU, e.g. for
+thumbnails or reference images. It uses the same meshes, materials, textures and Scene.P and Camera.V matrices as the
+OpenGL path.
+
+The frame is rendered in three passes:
+1. all triangles of the scene are transformed to the screen at once, and back faces are culled;
+2. the screen is split in tiles, each triangle is binned to the tiles its bounding box covers, and each tile is
+   rasterized with vectorised edge functions and a depth buffer, possibly in a pool of processes. This produces a
+   visibility buffer holding the triangle and the barycentric coordinates seen in each pixel;
+3. all visible pixels are shaded at once with the lighting model of shaders/flat/fragment_shader.glsl.
+Triangles crossing the near plane are clipped in view space beforehand, and fragments beyond the far plane are
+discarded, as the ground plane of the street crosses both.
+'''
+
+log = get_logger(__name__)
+
+
+def _clip_near(view, uv, near):
+    '''
+    Clip triangles against the near plane z = -near in view space, keeping their winding.
+    :param view: (T,3,3) view space positions of the triangle vertices
+    :param uv: (T,3,2) texture coordinates of the triangle vertices
+    :param near: the distance of the near plane
+    :return: the clipped view positions and texture coordinates, and the index of the source of each triangle
+    '''
+    inside = -view[..., 2] >= near
+    count = inside.sum(axis=1)
+    result = [(view[count == 3], uv[count == 3], np.flatnonzero(count == 3))]
+
+    # rotate the vertices so that the odd one out comes first, for triangles with one or two vertices inside.
+    for n in (1, 2):
+        source = np.flatnonzero(count == n)
+        if source.shape[0] == 0:
+            continue
+        odd = np.argmax(inside[source] if n == 1 else ~inside[source], axis=1)
+        order = (odd[:, np.newaxis] + np.arange(3)) % 3
+        v = np.take_along_axis(view[source], order[..., np.newaxis], axis=1)
+        t = np.take_along_axis(uv[source], order[..., np.newaxis], axis=1)
+        d = -v[..., 2] - near
+
+        # intersections of the edges from the first vertex with the near plane.
+        s1 = (d[:, 0] / (d[:, 0] - d[:, 1]))[:, np.newaxis]
+        s2 = (d[:, 0] / (d[:, 0] - d[:, 2]))[:, np.newaxis]
+        v1 = v[:, 0] + (v[:, 1] - v[:, 0]) * s1
+        v2 = v[:, 0] + (v[:, 2] - v[:, 0]) * s2
+        t1 = t[:, 0] + (t[:, 1] - t[:, 0]) * s1
+        t2 = t[:, 0] + (t[:, 2] - t[:, 0]) * s2
+
+        if n == 1:
+            # the first vertex is inside, the triangle shrinks.
+            result.append((np.stack([v[:, 0], v1, v2], axis=1), np.stack([t[:, 0], t1, t2], axis=1), source))
+        else:
+            # the first vertex is outside, the remaining quad is split in two triangles.
+            result.append((np.stack([v1, v[:, 1], v[:, 2]], axis=1), np.stack([t1, t[:, 1], t[:, 2]], axis=1), source))
+            result.append((np.stack([v1, v[:, 2], v2], axis=1), np.stack([t1, t[:, 2], t2], axis=1), source))
+
+    return tuple(np.concatenate(arrays) for arrays in zip(*result))
+
+
+def _rasterize_tile(task):
+    '''
+    Rasterize the triangles binned to one tile.
+    :param task: tuple of the tile rectangle (x0, y0, width, height), the (K,3,2) window coordinates, (K,3) depths
+    and (K,) indices of the triangles
+    :return: the tile rectangle, and the (h,w) triangle index and (h,w,3) barycentric coordinates of each pixel, with
+    index -1 where no triangle covers the pixel
+    '''
+    (x0, y0, w, h), xy, z, ids, chunk = task
+    px = np.tile(np.arange(x0, x0 + w) + 0.5, h)
+    py = np.repeat(np.arange(y0, y0 + h) + 0.5, w)
+
+    depth = np.full(w * h, np.inf)
+    triangle = np.full(w * h, -1, dtype=np.int64)
+    bary = np.zeros((w * h, 3))
+
+    for start in range(0, ids.shape[0], chunk):
+        a = xy[start:start + chunk, 0, :, np.newaxis]
+        b = xy[start:start + chunk, 1, :, np.newaxis]
+        c = xy[start:start + chunk, 2, :, np.newaxis]
+
+        # edge functions of the pixel centres, all positive inside the counter-clockwise triangles.
+        w0 = (c[:, 0] - b[:, 0]) * (py - b[:, 1]) - (c[:, 1] - b[:, 1]) * (px - b[:, 0])
+        w1 = (a[:, 0] - c[:, 0]) * (py - c[:, 1]) - (a[:, 1] - c[:, 1]) * (px - c[:, 0])
+        w2 = (b[:, 0] - a[:, 0]) * (py - a[:, 1]) - (b[:, 1] - a[:, 1]) * (px - a[:, 0])
+        area = w0 + w1 + w2
+        inside = (w0 >= 0.) & (w1 >= 0.) & (w2 >= 0.) & (area > 0.)
+
+        # interpolated depth, and the closest triangle of the chunk at each pixel.
+        area = np.where(area > 0., area, 1.)
+        zc = z[start:start + chunk]
+        fragment = (w0 * zc[:, 0, np.newaxis] + w1 * zc[:, 1, np.newaxis] + w2 * zc[:, 2, np.newaxis]) / area
+        # fragments beyond the far plane are clipped, as OpenGL does.
+        fragment = np.where(inside & (fragment <= 1.), fragment, np.inf)
+        closest = np.argmin(fragment, axis=0)
+        closest_depth = fragment[closest, np.arange(w * h)]
+
+        # depth test against the triangles of the previous chunks.
+        passed = closest_depth < depth
+        pixels = np.flatnonzero(passed)
+        k = closest[pixels]
+        depth[pixels] = closest_depth[pixels]
+        triangle[pixels] = ids[start + k]
+        bary[pixels] = np.stack([w0[k, pixels], w1[k, pixels], w2[k, pixels]], axis=1) / area[k, pixels, np.newaxis]
+
+    return (x0, y0, w, h), triangle.reshape(h, w), bary.reshape(h, w, 3)
+
+
+class SoftwareRenderer:
+    '''
+    Class to render scenes to images on the CPU.
+    '''
+    def __init__(self, width=1800, height=960, tile=64, workers=None, chunk=32, background=(0.1, 0.7, 1.0)):
+        '''
+        :param width: the width of the images in pixels
+        :param height: the height of the images in pixels
+        :param tile: the size of the square tiles in pixels
+        :param workers: number of worker processes rasterizing the tiles, all cores if None, 1 to run in process
+        :param chunk: the number of triangles rasterized together in a tile
+        :param background: the clear colour, the same as the OpenGL scene
+        '''
+        self.width = width
+        self.height = height
+        self.tile = tile
+        self.workers = os.cpu_count() if workers is None else workers
+        self.chunk = chunk
+        self.background = np.array(background)
+        self.pool = None
+
+        # texture images loaded from ./textures/, by file name.
+        self.textures = {}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def _texture(self, name):
+        '''
+        The (H,W,3) image of a texture, flipped so that rows go up as the texture coordinate v does in OpenGL.
+        '''
+        if name not in self.textures:
+            img = pygame.image.load('./textures/{}'.format(name))
+            self.textures[name] = np.flip(pygame.surfarray.array3d(img).transpose(1, 0, 2), axis=0) / 255.
+        return self.textures[name]
+
+    def _gather(self, scene, draw_list):
+        '''
+        Transform the triangles of all models to view space and clip space, and collect their attributes.
+        '''
+        V = scene.camera.V
+        positions = []
+        uvs = []
+        materials = []
+        textures = []
+        counts = []
+        for model, Mp in draw_list:
+            mesh = model.mesh
+            if not model.visible or mesh.faces is None:
+                continue
+
+            faces = mesh.faces
+            if faces.shape[1] == 4:
+                faces = np.concatenate([faces[:, [0, 1, 2]], faces[:, [0, 2, 3]]])
+
+            VM = np.matmul(V, np.matmul(Mp, model.M))
+            view = np.matmul(mesh.vertices, VM[:3, :3].T) + VM[:3, 3]
+            positions.append(view[faces])
+            uvs.append(mesh.textureCoords[faces] if mesh.textureCoords is not None else np.zeros(faces.shape + (2,)))
+            materials.append(mesh.material)
+            textures.append(mesh.textures[0].name if len(mesh.textures) > 0 else None)
+            counts.append(faces.shape[0])
+
+        if not positions:
+            return None
+
+        # the distance of the near plane, from the projection matrix.
+        near = scene.P[2, 3] / (scene.P[2, 2] - 1.)
+        view, uv, source = _clip_near(np.concatenate(positions), np.concatenate(uvs), near)
+
+        # material parameters of each triangle.
+        material = np.repeat(np.arange(len(materials)), counts)[source]
+        return {
+            'view': view,
+            'uv': uv,
+            'material': material,
+            'Ka': np.array([m.Ka for m in materials], dtype=np.float64)[material],
+            'Kd': np.array([m.Kd for m in materials], dtype=np.float64)[material],
+            'Ks': np.array([m.Ks for m in materials], dtype=np.float64)[material],
+            'Ns': np.array([m.Ns for m in materials], dtype=np.float64)[material],
+            'texture': textures,
+        }
+
+    def _project(self, scene, view):
+        '''
+        Project the view space triangles to window coordinates, with y up as in OpenGL.
+        :return: the (T,3,2) window coordinates, (T,3) depths and the mask of the triangles to rasterize
+        '''
+        clip = np.matmul(view, scene.P[:3, :3].T) + scene.P[:3, 3]
+        w = np.matmul(view, scene.P[3, :3]) + scene.P[3, 3]
+        keep = np.all(w > 1e-6, axis=1)
+        w = np.where(keep[:, np.newaxis], w, 1.)
+        ndc = clip / w[..., np.newaxis]
+
+        xy = np.empty(ndc.shape[:2] + (2,))
+        xy[..., 0] = (ndc[..., 0] + 1.) * self.width / 2.
+        xy[..., 1] = (ndc[..., 1] + 1.) * self.height / 2.
+
+        # back faces are clockwise in window coordinates, as GL_CULL_FACE culls them.
+        e1 = xy[:, 1] - xy[:, 0]
+        e2 = xy[:, 2] - xy[:, 0]
+        keep &= e1[:, 0] * e2[:, 1] - e1[:, 1] * e2[:, 0] > 0.
+
+        # triangles entirely off screen or beyond the depth range.
+        keep &= (xy[..., 0].max(axis=1) >= 0.) & (xy[..., 0].min(axis=1) < self.width)
+        keep &= (xy[..., 1].max(axis=1) >= 0.) & (xy[..., 1].min(axis=1) < self.height)
+        keep &= np.any(ndc[..., 2] <= 1., axis=1) & np.any(ndc[..., 2] >= -1., axis=1)
+        return xy, ndc[..., 2], keep
+
+    def _tasks(self, xy, z, ids):
+        '''
+        Bin the triangles to the tiles their bounding box overlaps, and build one task per non-empty tile.
+        '''
+        tiles_x = (self.width + self.tile - 1) // self.tile
+        tiles_y = (self.height + self.tile - 1) // self.tile
+        low = np.clip(np.floor(xy.min(axis=1) / self.tile).astype(np.int64), 0, [tiles_x - 1, tiles_y - 1])
+        high = np.clip(np.floor(xy.max(axis=1) / self.tile).astype(np.int64), 0, [tiles_x - 1, tiles_y - 1])
+
+        # expand each triangle to all tiles of its bounding box.
+        size = high - low + 1
+        counts = size[:, 0] * size[:, 1]
+        owner = np.repeat(np.arange(ids.shape[0]), counts)
+        local = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        tile = (low[owner, 1] + local // size[owner, 0]) * tiles_x + low[owner, 0] + local % size[owner, 0]
+
+        order = np.argsort(tile, kind='stable')
+        tile = tile[order]
+        owner = owner[order]
+        bounds = np.flatnonzero(np.diff(tile)) + 1
+        tasks = []
+        for members in np.split(np.arange(tile.shape[0]), bounds):
+            if members.shape[0] == 0:
+                continue
+            t = tile[members[0]]
+            x0 = (t % tiles_x) * self.tile
+            y0 = (t // tiles_x) * self.tile
+            rect = (x0, y0, min(self.tile, self.width - x0), min(self.tile, self.height - y0))
+            k = owner[members]
+            tasks.append((rect, xy[k], z[k], ids[k], self.chunk))
+        return tasks
+
+    def _shade(self, scene, data, triangle, bary):
+        '''
+        Shade the visible pixels with the flat shader lighting model.
+        :return: the (N,3) colours of the pixels
+        '''
+        view = data['view'][triangle]
+        w = 1. / np.maximum(-view[..., 2], 1e-6)
+
+        # perspective correct interpolation of the attributes.
+        weights = bary * w
+        weights /= weights.sum(axis=1, keepdims=True)
+        position = np.einsum('nk,nkj->nj', weights, view)
+        uv = np.einsum('nk,nkj->nj', weights, data['uv'][triangle])
+
+        # the face normal, as obtained from the derivatives of the position in the shader, faces the camera.
+        normal = np.cross(view[:, 1] - view[:, 0], view[:, 2] - view[:, 0])
+        normal /= np.maximum(np.linalg.norm(normal, axis=1, keepdims=True), 1e-12)
+        normal *= np.where(np.sum(normal * position, axis=1) > 0., -1., 1.)[:, np.newaxis]
+
+        light = scene.camera.V[:3, :3] @ scene.light.position + scene.camera.V[:3, 3]
+        to_light = light - position
+        dist = np.linalg.norm(to_light, axis=1)
+        light_direction = to_light / np.maximum(dist, 1e-12)[:, np.newaxis]
+        camera_direction = -position / np.maximum(np.linalg.norm(position, axis=1, keepdims=True), 1e-12)
+
+        Ka = data['Ka'][triangle]
+        Kd = data['Kd'][triangle]
+        Ks = data['Ks'][triangle]
+        Ns = data['Ns'][triangle]
+
+        ambient = np.array(scene.light.Ia) * Ka
+        diffuse = np.array(scene.light.Id) * Kd * np.maximum(0., np.sum(light_direction * normal, axis=1))[:, np.newaxis]
+        reflected = light_direction - 2. * np.sum(normal * light_direction, axis=1)[:, np.newaxis] * normal
+        specular = np.array(scene.light.Is) * Ks * (
+            np.maximum(0., np.sum(reflected * -camera_direction, axis=1)) ** Ns)[:, np.newaxis]
+        attenuation = np.minimum(1. / (dist * dist * 0.005) + 1. / (dist * 0.05), 1.)[:, np.newaxis]
+
+        # nearest neighbour sampling with repeat wrapping, as the Texture class sets up.
+        texval = np.ones((triangle.shape[0], 3))
+        material = data['material'][triangle]
+        for index, name in enumerate(data['texture']):
+            if name is None:
+                continue
+            pixels = np.flatnonzero(material == index)
+            if pixels.shape[0] == 0:
+                continue
+            image = self._texture(name)
+            tx = np.floor(uv[pixels, 0] * image.shape[1]).astype(np.int64) % image.shape[1]
+            ty = np.floor(uv[pixels, 1] * image.shape[0]).astype(np.int64) % image.shape[0]
+            texval[pixels] = image[ty, tx]
+
+        return texval * ambient + attenuation * (texval * diffuse + specular)
+
+    def render(self, scene, draw_list=None):
+        '''
+        Render a frame of a scene.
+        :param scene: the scene, providing the P matrix, the camera and the light
+        :param draw_list: [optional] list of (model, parent matrix) pairs to draw, scene.draw_list() if None
+        :return: the (height,width,3) uint8 image, top row first
+        '''
+        if draw_list is None:
+            draw_list = scene.draw_list()
+
+        image = np.tile(self.background, (self.height, self.width, 1))
+        data = self._gather(scene, draw_list)
+        if data is not None:
+            xy, z, keep = self._project(scene, data['view'])
+            ids = np.flatnonzero(keep)
+            tasks = self._tasks(xy[ids], z[ids], ids)
+
+            if self.workers > 1 and len(tasks) > 1:
+                if self.pool is None:
+                    self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                results = self.pool.map(_rasterize_tile, tasks, chunksize=max(1, len(tasks) // (4 * self.workers)))
+            else:
+                results = map(_rasterize_tile, tasks)
+
+            # gather the visibility buffer of the tiles.
+            triangle = np.full((self.height, self.width), -1, dtype=np.int64)
+            bary = np.zeros((self.height, self.width, 3))
+            for (x0, y0, w, h), tile_triangle, tile_bary in results:
+                triangle[y0:y0 + h, x0:x0 + w] = tile_triangle
+                bary[y0:y0 + h, x0:x0 + w] = tile_bary
+
+            covered = triangle >= 0
+            image[covered] = self._shade(scene, data, triangle[covered], bary[covered])
+
+        # window coordinates go up, images go down.
+        return (np.clip(np.flip(image, axis=0), 0., 1.) * 255. + 0.5).astype(np.uint8)
+
+    @staticmethod
+    def save(image, file_name):
+        '''
+        Save an image as PNG.
+        '''
+        pygame.image.save(pygame.surfarray.make_surface(image.transpose(1, 0, 2)), file_name)
+
+
+def benchmark(frames=10, workers=None, file_name='softrender.png'):
+    '''
+    Render frames of the project scene at 1800x960 without any GPU, save the last one and report the frame rate.
+    '''
+    from project import ProjectScene
+
+    scene = ProjectScene(headless=True)
+    scene.toggle_traffic()
+    renderer = SoftwareRenderer(scene.window_size[0], scene.window_size[1], workers=workers)
+
+    # the first frame starts the worker processes and loads the textures.
+    renderer.render(scene)
+    start = time.perf_counter()
+    for _ in range(frames):
+        scene.update(scene.timestep)
+        image = renderer.render(scene)
+    elapsed = time.perf_counter() - start
+    renderer.close()
+
+    renderer.save(image, file_name)
+    log.info('--> %d frames of %dx%d using %d worker(s): %.2f fps, saved %s',
+             frames, renderer.width, renderer.height, renderer.workers, frames / elapsed, file_name)
+
+
+if __name__ == '__main__':
+    benchmark()
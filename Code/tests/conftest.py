@@ -0,0 +1,18 @@
+# import requirements
+import os
+import sys
+
+import pytest
+
+'''
+The scene modules are imported from the Code directory, and load their models, shaders and textures from paths
+relative to it, so the tests run from there.
+'''
+
+CODE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE)
+
+
+@pytest.fixture(autouse=True)
+def code_directory(monkeypatch):
+    monkeypatch.chdir(CODE)
@@ -0,0 +1,70 @@
+# import requirements
+import glbackend
+from glbackend import RecordingBackend
+from project import ProjectScene
+from scene import Scene
+from texstream import texture_streamer
+
+'''
+Budgets of the GL calls per frame, checked by drawing frames with the no-op recording backend, without any window
+or GPU.
+'''
+
+# maximum number of calls per frame of the project scene, by category or by GL function. They are the counts of the
+# scene, so that any change adding calls has to raise them.
+# The texture binds vary by a few calls with the textures streamed in, and are given some headroom.
+STATIC_BUDGETS = {
+    'draw': 19,
+    'program': 17,
+    'vertex array': 6,
+    'uniform': 36,
+    'buffer': 6,
+    'glUniformMatrix4fv': 20,
+    'glBindTexture': 24,
+}
+
+# the same with the traffic and the car driven along the road.
+TRAFFIC_BUDGETS = {
+    'draw': 76,
+    'program': 38,
+    'vertex array': 42,
+    'uniform': 96,
+    'buffer': 6,
+    'glUniformMatrix4fv': 77,
+    'glBindTexture': 52,
+}
+
+
+def draw_frames(scene, frames=3):
+    '''
+    Draw a few frames of a scene, and return the recording backend holding their calls.
+    '''
+    for _ in range(frames):
+        scene.update(scene.timestep)
+        scene.draw()
+
+    # the textures are decoded on another thread, finished before leaving the Code directory.
+    texture_streamer.wait()
+    return glbackend.backend()
+
+
+def test_empty_scene():
+    scene = Scene(headless=True)
+    assert isinstance(glbackend.backend(), RecordingBackend)
+
+    # the frame of the recording backend ends when the scene is flipped at the end of draw().
+    scene.draw()
+    glbackend.backend().assert_budgets({'draw': 0, 'program': 0})
+
+
+def test_project_scene():
+    recorder = draw_frames(ProjectScene(headless=True))
+    assert recorder.frame_counts(by_category=True)['draw'] > 0
+    recorder.assert_budgets(STATIC_BUDGETS)
+
+
+def test_traffic():
+    scene = ProjectScene(headless=True)
+    scene.toggle_traffic()
+    scene.drive_car()
+    draw_frames(scene).assert_budgets(TRAFFIC_BUDGETS)
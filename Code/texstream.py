@@ -0,0 +1,374 @@
+# import requirements
+import queue
+import threading
+
+import numpy as np
+import pygame
+
+from glbackend import gl
+
+from texture import Texture
+
+from collision import mesh_bounds
+
+# CPU profiler, showing the streaming metrics as counters.
+from profiler import profiler
+
+from runtime import get_logger
+
+'''
+Progressive streaming of the textures from low to high resolution. Instead of decoding and uploading the whole image
+when a mesh is created, a streamed texture starts as a single placeholder texel, the image is decoded and its mip
+chain built in a background thread, and the small levels of the mip tail are uploaded as soon as they are ready. The
+higher levels are then uploaded with glTexSubImage2D a few rows at a time under a per-frame budget, in the order of
+the screen-space size of the models using the textures, down to the level matching that size. The levels above the
+mip tail of the textures which have not been drawn for a while are released. GL_TEXTURE_BASE_LEVEL always points to
+the finest complete level, so that the texture can be sampled at any time.
+'''
+
+log = get_logger(__name__)
+
+# the mip levels of at most this size are uploaded as soon as the image is decoded, and never released.
+TAIL_SIZE = 32
+
+
+def mip_chain(image):
+    '''
+    Build the mip levels of an image by averaging blocks of 2x2 texels, down to a single texel.
+    :param image: (height, width, channels) array of uint8
+    :return: the list of levels, the image first
+    '''
+    levels = [image]
+    while max(image.shape[:2]) > 1:
+        block = image.astype(np.uint16)
+        count = 1
+        # odd sizes drop their last row or column, as GL sizes the levels by rounding down.
+        if block.shape[0] > 1:
+            h = block.shape[0] // 2 * 2
+            block = block[0:h:2] + block[1:h:2]
+            count *= 2
+        if block.shape[1] > 1:
+            w = block.shape[1] // 2 * 2
+            block = block[:, 0:w:2] + block[:, 1:w:2]
+            count *= 2
+        image = ((block + count // 2) // count).astype(np.uint8)
+        levels.append(image)
+    return levels
+
+
+class StreamedTexture(Texture):
+    '''
+    Class to hold a texture whose mip levels are streamed by a TextureStreamer.
+    '''
+    def __init__(self, name, wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST):
+        self.name = name
+        self.format = gl.GL_RGBA
+        self.type = gl.GL_UNSIGNED_BYTE
+        self.wrap = wrap
+        self.sample = sample
+        self.target = gl.GL_TEXTURE_2D
+
+        self.textureid = gl.glGenTextures(1)
+
+        # the decoded mip chain, None until the decoder thread has built it.
+        self.levels = None
+        self.tail = 0
+
+        # the finest complete level, the level being uploaded and its next row.
+        self.base = 0
+        self.row = 0
+
+        # the level requested by the models drawn this frame, their largest size on screen and the last frame drawn.
+        self.wanted = None
+        self.priority = 0.
+        self.last_seen = 0
+
+        log.debug('* Streaming texture ./textures/%s at ID %s', name, self.textureid)
+
+        # a white texel, until the mip tail is decoded.
+        self.bind()
+        gl.glTexImage2D(self.target, 0, self.format, 1, 1, 0, self.format, self.type, np.full(4, 255, dtype=np.uint8))
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_BASE_LEVEL, 0)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAX_LEVEL, 0)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_S, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_T, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, sample)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER, sample)
+        self.unbind()
+
+    def set_levels(self, levels):
+        '''
+        Store the decoded mip chain and upload its tail, making it the texture sampled.
+        '''
+        self.levels = levels
+        self.tail = next(level for level, image in enumerate(levels) if max(image.shape[:2]) <= TAIL_SIZE)
+
+        self.bind()
+        for level in range(self.tail, len(levels)):
+            image = levels[level]
+            gl.glTexImage2D(self.target, level, self.format, image.shape[1], image.shape[0], 0, self.format,
+                            self.type, image)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAX_LEVEL, len(levels) - 1)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER, gl.GL_LINEAR_MIPMAP_LINEAR
+                           if self.sample == gl.GL_LINEAR else gl.GL_NEAREST_MIPMAP_NEAREST)
+        self._set_base(self.tail)
+
+    def _set_base(self, level):
+        '''
+        Make a level the finest one sampled, the texture must be bound.
+        '''
+        self.base = level
+        self.row = 0
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_BASE_LEVEL, level)
+
+    def level_bytes(self, level):
+        image = self.levels[level]
+        return image.shape[0] * image.shape[1] * image.shape[2]
+
+    def upload(self, budget):
+        '''
+        Upload the next rows of the level above the finest complete one.
+        :param budget: the number of bytes which may be uploaded
+        :return: the number of bytes uploaded
+        '''
+        level = self.base - 1
+        image = self.levels[level]
+        row_bytes = image.shape[1] * image.shape[2]
+        rows = min(image.shape[0] - self.row, max(1, budget // row_bytes))
+
+        self.bind()
+        # the storage of the level is allocated with its first rows.
+        if self.row == 0:
+            gl.glTexImage2D(self.target, level, self.format, image.shape[1], image.shape[0], 0, self.format,
+                            self.type, None)
+        gl.glTexSubImage2D(self.target, level, 0, self.row, image.shape[1], rows, self.format, self.type,
+                           image[self.row:self.row + rows])
+        self.row += rows
+
+        if self.row == image.shape[0]:
+            self._set_base(level)
+        self.unbind()
+        return rows * row_bytes
+
+    def release(self):
+        '''
+        Release the levels above the mip tail.
+        '''
+        self.bind()
+        for level in range(0, self.tail):
+            gl.glTexImage2D(self.target, level, self.format, 0, 0, 0, self.format, self.type, None)
+        self._set_base(self.tail)
+        self.unbind()
+
+    def resident_bytes(self):
+        '''
+        The size of the levels in GPU memory, including the level being uploaded.
+        '''
+        if self.levels is None:
+            return 4
+        first = self.base - 1 if self.row > 0 else self.base
+        return sum(self.level_bytes(level) for level in range(first, len(self.levels)))
+
+    def backlog_bytes(self):
+        '''
+        The size of the levels requested this frame and not uploaded yet.
+        '''
+        if self.levels is None or self.wanted is None or self.wanted >= self.base:
+            return 0
+        return sum(self.level_bytes(level) for level in range(self.wanted, self.base)) - \
+            self.row * self.levels[self.base - 1].shape[1] * self.levels[self.base - 1].shape[2]
+
+
+class TextureStreamer:
+    '''
+    Class to stream the textures of the meshes, shared by all scenes.
+    '''
+    def __init__(self, budget=1 << 20, evict_frames=300, enabled=False):
+        '''
+        :param budget: the number of bytes uploaded per frame, beyond the mip tails
+        :param evict_frames: the number of frames after which the levels above the tail of a texture not drawn are
+        released
+        :param enabled: whether the meshes create streamed textures
+        '''
+        self.budget = budget
+        self.evict_frames = evict_frames
+        self.enabled = enabled
+
+        # streamed textures by name, shared by the meshes using the same image.
+        self.textures = {}
+
+        # local bounding spheres of the meshes, by mesh.
+        self.spheres = {}
+
+        self.requests = queue.Queue()
+        self.decoded = queue.Queue()
+        self.decoder = None
+        self.pending = 0
+
+        self.frame = 0
+        self.uploaded = 0
+        self.total_uploaded = 0
+        self.evictions = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def texture(self, name):
+        '''
+        Returns the streamed texture of an image in the textures folder, queueing its decoding the first time.
+        '''
+        texture = self.textures.get(name)
+        if texture is None:
+            texture = StreamedTexture(name)
+            self.textures[name] = texture
+            if self.decoder is None:
+                self.decoder = threading.Thread(target=self._decode, daemon=True)
+                self.decoder.start()
+            self.pending += 1
+            self.requests.put(name)
+        return texture
+
+    def _decode(self):
+        '''
+        Decoder thread, loading the images and building their mip chains until stopped.
+        '''
+        while True:
+            name = self.requests.get()
+            if name is None:
+                break
+            try:
+                image = pygame.image.load('./textures/{}'.format(name))
+                data = np.frombuffer(pygame.image.tostring(image, 'RGBA', 1), dtype=np.uint8)
+                self.decoded.put((name, mip_chain(data.reshape(image.get_height(), image.get_width(), 4))))
+            except (pygame.error, OSError) as error:
+                log.warning('cannot decode texture %s (%s), keeping its placeholder', name, error)
+                self.decoded.put((name, None))
+
+    def wait(self):
+        '''
+        Block until all the queued images are decoded, and upload their mip tails.
+        '''
+        while self.pending > 0:
+            self._receive(self.decoded.get())
+
+    def _receive(self, result):
+        name, levels = result
+        self.pending -= 1
+        if levels is not None:
+            self.textures[name].set_levels(levels)
+
+    def screen_sizes(self, models, P, V, window_size):
+        '''
+        The size in pixels of the bounding spheres of models on screen, the height of the window if the camera is inside.
+        :param models: the list of (model, parent matrix) pairs
+        '''
+        centers = np.empty((len(models), 4), dtype=np.float32)
+        radii = np.empty(len(models), dtype=np.float32)
+        for i, (model, Mp) in enumerate(models):
+            sphere = self.spheres.get(id(model.mesh))
+            if sphere is None:
+                low, high = mesh_bounds(model.mesh.vertices, model.mesh.faces)
+                sphere = (np.append((low + high) / 2., 1.), np.linalg.norm(high - low) / 2.)
+                self.spheres[id(model.mesh)] = sphere
+            VM = np.matmul(V, np.matmul(Mp, model.M))
+            centers[i] = VM @ sphere[0]
+            radii[i] = sphere[1] * np.linalg.norm(VM[:3, :3], axis=0).max()
+
+        depth = -centers[:, 2]
+        height = window_size[1]
+        return np.where(depth > radii, radii * P[1, 1] * height / np.maximum(depth, 1e-6), height)
+
+    def update(self, models, P, V, window_size):
+        '''
+        Upload the decoded mip tails, and the next rows of the levels requested by the models drawn in this frame,
+        most visible first, and release the high levels of the textures not drawn for a while.
+        :param models: the list of (model, parent matrix) pairs drawn in this frame
+        '''
+        self.frame += 1
+        while self.pending > 0:
+            try:
+                self._receive(self.decoded.get_nowait())
+            except queue.Empty:
+                break
+
+        for texture in self.textures.values():
+            texture.wanted = None
+            texture.priority = 0.
+
+        streamed = [(model, Mp) for model, Mp in models if model.visible and any(
+            isinstance(texture, StreamedTexture) for texture in model.mesh.textures)]
+        if streamed:
+            sizes = self.screen_sizes(streamed, P, V, window_size)
+            for (model, _), size in zip(streamed, sizes):
+                for texture in model.mesh.textures:
+                    if not isinstance(texture, StreamedTexture) or texture.levels is None:
+                        continue
+                    # the level with about one texel per pixel, assuming the texture covers the model once.
+                    level = int(np.clip(np.floor(np.log2(texture.levels[0].shape[1] / max(size, 1.))), 0, texture.tail))
+                    texture.wanted = level if texture.wanted is None else min(texture.wanted, level)
+                    texture.priority = max(texture.priority, size)
+                    texture.last_seen = self.frame
+
+        # the levels above the tail of the textures not drawn for a while are released.
+        for texture in self.textures.values():
+            if texture.levels is not None and (texture.base < texture.tail or texture.row > 0) and \
+                    self.frame - texture.last_seen > self.evict_frames:
+                texture.release()
+                self.evictions += 1
+
+        budget = self.budget
+        queued = sorted([texture for texture in self.textures.values()
+                         if texture.wanted is not None and texture.wanted < texture.base],
+                        key=lambda texture: -texture.priority)
+        for texture in queued:
+            while budget > 0 and texture.wanted < texture.base:
+                budget -= texture.upload(budget)
+            if budget <= 0:
+                break
+
+        self.uploaded = self.budget - budget
+        self.total_uploaded += self.uploaded
+
+        if profiler.enabled:
+            stats = self.stats()
+            profiler.count('texture resident MB', stats['resident'] / 2**20)
+            profiler.count('texture backlog MB', stats['backlog'] / 2**20)
+
+    def stats(self):
+        '''
+        The streaming metrics: the texture memory resident, the bytes still to upload for the current frame, the
+        images waiting to be decoded and the bytes uploaded in the last frame.
+        '''
+        return {
+            'textures': len(self.textures),
+            'resident': sum(texture.resident_bytes() for texture in self.textures.values()),
+            'backlog': sum(texture.backlog_bytes() for texture in self.textures.values()),
+            'pending decodes': self.pending,
+            'uploaded': self.uploaded,
+            'evictions': self.evictions,
+        }
+
+    def report(self):
+        stats = self.stats()
+        log.info('--> Texture streaming: %d textures, %.1f MB resident, %.1f MB backlog, %d pending decode(s)',
+                 stats['textures'], stats['resident'] / 2**20, stats['backlog'] / 2**20, stats['pending decodes'])
+        log.info('- %.1f MB uploaded over %d frames, %d eviction(s)',
+                 self.total_uploaded / 2**20, self.frame, stats['evictions'])
+
+    def stop(self):
+        '''
+        Stop the decoder thread.
+        '''
+        if self.decoder is not None:
+            self.requests.put(None)
+            self.decoder.join()
+            self.decoder = None
+
+    def delete(self):
+        self.stop()
+        if self.textures:
+            gl.glDeleteTextures([texture.textureid for texture in self.textures.values()])
+        self.textures = {}
+
+
+texture_streamer = TextureStreamer()
@@ -1,13 +1,17 @@
 import pygame
-from OpenGL.GL import *
+from glbackend import gl
 import numpy as np
 
+from runtime import get_logger
+
+log = get_logger(__name__)
+
 
 class Texture:
     '''
     Class to handle texture loading.
     '''
-    def __init__(self, name, img=None, wrap=GL_REPEAT, sample=GL_NEAREST, format=GL_RGBA, type=GL_UNSIGNED_BYTE, target=GL_TEXTURE_2D):
+    def __init__(self, name, img=None, wrap=gl.GL_REPEAT, sample=gl.GL_NEAREST, format=gl.GL_RGBA, type=gl.GL_UNSIGNED_BYTE, target=gl.GL_TEXTURE_2D):
         self.name = name
         self.format = format
         self.type = type
@@ -15,49 +19,49 @@ class Texture:
         self.sample = sample
         self.target = target
 
-        self.textureid = glGenTextures(1)
+        self.textureid = gl.glGenTextures(1)
 
-        print('* Loading texture {} at ID {}'.format('./textures/{}'.format(name), self.textureid))
+        log.debug('* Loading texture ./textures/%s at ID %s', name, self.textureid)
 
         self.bind()
 
         if img is None:
             # load the image from file using pyGame - any other image reading function could be used here.
-            print('Loading texture: texture/{}'.format(name))
+            log.debug('Loading texture: texture/%s', name)
             img = pygame.image.load('./textures/{}'.format(name))
 
             # convert the python image object to a plain byte array for passsing to OpenGL
             data = pygame.image.tostring(img, "RGBA", 1)
 
             # load the texture in the buffer
-            glTexImage2D(self.target, 0, format, img.get_width(), img.get_height(), 0, format, type, data)
+            gl.glTexImage2D(self.target, 0, format, img.get_width(), img.get_height(), 0, format, type, data)
         else:
             # if a data array is provided use this
-            glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
+            gl.glTexImage2D(self.target, 0, format, img.shape[0], img.shape[1], 0, format, type, img)
 
 
         # set what happens for texture coordinates outside [0,1]
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_T, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_S, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_T, wrap)
 
         # set how sampling from the texture is done.
-        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, sample)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER, sample)
 
         self.unbind()
 
-    def set_wrap_parameter(self, wrap=GL_REPEAT):
+    def set_wrap_parameter(self, wrap=gl.GL_REPEAT):
         self.wrap = wrap
         self.bind()
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_S, wrap)
-        glTexParameteri(self.target, GL_TEXTURE_WRAP_T, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_S, wrap)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_WRAP_T, wrap)
         self.unbind()
 
-    def set_sampling_parameter(self, sample=GL_NEAREST):
+    def set_sampling_parameter(self, sample=gl.GL_NEAREST):
         self.sample = sample
         self.bind()
-        glTexParameteri(self.target, GL_TEXTURE_MAG_FILTER, sample)
-        glTexParameteri(self.target, GL_TEXTURE_MIN_FILTER, sample)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MAG_FILTER, sample)
+        gl.glTexParameteri(self.target, gl.GL_TEXTURE_MIN_FILTER, sample)
         self.unbind()
 
     def set_data_from_image(self, data, width=None, height=None):
@@ -68,12 +72,12 @@ class Texture:
         self.bind()
 
         # load the texture in the buffer
-        glTexImage2D(self.target, 0, self.format, width, height, 0, self.format, self.type, data)
+        gl.glTexImage2D(self.target, 0, self.format, width, height, 0, self.format, self.type, data)
 
         self.unbind()
 
     def bind(self):
-        glBindTexture(self.target, self.textureid)
+        gl.glBindTexture(self.target, self.textureid)
 
     def unbind(self):
-        glBindTexture(self.target, 0)
+        gl.glBindTexture(self.target, 0)
@@ -0,0 +1,144 @@
+# import requirements
+import time
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+Helpers for the main loop: pacing the frames to a maximum rate, and measuring the frame times, their jitter and the
+CPU time used while rendering and while idle.
+'''
+
+log = get_logger(__name__)
+
+
+class FramePacer:
+    '''
+    Class to cap the frame rate. Waiting sleeps for most of the remaining frame time, as the operating system may
+    oversleep by a millisecond or more, and yields in a loop for the last part to hit the deadline accurately.
+    '''
+    def __init__(self, max_fps=None, spin=0.002):
+        '''
+        :param max_fps: the maximum frame rate, or None for no cap
+        :param spin: the duration at the end of each frame spent yielding rather than sleeping, in seconds
+        '''
+        self.period = 1. / max_fps if max_fps else 0.
+        self.spin = spin
+        self.deadline = time.perf_counter()
+
+    def wait(self, period=None):
+        '''
+        Wait until the end of the current frame.
+        :param period: [optional] duration of this frame, the capped frame period if None
+        '''
+        period = self.period if period is None else period
+        if period <= 0.:
+            return
+
+        self.deadline += period
+        now = time.perf_counter()
+
+        # after a long frame, restart from now rather than rushing to catch up.
+        if self.deadline < now:
+            self.deadline = now
+            return
+
+        if self.deadline - now > self.spin:
+            time.sleep(self.deadline - now - self.spin)
+        while time.perf_counter() < self.deadline:
+            time.sleep(0)
+
+
+class FrameStats:
+    '''
+    Class to measure the main loop. Each iteration is recorded as either a rendered frame or an idle iteration,
+    with its wall-clock and CPU durations. Frame times are kept in a ring buffer over the last frames.
+    '''
+    def __init__(self, window=600):
+        '''
+        :param window: the number of frame times kept
+        '''
+        self.frame_times = np.zeros(window)
+        self.count = 0
+        self.last_frame = None
+
+        # wall-clock and CPU time spent in rendered frames and in idle iterations.
+        self.wall = {True: 0., False: 0.}
+        self.cpu = {True: 0., False: 0.}
+        self.iterations = {True: 0, False: 0}
+
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def record(self, rendered):
+        '''
+        Record the end of an iteration of the main loop.
+        :param rendered: whether the iteration drew a frame
+        '''
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        self.wall[rendered] += wall - self.wall_start
+        self.cpu[rendered] += cpu - self.cpu_start
+        self.iterations[rendered] += 1
+        self.wall_start = wall
+        self.cpu_start = cpu
+
+        if rendered:
+            if self.last_frame is not None:
+                self.frame_times[self.count % self.frame_times.shape[0]] = wall - self.last_frame
+                self.count += 1
+            self.last_frame = wall
+
+    def times(self):
+        '''
+        The recorded frame times in seconds, oldest first.
+        '''
+        n = self.frame_times.shape[0]
+        if self.count <= n:
+            return self.frame_times[:self.count]
+        return np.roll(self.frame_times, -(self.count % n))
+
+    def cpu_usage(self, rendered=None):
+        '''
+        The fraction of one core used by the process, over all iterations or only the rendered or idle ones.
+        '''
+        kinds = [True, False] if rendered is None else [rendered]
+        wall = sum(self.wall[kind] for kind in kinds)
+        return sum(self.cpu[kind] for kind in kinds) / wall if wall > 0. else 0.
+
+    def summary(self):
+        '''
+        Returns a dictionary of the statistics, times in milliseconds.
+        '''
+        times = 1000. * self.times()
+        wall = self.wall[True] + self.wall[False]
+        summary = {
+            'frames': self.iterations[True],
+            'idle iterations': self.iterations[False],
+            'fps': self.iterations[True] / wall if wall > 0. else 0.,
+            'cpu': self.cpu_usage(),
+            'rendering cpu': self.cpu_usage(True),
+            'idle cpu': self.cpu_usage(False),
+        }
+        if times.shape[0] > 0:
+            summary.update({
+                'mean': times.mean(),
+                'p95': np.percentile(times, 95),
+                'p99': np.percentile(times, 99),
+                'jitter': times.std(),
+            })
+        return summary
+
+    def report(self):
+        '''
+        Print a summary of the statistics.
+        '''
+        summary = self.summary()
+        log.info('--> %d frames and %d idle iterations, %.1f fps',
+                 summary['frames'], summary['idle iterations'], summary['fps'])
+        log.info('- CPU usage: %.1f%% overall, %.1f%% while rendering, %.1f%% while idle',
+                 100. * summary['cpu'], 100. * summary['rendering cpu'], 100. * summary['idle cpu'])
+        if 'mean' in summary:
+            log.info('- frame time: mean %.2f ms, p95 %.2f ms, p99 %.2f ms, jitter %.2f ms',
+                     summary['mean'], summary['p95'], summary['p99'], summary['jitter'])
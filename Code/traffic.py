@@ -0,0 +1,274 @@
+# import requirements
+import time
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+Traffic simulation moving vehicles along lanes. The state of all vehicles is stored as a structure of arrays, and
+each fixed timestep updates all of them at once: leaders are found by sorting the vehicles along their lane, the
+acceleration follows the Intelligent Driver Model, and a damped controller keeps each vehicle centred in its lane.
+The module only depends on numpy, so it can run headless, without any OpenGL context.
+Source:
+https://en.wikipedia.org/wiki/Intelligent_driver_model
+'''
+
+log = get_logger(__name__)
+
+
+class Lanes:
+    '''
+    Class to hold a set of closed polyline lanes, packed in flat arrays for vectorised lookups.
+    '''
+    def __init__(self, paths):
+        '''
+        :param paths: list of (K,3) arrays of points, each lane goes through its points and back to the first one
+        '''
+        points = []
+        directions = []
+        starts = []
+        lengths = []
+        counts = []
+        for path in paths:
+            path = np.asarray(path, dtype=np.float64)
+            segments = np.roll(path, -1, axis=0) - path
+            length = np.linalg.norm(segments, axis=1)
+            points.append(path)
+            directions.append(segments / length[:, np.newaxis])
+            starts.append(np.concatenate([[0.], np.cumsum(length)[:-1]]))
+            lengths.append(length.sum())
+            counts.append(path.shape[0])
+
+        self.count = len(paths)
+        self.length = np.array(lengths)
+        self.points = np.concatenate(points)
+        self.directions = np.concatenate(directions)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+        # each lane gets its own window of a global arc length axis, so one binary search serves all lanes.
+        self.stride = self.length.max() + 1.
+        lane_ids = np.repeat(np.arange(self.count), counts)
+        self.keys = np.concatenate(starts) + lane_ids * self.stride
+
+    def locate(self, lane, s):
+        '''
+        Find the position and direction at arc length s along each lane.
+        :param lane: (N,) lane index of each query
+        :param s: (N,) arc length along the lane, in [0, length[
+        :return: (N,3) positions and (N,3) unit directions
+        '''
+        query = s + lane * self.stride
+        segment = np.searchsorted(self.keys, query, side='right') - 1
+        segment = np.clip(segment, self.offsets[lane], self.offsets[lane + 1] - 1)
+        along = query - self.keys[segment]
+        directions = self.directions[segment]
+        return self.points[segment] + directions * along[:, np.newaxis], directions
+
+
+def lanes_from_road(vertices, M=None, y=None, separation=None):
+    '''
+    Build a circuit along a straight road running along the Z axis: one lane down each side of the road, joined by
+    half turns at both ends.
+    :param vertices: (N,3) vertices of the road surface mesh
+    :param M: [optional] model matrix of the road
+    :param y: [optional] height of the lanes, the top of the road if None
+    :param separation: [optional] distance between the lanes, half the road width if None
+    :return: a Lanes object
+    '''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    if M is not None:
+        vertices = np.matmul(vertices, np.asarray(M)[:3, :3].T) + np.asarray(M)[:3, 3]
+
+    low = vertices.min(axis=0)
+    high = vertices.max(axis=0)
+    centre = (low + high) / 2.
+    if separation is None:
+        separation = (high[0] - low[0]) / 2.
+    if y is None:
+        y = high[1]
+
+    # the half turns stay on the road.
+    radius = separation / 2.
+    z0 = low[2] + radius
+    z1 = high[2] - radius
+    angles = np.linspace(0., np.pi, 12)
+    turn = np.column_stack([-radius * np.cos(angles), np.zeros_like(angles), -radius * np.sin(angles)])
+
+    path = np.concatenate([
+        [[centre[0] - radius, y, z1]],
+        turn + [centre[0], y, z0],
+        [[centre[0] + radius, y, z1]],
+        -turn[1:-1] + [centre[0], y, z1],
+    ])
+    return Lanes([path])
+
+
+def circle_lanes(count, radius=200., spacing=10.):
+    '''
+    Build concentric circular lanes, used to benchmark large numbers of vehicles.
+    '''
+    angles = np.linspace(0., 2. * np.pi, 64, endpoint=False)
+    return Lanes([np.column_stack([(radius + i * spacing) * np.cos(angles), np.zeros_like(angles),
+                                   (radius + i * spacing) * np.sin(angles)]) for i in range(count)])
+
+
+class TrafficSimulation:
+    '''
+    Class to hold the state of all vehicles and step them at a fixed timestep.
+    '''
+    def __init__(self, lanes, count, dt=1. / 60., seed=0, desired_speed=8., vehicle_length=5.2):
+        '''
+        :param lanes: the Lanes object the vehicles drive on
+        :param count: the number of vehicles, spread evenly over the lanes
+        :param dt: the fixed simulation timestep in seconds
+        :param seed: seed of the random variations between drivers
+        :param desired_speed: mean speed the drivers aim for, in scene units per second
+        :param vehicle_length: length of the vehicles, in scene units
+        '''
+        self.lanes = lanes
+        self.dt = dt
+        self.time = 0.
+        self.accumulator = 0.
+        rng = np.random.default_rng(seed)
+
+        # Intelligent Driver Model parameters: maximum acceleration, comfortable braking, time headway and minimum
+        # distance to the leader.
+        self.acceleration = 1.5
+        self.braking = 2.
+        self.headway = 1.2
+        self.min_gap = 1.
+
+        # lane-keeping controller gains on the lateral offset and its rate.
+        self.keep_gain = 2.
+        self.keep_damping = 2.5
+
+        # spread the vehicles over the lanes in proportion to their length.
+        share = lanes.length / lanes.length.sum()
+        per_lane = np.floor(share * count).astype(np.int64)
+        per_lane[:count - per_lane.sum()] += 1
+        self.lane = np.repeat(np.arange(lanes.count), per_lane).astype(np.int32)
+        rank = np.arange(count) - np.repeat(np.concatenate([[0], np.cumsum(per_lane)[:-1]]), per_lane)
+
+        # vehicle state, one entry per vehicle.
+        self.s = (rank + rng.uniform(0., 0.3, count)) * (lanes.length / np.maximum(per_lane, 1))[self.lane]
+        self.speed = np.zeros(count, dtype=np.float32)
+        self.desired_speed = (desired_speed * rng.uniform(0.8, 1.2, count)).astype(np.float32)
+        self.length = np.full(count, vehicle_length, dtype=np.float32)
+        self.offset = rng.uniform(-0.3, 0.3, count).astype(np.float32)
+        self.offset_rate = np.zeros(count, dtype=np.float32)
+        self.heading = np.zeros(count, dtype=np.float32)
+
+    @property
+    def count(self):
+        return self.s.shape[0]
+
+    def leaders(self):
+        '''
+        Find the vehicle ahead of each vehicle in its lane, and the bumper to bumper gap to it.
+        '''
+        order = np.lexsort((self.s, self.lane))
+        lane = self.lane[order]
+
+        # the leader is the next vehicle in the sorted order, wrapping around to the first one of the lane.
+        leader = np.roll(order, -1)
+        last = np.append(lane[1:] != lane[:-1], True)
+        first = np.concatenate([[True], lane[1:] != lane[:-1]])
+        leader[last] = order[first]
+
+        gap = np.empty(self.count)
+        gap[order] = self.s[leader] - self.s[order]
+        gap[order[last]] += self.lanes.length[lane[last]]
+
+        leaders = np.empty(self.count, dtype=np.int64)
+        leaders[order] = leader
+        return leaders, gap - self.length[leaders]
+
+    def step(self, steps=1):
+        '''
+        Advance the simulation by a number of fixed timesteps.
+        '''
+        for _ in range(steps):
+            leaders, gap = self.leaders()
+            v = self.speed
+            dv = v - v[leaders]
+
+            # Intelligent Driver Model acceleration.
+            desired_gap = self.min_gap + v * self.headway + v * dv / (2. * np.sqrt(self.acceleration * self.braking))
+            accel = self.acceleration * (1. - (v / self.desired_speed) ** 4
+                                         - (np.maximum(desired_gap, 0.) / np.maximum(gap, 0.1)) ** 2)
+
+            self.speed = np.maximum(v + accel * self.dt, 0.).astype(np.float32)
+            self.s = np.mod(self.s + self.speed * self.dt, self.lanes.length[self.lane])
+
+            # damped steering back to the lane centre.
+            self.offset_rate += (-self.keep_gain * self.offset - self.keep_damping * self.offset_rate) * self.dt
+            self.offset += self.offset_rate * self.dt
+            self.time += self.dt
+
+    def advance(self, elapsed, max_steps=8):
+        '''
+        Advance the simulation by a wall-clock duration, using as many fixed timesteps as fit in it.
+        :param elapsed: the duration in seconds
+        :param max_steps: the maximum number of steps, the remaining time is dropped to avoid spiralling
+        :return: the number of steps taken
+        '''
+        self.accumulator += elapsed
+        steps = min(int(self.accumulator / self.dt), max_steps)
+        self.accumulator = 0. if steps == max_steps else self.accumulator - steps * self.dt
+        self.step(steps)
+        return steps
+
+    def transforms(self, out=None):
+        '''
+        Model matrices of all vehicles, with the vehicle models facing -Z in their own frame.
+        :param out: [optional] (N,4,4) float32 array to write the matrices into, such as an instance buffer
+        :return: the (N,4,4) array of matrices
+        '''
+        if out is None:
+            out = np.empty((self.count, 4, 4), dtype='f')
+
+        position, direction = self.lanes.locate(self.lane, self.s)
+
+        # lateral offset to the right of the direction of travel, in the horizontal plane.
+        right = np.column_stack([-direction[:, 2], np.zeros(self.count), direction[:, 0]])
+        position += right * self.offset[:, np.newaxis]
+
+        # the heading follows the lane, turned by the lateral motion.
+        steer = np.arctan2(self.offset_rate, np.maximum(self.speed, 0.1))
+        self.heading = (np.arctan2(-direction[:, 0], -direction[:, 2]) - steer).astype(np.float32)
+
+        c = np.cos(self.heading)
+        s = np.sin(self.heading)
+        out[...] = 0.
+        out[:, 0, 0] = c
+        out[:, 0, 2] = s
+        out[:, 1, 1] = 1.
+        out[:, 2, 0] = -s
+        out[:, 2, 2] = c
+        out[:, :3, 3] = position
+        out[:, 3, 3] = 1.
+        return out
+
+
+def benchmark(counts=(1000, 10000, 100000), steps=100):
+    '''
+    Report the simulation throughput, in vehicles stepped per millisecond.
+    '''
+    for count in counts:
+        # 100 vehicles per lane keeps the density realistic whatever the number of vehicles.
+        simulation = TrafficSimulation(circle_lanes(max(1, count // 100)), count)
+        out = np.empty((count, 4, 4), dtype='f')
+        simulation.step(10)
+
+        start = time.perf_counter()
+        for _ in range(steps):
+            simulation.step()
+            simulation.transforms(out)
+        elapsed = 1000. * (time.perf_counter() - start)
+
+        log.info('%7d vehicles: %8.3f ms per step, %9.0f vehicles per ms', count, elapsed / steps, count * steps / elapsed)
+
+
+if __name__ == '__main__':
+    benchmark()
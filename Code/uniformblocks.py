@@ -0,0 +1,164 @@
+# imports all openGL functions
+from glbackend import gl
+
+# import manipulation functions.
+from matutils import *
+
+import numpy as np
+
+from runtime import get_logger
+
+'''
+Uniform buffer objects shared by all shader programs. The data which is the same for every draw of a frame, the
+camera matrices, the light and its shadow map parameters and the rendering mode, is written once per frame to the Frame block, and the materials
+are stored in a table in the Materials block, so that each draw only sets the model matrix and a material index.
+Both blocks use the std140 layout, in which vec3 are padded to vec4 and the int mode ends the block.
+'''
+
+log = get_logger(__name__)
+
+# the binding points of the blocks, shared by all programs.
+FRAME_BINDING = 0
+MATERIALS_BINDING = 1
+
+# the number of materials in the table, 16 kB of 64 bytes materials, the smallest GL_MAX_UNIFORM_BLOCK_SIZE allowed.
+MAX_MATERIALS = 256
+
+# size in floats of the Frame block: P, V, PV, light, Ia, Id, Is, the shadow matrix and parameters, and mode padded to
+# a vec4.
+FRAME_FLOATS = 3 * 16 + 4 * 4 + 16 + 4 + 4
+
+# size in floats of a material: Ka, Kd, Ks and (Ns, has_texture) padded to vec4.
+MATERIAL_FLOATS = 4 * 4
+
+
+def _uniform_buffer(size, binding):
+    '''
+    Create a uniform buffer of a size in bytes, bound to a binding point.
+    '''
+    buffer = gl.glGenBuffers(1)
+    gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, buffer)
+    gl.glBufferData(gl.GL_UNIFORM_BUFFER, size, None, gl.GL_DYNAMIC_DRAW)
+    gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+    gl.glBindBufferBase(gl.GL_UNIFORM_BUFFER, binding, buffer)
+    return buffer
+
+
+def bind_blocks(program):
+    '''
+    Assign the blocks used by a program to their binding points.
+    '''
+    for name, binding in (('Frame', FRAME_BINDING), ('Materials', MATERIALS_BINDING)):
+        index = gl.glGetUniformBlockIndex(program, name)
+        if index is not None and index != gl.GL_INVALID_INDEX:
+            gl.glUniformBlockBinding(program, index, binding)
+
+
+class FrameUniforms:
+    '''
+    Class to hold the per-frame uniform block.
+    '''
+    def __init__(self):
+        self.data = np.zeros(FRAME_FLOATS, dtype=np.float32)
+        self.buffer = _uniform_buffer(self.data.nbytes, FRAME_BINDING)
+
+    def update(self, scene):
+        '''
+        Fill the block from the camera, light and mode of the scene, and upload it.
+        '''
+        P = scene.P
+        V = scene.camera.V
+        light = scene.light
+
+        # matrices are stored column major, as GLSL reads them.
+        self.data[0:16] = P.T.flatten()
+        self.data[16:32] = V.T.flatten()
+        self.data[32:48] = np.matmul(P, V).T.flatten()
+
+        # the light position is transformed to view coordinates once per frame, a snapshot brings its own.
+        position = light.position if scene.snapshot is None else scene.snapshot.light
+        self.data[48:51] = unhomog(np.dot(V, homog(position)))
+        self.data[52:55] = light.Ia
+        self.data[56:59] = light.Id
+        self.data[60:63] = light.Is
+
+        # the shadow matrix takes world positions to the shadow map, and shadows are disabled by a zero parameter.
+        shadows = scene.shadows
+        if shadows is not None and scene.shadows_enabled:
+            self.data[64:80] = shadows.LPV.T.flatten()
+            self.data[80:84] = shadows.parameters()
+        else:
+            self.data[80:84] = 0.
+        self.data[84:85].view(np.int32)[0] = scene.mode
+
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.buffer)
+        gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, 0, self.data.nbytes, self.data)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+
+    def delete(self):
+        gl.glDeleteBuffers(1, [self.buffer])
+
+
+class MaterialTable:
+    '''
+    Class to hold the materials uniform block. Materials get an index in the table the first time they are drawn, and
+    the table is uploaded once per frame, so that changes to the material properties are still taken into account.
+    '''
+    def __init__(self):
+        self.data = np.zeros((MAX_MATERIALS, MATERIAL_FLOATS), dtype=np.float32)
+        self.buffer = _uniform_buffer(self.data.nbytes, MATERIALS_BINDING)
+
+        # the materials of the table, and their index by material and texture flag.
+        self.materials = []
+        self.indices = {}
+
+    def index(self, material, has_texture):
+        '''
+        Returns the index of a material in the table, adding it if needed.
+        '''
+        key = (id(material), has_texture)
+        index = self.indices.get(key)
+        if index is None:
+            if len(self.materials) == MAX_MATERIALS:
+                log.warning('more than %d materials, reusing the last one', MAX_MATERIALS)
+                return MAX_MATERIALS - 1
+            index = len(self.materials)
+            self.materials.append((material, has_texture))
+            self.indices[key] = index
+
+            # the new entry is uploaded at once, as it is about to be drawn.
+            self._fill(index)
+            self._upload(index, index + 1)
+        return index
+
+    def _fill(self, index):
+        material, has_texture = self.materials[index]
+        row = self.data[index]
+        row[0:3] = material.Ka
+        row[4:7] = material.Kd
+        row[8:11] = material.Ks
+        row[12] = material.Ns
+        row[13] = has_texture
+
+    def _upload(self, start, end):
+        '''
+        Upload the entries of the table from start to end.
+        '''
+        row_size = MATERIAL_FLOATS * 4
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.buffer)
+        gl.glBufferSubData(gl.GL_UNIFORM_BUFFER, start * row_size, (end - start) * row_size, self.data[start:end])
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+
+    def update(self):
+        '''
+        Fill the table from the materials and upload the entries used.
+        '''
+        if not self.materials:
+            return
+
+        for index in range(len(self.materials)):
+            self._fill(index)
+        self._upload(0, len(self.materials))
+
+    def delete(self):
+        gl.glDeleteBuffers(1, [self.buffer])
@@ -0,0 +1,356 @@
+# import requirements
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from matutils import *
+
+from mesh import Mesh, calculate_normals
+from objstream import iter_obj_groups
+from BaseModel import DrawModelFromMesh
+from shaders import ClusteredShader
+
+# CPU profiler of the frame stages.
+from profiler import profiler
+
+from runtime import get_logger, quiet
+
+'''
+Streaming of a world too large to be loaded at once, divided into a grid of chunks on the ground plane, each
+referencing the models placed in it. Chunks within the load radius of the point the camera looks at are parsed in
+worker processes, with their normals, and their models are created on the main thread a few chunks per frame, as
+they need the OpenGL context. Chunks are drawn while within the unload radius, larger than the load radius so that
+chunks near the boundary are not loaded and unloaded over and over. Beyond it they stay resident until the memory or
+GPU budget is exceeded, and are then evicted least recently used first, so that going back to a place does not
+reload it.
+'''
+
+log = get_logger(__name__)
+
+# spacing of the copies of the street in a city, along x and z, and the centre of the street model.
+STREET_SPACING = (24., 72.)
+STREET_CENTER = (6.5, -12.5)
+
+
+def city_layout(columns, rows, file_name='models/test.obj', skip=((0, 0),)):
+    '''
+    A city made of copies of the street model on a grid, one per chunk.
+    :param columns: the number of chunks along x, centred on the origin
+    :param rows: the number of chunks along z, centred on the origin
+    :param skip: the chunks left empty, e.g. the one of the street already in the scene
+    :return: dictionary of the list of (file name, model matrix) of each chunk, by chunk index
+    '''
+    layout = {}
+    for i in range(-(columns // 2), columns - columns // 2):
+        for j in range(-(rows // 2), rows - rows // 2):
+            if (i, j) in skip:
+                continue
+            layout[(i, j)] = [(file_name, translationMatrix([i * STREET_SPACING[0], -5., -10. + j * STREET_SPACING[1]]))]
+    return layout
+
+
+def _load_chunk(files):
+    '''
+    Read the material groups of the files of a chunk and calculate their normals, in a worker process.
+    :return: the list of (model matrix, group, normals, tangents, binormals)
+    '''
+    groups = []
+    with quiet():
+        for file_name, M in files:
+            for group in iter_obj_groups(file_name):
+                groups.append((M, group) + tuple(calculate_normals(group.vertices, group.faces, group.textureCoords)))
+    return groups
+
+
+class Chunk:
+    '''
+    Class to hold the state of a chunk of the world.
+    '''
+    def __init__(self, key, files, center):
+        '''
+        :param key: the (column, row) index of the chunk
+        :param files: the list of (file name, model matrix) of the models of the chunk
+        :param center: the (x, z) centre of the chunk
+        '''
+        self.key = key
+        self.files = files
+        self.center = np.array(center, dtype=np.float32)
+
+        # None, 'loading', 'loaded' once parsed and waiting to be created, or 'resident'.
+        self.state = None
+        self.future = None
+        self.groups = None
+        self.models = []
+
+        # sizes of the mesh data in memory and in the GPU buffers, in bytes.
+        self.memory = 0
+        self.gpu = 0
+
+        self.requested = 0.
+        self.last_used = 0
+
+
+class WorldStreamer:
+    '''
+    Class to load and evict the chunks of the world around the camera.
+    '''
+    def __init__(self, scene, layout, chunk_size=STREET_SPACING, origin=STREET_CENTER, load_radius=80.,
+                 unload_radius=120., memory_budget=64 << 20, gpu_budget=64 << 20, workers=2, creates_per_frame=1):
+        '''
+        :param scene: the scene drawing the chunks, whose buffer arena stores the models
+        :param layout: dictionary of the list of (file name, model matrix) of each chunk, by (column, row) index
+        :param chunk_size: the size of the chunks along x and z
+        :param origin: the (x, z) centre of chunk (0, 0)
+        :param load_radius: the distance from the camera centre within which chunks are loaded
+        :param unload_radius: the distance beyond which chunks are not drawn and may be evicted
+        :param memory_budget: the bytes of mesh data kept in memory
+        :param gpu_budget: the bytes of vertex and index data kept in the arena
+        :param workers: the number of worker processes parsing the chunks
+        :param creates_per_frame: the number of parsed chunks whose models are created per frame
+        '''
+        if unload_radius < load_radius:
+            raise ValueError('The unload radius {} must not be smaller than the load radius {}'.format(
+                unload_radius, load_radius))
+
+        self.scene = scene
+        self.load_radius = load_radius
+        self.unload_radius = unload_radius
+        self.memory_budget = memory_budget
+        self.gpu_budget = gpu_budget
+        self.workers = workers
+        self.creates_per_frame = creates_per_frame
+
+        self.chunks = {key: Chunk(key, files, [origin[0] + key[0] * chunk_size[0], origin[1] + key[1] * chunk_size[1]])
+                       for key, files in layout.items()}
+        self.centers = np.array([chunk.center for chunk in self.chunks.values()], dtype=np.float32).reshape(-1, 2)
+        self.pool = None
+
+        # the models share one program and the materials of the same name share one entry of the materials table.
+        self.shader = ClusteredShader()
+        self.shader.compile(scene.arena.attributes)
+        self.materials = {}
+
+        self.frame = 0
+        self.memory = 0
+        self.gpu = 0
+        self.visible = []
+
+        # statistics since the last report.
+        self.latencies = []
+        self.loads = 0
+        self.evictions = 0
+        self.deferred = 0
+
+    def focus(self):
+        '''
+        The (x, z) position of the point the camera turns around, the camera looks at -center.
+        '''
+        center = self.scene.camera.center
+        return np.array([-center[0], -center[2]], dtype=np.float32)
+
+    def _evict(self, chunk):
+        for model in chunk.models:
+            if model.allocation is not None:
+                model.arena.free(model.allocation)
+                model.allocation = None
+        chunk.models = []
+        chunk.groups = None
+        chunk.state = None
+        self.memory -= chunk.memory
+        self.gpu -= chunk.gpu
+        chunk.memory = chunk.gpu = 0
+        self.evictions += 1
+
+    def _make_room(self, memory, gpu, distances):
+        '''
+        Evict the least recently used chunks beyond the unload radius until the sizes fit in the budgets.
+        :return: whether they fit
+        '''
+        candidates = sorted([chunk for chunk, distance in zip(self.chunks.values(), distances)
+                             if chunk.state == 'resident' and distance > self.unload_radius],
+                            key=lambda chunk: chunk.last_used)
+        for chunk in candidates:
+            if self.memory + memory <= self.memory_budget and self.gpu + gpu <= self.gpu_budget:
+                break
+            self._evict(chunk)
+        return self.memory + memory <= self.memory_budget and self.gpu + gpu <= self.gpu_budget
+
+    def _create(self, chunk, distances):
+        '''
+        Create the models of a parsed chunk, if the budgets allow it.
+        :return: whether the chunk was created
+        '''
+        memory = sum(sum(array.nbytes for array in (group.vertices, group.faces, group.textureCoords, normals,
+                                                    tangents, binormals) if array is not None)
+                     for _, group, normals, tangents, binormals in chunk.groups)
+        vertex_size = 4 * sum(size for _, size in self.scene.arena.attribute_sizes)
+        gpu = sum(group.vertices.shape[0] * vertex_size + group.faces.size * 4 for _, group, *_ in chunk.groups)
+        if not self._make_room(memory, gpu, distances):
+            self.deferred += 1
+            return False
+
+        for M, group, normals, tangents, binormals in chunk.groups:
+            material = self.materials.setdefault(group.material.name, group.material)
+            mesh = Mesh(vertices=group.vertices, faces=group.faces, normals=normals, textureCoords=group.textureCoords,
+                        material=material, tangents=tangents, binormals=binormals)
+            model = DrawModelFromMesh(scene=self.scene, M=M, mesh=mesh, arena=self.scene.arena)
+            model.shader = self.shader
+            chunk.models.append(model)
+
+        chunk.memory = memory
+        chunk.gpu = gpu
+        self.memory += memory
+        self.gpu += gpu
+        chunk.state = 'resident'
+        chunk.last_used = self.frame
+        self.loads += 1
+        self.latencies.append(time.perf_counter() - chunk.requested)
+        return True
+
+    def update(self):
+        '''
+        Request the chunks entering the load radius, create the models of the chunks parsed, nearest first, and
+        select the chunks to draw.
+        :return: whether the chunks drawn have changed
+        '''
+        self.frame += 1
+        if not self.chunks:
+            return False
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers)
+
+        distances = np.linalg.norm(self.centers - self.focus(), axis=1)
+        order = np.argsort(distances)
+        chunks = list(self.chunks.values())
+        changed = False
+
+        with profiler.scope('requests'):
+            for index in order:
+                chunk = chunks[index]
+                if distances[index] > self.load_radius:
+                    break
+                if chunk.state is None:
+                    chunk.state = 'loading'
+                    chunk.requested = time.perf_counter()
+                    chunk.future = self.pool.submit(_load_chunk, chunk.files)
+
+        with profiler.scope('create'):
+            created = 0
+            for index in order:
+                chunk = chunks[index]
+                if chunk.state == 'loading' and chunk.future.done():
+                    chunk.groups = chunk.future.result()
+                    chunk.future = None
+                    chunk.state = 'loaded'
+                if chunk.state == 'loaded' and created < self.creates_per_frame:
+                    # chunks which have left the unload radius while loading are dropped.
+                    if distances[index] > self.unload_radius:
+                        chunk.groups = None
+                        chunk.state = None
+                        continue
+                    if self._create(chunk, distances):
+                        created += 1
+                        changed = True
+
+        visible = [chunk for chunk, distance in zip(chunks, distances)
+                   if chunk.state == 'resident' and distance <= self.unload_radius]
+        for chunk in visible:
+            chunk.last_used = self.frame
+        changed = changed or [chunk.key for chunk in visible] != [chunk.key for chunk in self.visible]
+        self.visible = visible
+
+        profiler.count('resident chunks', sum(chunk.state == 'resident' for chunk in chunks))
+        return changed
+
+    def draw_list(self):
+        '''
+        The models of the chunks within the unload radius.
+        :return: a list of (model, parent matrix) pairs
+        '''
+        identity = poseMatrix()
+        return [(model, identity) for chunk in self.visible for model in chunk.models]
+
+    def wait(self):
+        '''
+        Block until the chunks requested are parsed.
+        '''
+        for chunk in self.chunks.values():
+            if chunk.future is not None:
+                chunk.future.result()
+
+    def stats(self):
+        '''
+        The chunk counts, load latencies in milliseconds and budget usage.
+        '''
+        states = [chunk.state for chunk in self.chunks.values()]
+        latencies = 1000. * np.array(self.latencies) if self.latencies else np.zeros(1)
+        return {
+            'chunks': len(states),
+            'resident': states.count('resident'),
+            'visible': len(self.visible),
+            'loading': states.count('loading') + states.count('loaded'),
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'deferred': self.deferred,
+            'latency mean': float(latencies.mean()),
+            'latency p95': float(np.percentile(latencies, 95)),
+            'latency max': float(latencies.max()),
+            'memory': self.memory / self.memory_budget,
+            'gpu': self.gpu / self.gpu_budget,
+        }
+
+    def report(self):
+        stats = self.stats()
+        log.info('--> World streaming: %d of %d chunks resident, %d drawn, %d loading',
+                 stats['resident'], stats['chunks'], stats['visible'], stats['loading'])
+        log.info('- %d load(s), latency mean %.1f ms, p95 %.1f ms, max %.1f ms',
+                 stats['loads'], stats['latency mean'], stats['latency p95'], stats['latency max'])
+        log.info('- budgets: memory %.0f%%, GPU %.0f%%, %d eviction(s), %d creation(s) deferred',
+                 100. * stats['memory'], 100. * stats['gpu'], stats['evictions'], stats['deferred'])
+        self.latencies = []
+        self.loads = 0
+        self.evictions = 0
+        self.deferred = 0
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+
+def benchmark(columns=3, rows=16, frames=600, speed=1.5, memory_budget=1 << 20, gpu_budget=1 << 20):
+    '''
+    Fly the camera down the length of a city without any GPU, with small budgets so that chunks are evicted, and
+    report the frame times and the streaming statistics.
+    '''
+    from project import ProjectScene
+
+    scene = ProjectScene(headless=True, city=(columns, rows))
+    world = scene.world
+    world.memory_budget = memory_budget
+    world.gpu_budget = gpu_budget
+
+    # start from one end of the city, looking down at the street.
+    start_z = -STREET_SPACING[1] * (rows // 2)
+    scene.camera.distance = 40.
+    scene.camera.psi = 0.6
+    frame_times = []
+    for frame in range(frames):
+        scene.camera.center = [-STREET_CENTER[0], 0., -(start_z + speed * frame)]
+        start = time.perf_counter()
+        scene.update(scene.timestep)
+        scene.draw()
+        frame_times.append(time.perf_counter() - start)
+        if frame % 100 == 99:
+            log.info('frame %d: %d chunks resident', frame + 1, world.stats()['resident'])
+
+    times = 1000. * np.array(frame_times)
+    log.info('--> %d frames flying %.0f units: mean %.2f ms, p95 %.2f ms, max %.2f ms',
+             frames, speed * frames, times.mean(), np.percentile(times, 95), times.max())
+    world.report()
+    world.close()
+
+
+if __name__ == '__main__':
+    benchmark()